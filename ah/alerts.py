@@ -0,0 +1,354 @@
+"""
+alerts.py
+=========
+
+Incremental alert rules over the price histories of a watchlist.
+
+Rules are short conditions on the newest scan of a series:
+>>> marketValue < 5000                  a field (marketValue, minBuyout or quantity) against a fixed value, in copper or units
+>>> quantity > 50% vs 24h               the change of a field from its average over about the last 24 scans
+>>> minBuyout < -2 sigma vs 168h        a field in standard deviations from its average (the window defaults to 24h)
+>>> spread > 10%                        the server price relative to the region price; also `spread > 2 sigma vs 168h`, ...
+
+Every rule is compiled once into one entry per `(item, market)` series it covers, and each check evaluates all entries at
+once against every stored scan newer than the last one seen, in scan order, skipping series without a new scan.  Averages and
+deviations are exponentially weighted, so every entry keeps O(1) state however long its window.  A rule alerts when its condition
+becomes true, not again while it stays true.  Engines built with a store first replay its last few windows of scans without
+alerting, so a restarted poller neither starts blind nor repeats alerts that already fired.
+
+Rules files are JSON of the form:
+>>> {
+>>>     "rules": [
+>>>         {"name": "Cheap ore", "items": ["Saronite Ore"], "markets": ["Skyfury-Alliance"], "when": "marketValue < 5000"},
+>>>         {"name": "Supply spike", "when": "quantity > 50% vs 24h"},
+>>>         {"name": "Server premium", "when": "spread > 2 sigma vs 168h"}
+>>>     ],
+>>>     "sinks": [{"type": "stdout"}, {"type": "file", "path": "alerts.jsonl"}, {"type": "webhook", "url": "http://127.0.0.1:8800/webhook"}]
+>>> }
+`items` and `markets` default to everything on the watchlist.  Spread rules compare each server with the watchlist's first region.
+
+Usage:
+>>> python -m ah.poller watchlist.json --alerts alerts.json
+"""
+import re
+import sys
+import json
+import datetime
+import urllib.request
+import numpy as np
+import ah.store as store
+import ah.metrics as metrics
+from ah.watchlist import Watchlist
+
+FIELDS = ("marketValue", "minBuyout", "quantity")
+OPERATORS = ("<", "<=", ">", ">=")
+LEVEL, CHANGE, SIGMA = 0, 1, 2
+DEFAULT_WINDOW = 24         # Hours of scans the averages of `% vs` and `sigma` conditions cover by default.
+MIN_SCANS = 6               # Scans a series needs before its `% vs` and `sigma` conditions can alert.
+WARMUP = 3                  # Windows of stored scans replayed to warm the averages up (about 95% of their weight).
+CONDITION = re.compile(r"^\s*(?P<field>marketValue|minBuyout|quantity|spread)\s*(?P<op><=|>=|<|>)\s*(?P<value>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*"
+                       r"(?P<unit>%|sigma|σ)?(?:\s*vs\s*(?P<window>\d+)\s*h)?\s*$")
+
+
+
+
+
+def parse_condition(text: str) -> dict:
+    """
+    Parses a rule condition such as `"quantity > 50% vs 24h"`.  Raises `ValueError` if it isn't one.
+    Numbers may be written with decimals or in scientific notation (e.g. `1.5e6`).
+
+    Returns
+    -------
+    Dictionary of the form:
+    >>> {"field": "quantity", "op": ">", "value": 50.0, "kind": CHANGE, "window": 24, "scale": 1}
+    where `value` is in the unit conditions are tested in (a fraction for `spread > 10%`), and `scale` converts that unit back to the one written.
+    """
+    match = CONDITION.match(text)
+    if match is None:
+        raise ValueError(f"\n>> Can't parse the alert condition '{text}'.  Expected e.g. 'marketValue < 5000', 'marketValue > 1.5e6', 'quantity > 50% vs 24h' or 'spread > 2 sigma'.\n")
+    value, unit, window, scale = float(match["value"]), match["unit"], match["window"], 1
+    if unit in ("sigma", "σ"):
+        kind = SIGMA
+    elif unit == "%" and window:
+        kind = CHANGE
+    elif window:
+        raise ValueError(f"\n>> '{text}': only '%' and 'sigma' conditions can be compared with an average ('vs {window}h').\n")
+    else:
+        kind = LEVEL
+        scale = 100 if unit == "%" else 1
+        value = value / scale
+    return {"field": match["field"], "op": match["op"], "value": value, "kind": kind, "window": int(window or DEFAULT_WINDOW), "scale": scale}
+
+
+
+
+
+class AlertEngine:
+    """
+    Compiled alert rules for the series of a watchlist, with their running state.
+
+    Each compiled entry pairs one rule with one series, and its state is one exponentially weighted mean and variance,
+    the time of the last scan it saw and whether its condition held then.  Each series also keeps its newest scan seen.
+    """
+
+    def __init__(self, rules: list, watchlist: Watchlist, sinks: list = None, historyStore: store.HistoryStore = None):
+        """
+        Parameters
+        ----------
+        `rules`: List of rule dictionaries with a `when` condition and optional `name`, `items` and `markets`.  See the module docstring.
+        `watchlist`: The watchlist the rules apply to.
+        `sinks`: Where alerts are sent, e.g. `[StdoutSink(), FileSink("alerts.jsonl")]`.  Default is `None`, i.e. alerts are only returned.
+        `historyStore`: Optional store to `warm` the state up from.  Default is `None`, i.e. the state starts empty.
+        """
+        self.sinks = list(sinks or [])
+        self.series = []
+        self._seriesIndex = {}
+        region = watchlist.regions[0] if watchlist.regions else "US"
+        servers = {f"{realm}-{faction}": (realm, faction) for realm, faction in watchlist.servers()}
+        regions = {name: name for name in watchlist.regions}
+        entries = []
+        for rule in rules:
+            condition = parse_condition(rule["when"])
+            name = rule.get("name", rule["when"])
+            items = rule.get("items", watchlist.items)
+            unknown = [item for item in items if item not in watchlist.items]
+            if unknown:
+                raise ValueError(f"\n>> Alert rule '{name}' covers items that aren't on the watchlist: {', '.join(unknown)}.\n")
+            markets = rule.get("markets", list(servers) if condition["field"] == "spread" else [*servers, *regions])
+            for market in markets:
+                if market not in servers and market not in regions:
+                    raise ValueError(f"\n>> Alert rule '{name}' covers a market that isn't on the watchlist: {market}.\n")
+                if condition["field"] == "spread" and market not in servers:
+                    raise ValueError(f"\n>> Alert rule '{name}' compares a region with itself; spread rules only apply to servers.\n")
+                for item in items:
+                    source = store.server_source(item, *servers[market]) if market in servers else store.region_source(item, market)
+                    reference = self._series(*store.region_source(item, region)[:2]) if condition["field"] == "spread" else -1
+                    entries.append((name, rule["when"], item, market, self._series(*source[:2]), reference, condition))
+        self.names = [e[0] for e in entries]
+        self.conditions = [e[1] for e in entries]
+        self.items = [e[2] for e in entries]
+        self.markets = [e[3] for e in entries]
+        self._source = np.array([e[4] for e in entries], dtype=np.int64)
+        self._reference = np.array([e[5] for e in entries], dtype=np.int64)
+        self._field = np.array([FIELDS.index(e[6]["field"]) if e[6]["field"] != "spread" else 0 for e in entries], dtype=np.int64)
+        self._op = np.array([OPERATORS.index(e[6]["op"]) for e in entries], dtype=np.int64)
+        self._kind = np.array([e[6]["kind"] for e in entries], dtype=np.int64)
+        self._value = np.array([e[6]["value"] for e in entries], dtype=np.float64)
+        self._alpha = np.array([2 / (e[6]["window"] + 1) for e in entries], dtype=np.float64)
+        self._scale = np.array([e[6]["scale"] for e in entries], dtype=np.float64)
+        self._window = max([e[6]["window"] for e in entries], default=DEFAULT_WINDOW)
+        # running state
+        n = len(entries)
+        self.mean = np.zeros(n)
+        self.variance = np.zeros(n)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.lastTime = np.full(n, -1, dtype=np.int64)
+        self.firing = np.zeros(n, dtype=bool)
+        self.seenTime = np.full(len(self.series), -1, dtype=np.int64)
+        self.seenValues = np.full((len(self.series), len(FIELDS)), np.nan)
+        if historyStore is not None:
+            self.warm(historyStore)
+
+
+    def _series(self, market: str, slug: str) -> int:
+        key = (market, slug)
+        if key not in self._seriesIndex:
+            self._seriesIndex[key] = len(self.series)
+            self.series.append(key)
+        return self._seriesIndex[key]
+
+
+    def __len__(self) -> int:
+        return len(self._source)
+
+
+    @classmethod
+    def load(cls, path: str, watchlist: Watchlist, historyStore: store.HistoryStore = None) -> "AlertEngine":
+        """
+        Reads the rules and sinks of a JSON rules file (see the module docstring) and compiles them for `watchlist`,
+        warming the state up from `historyStore` if given.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        return cls(config.get("rules", []), watchlist, [make_sink(spec) for spec in config.get("sinks", [{"type": "stdout"}])], historyStore)
+
+
+    def warm(self, historyStore: store.HistoryStore) -> None:
+        """
+        Replays the last `WARMUP` windows of stored scans through the rules without alerting, so the averages are ready
+        and conditions that already hold don't alert again.
+        """
+        start = (datetime.datetime.utcnow() - datetime.timedelta(hours=WARMUP * self._window)).strftime(store.ISO_FORMAT)
+        self._replay(historyStore, [start] * len(self.series))
+
+
+    def check(self, historyStore: store.HistoryStore = None) -> list:
+        """
+        Evaluates every rule against each stored scan newer than the last one seen, in scan order, and sends the alerts to the sinks.
+        Series never seen before start from their newest scan.
+
+        Returns
+        -------
+        The new alerts.  See `evaluate`.
+        """
+        historyStore = historyStore or store.default_store()
+        starts = []
+        for s, (market, slug) in enumerate(self.series):
+            if self.seenTime[s] >= 0:
+                starts.append(np.datetime64(int(self.seenTime[s]), "m").item().strftime(store.ISO_FORMAT))
+            else:
+                row = historyStore.latest(market, slug)
+                starts.append(None if row is None else row["scannedAt"])
+        alerts = self._replay(historyStore, starts)
+        self._emit(alerts)
+        return alerts
+
+
+    @metrics.timed("alerts")
+    def _replay(self, historyStore: store.HistoryStore, starts: list) -> list:
+        """
+        Steps the state through every stored scan of each series from its UTC timestamp in `starts` (`None` for none) that is newer than the last one seen,
+        one scan time at a time.  The other series keep their newest earlier scan, e.g. as spread references.  Returns the alerts, unsent.
+        """
+        times, series, values = [], [], []
+        for s, (market, slug) in enumerate(self.series):
+            rows = historyStore.read(market, slug, starts[s]) if starts[s] is not None else []
+            times.append(np.array([np.datetime64(row["scannedAt"].rstrip("Z"), "m") for row in rows], dtype="datetime64[m]").astype(np.int64))
+            series.append(np.full(len(rows), s, dtype=np.int64))
+            values.append(np.array([[np.nan if row[field] is None else row[field] for field in FIELDS] for row in rows], dtype=np.float64).reshape(-1, len(FIELDS)))
+        times, series, values = np.concatenate(times), np.concatenate(series), np.concatenate(values)
+        new = times > self.seenTime[series]
+        times, series, values = times[new], series[new], values[new]
+        order = np.lexsort((series, times))
+        times, series, values = times[order], series[order], values[order]
+        alerts = []
+        for group in np.split(np.arange(len(times)), np.flatnonzero(np.diff(times)) + 1) if len(times) else []:
+            self.seenTime[series[group]] = times[group]
+            self.seenValues[series[group]] = values[group]
+            alerts += self._step(self.seenTime, self.seenValues)
+        return alerts
+
+
+    @metrics.timed("alerts")
+    def evaluate(self, times: np.ndarray, values: np.ndarray) -> list:
+        """
+        Evaluates every rule against the newest scan of each series, updates their state, and sends the alerts to the sinks.
+        Entries whose series has no scan newer than the last one they saw are left as they are.
+
+        Parameters
+        ----------
+        `times`: The UTC time of the newest scan of each series of `self.series`, in minutes since the epoch, or `-1` if there is none.
+        `values`: Array of shape `(len(self.series), 3)` with the `marketValue`, `minBuyout` and `quantity` of those scans.
+
+        Returns
+        -------
+        List of dictionaries of the form:
+        >>> {"rule": "Supply spike", "when": "quantity > 50% vs 24h", "item": "Saronite Ore", "market": "Skyfury-Alliance", "value": 73.5, "scannedAt": "2026-10-17T14:00Z"}
+        where `value` is what the condition was tested on, in the unit it was written in: the field, the % change, the spread (in % for
+        `spread > 10%`) or the number of standard deviations.
+        """
+        alerts = self._step(times, values)
+        self._emit(alerts)
+        return alerts
+
+
+    def _step(self, times: np.ndarray, values: np.ndarray) -> list:
+        """
+        As `evaluate`, without sending the alerts.
+        """
+        seen = times[self._source]
+        fresh = seen > self.lastTime
+        x = values[self._source, self._field]
+        spread = self._reference >= 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x = np.where(spread, x / values[np.maximum(self._reference, 0), 0] - 1, x)
+            # compare with the average of the earlier scans, then fold this one in
+            warm = self.count >= MIN_SCANS
+            metric = np.select(
+                [self._kind == LEVEL, self._kind == CHANGE, self._kind == SIGMA],
+                [x, (x / self.mean - 1) * 100, (x - self.mean) / np.sqrt(self.variance)]
+            )
+            metric = np.where((self._kind == LEVEL) | warm, metric, np.nan)
+            metric[~np.isfinite(metric)] = np.nan
+            holds = np.select(
+                [self._op == 0, self._op == 1, self._op == 2, self._op == 3],
+                [metric < self._value, metric <= self._value, metric > self._value, metric >= self._value]
+            ).astype(bool)
+        holds &= fresh & ~np.isnan(metric)
+        fired = np.flatnonzero(holds & ~self.firing)
+        self.firing = np.where(fresh, holds, self.firing)
+        update = fresh & ~np.isnan(x)
+        first = update & (self.count == 0)
+        delta = np.where(update, x - self.mean, 0)
+        self.mean = np.where(first, x, self.mean + self._alpha * delta)
+        self.variance = np.where(first, 0, np.where(update, (1 - self._alpha) * (self.variance + self._alpha * delta**2), self.variance))
+        self.count += update
+        self.lastTime = np.where(fresh, seen, self.lastTime)
+        alerts = [{"rule": self.names[i], "when": self.conditions[i], "item": self.items[i], "market": self.markets[i],
+                   "value": round(float(metric[i] * self._scale[i]), 4), "scannedAt": f"{np.datetime64(int(seen[i]), 'm')}Z"} for i in fired]
+        return alerts
+
+
+    def _emit(self, alerts: list) -> None:
+        metrics.count("alerts_fired", len(alerts))
+        if alerts:
+            for sink in self.sinks:
+                sink.emit(alerts)
+
+
+
+
+
+class StdoutSink:
+    """
+    Prints each alert on a line of its own.
+    """
+
+    def emit(self, alerts: list) -> None:
+        for a in alerts:
+            print(f"[{a['scannedAt']}] {a['rule']}: {a['item']} on {a['market']} ({a['when']}, value {a['value']:g})", file=sys.stdout, flush=True)
+
+
+class FileSink:
+    """
+    Appends each alert to a file as a line of JSON.
+    """
+
+    def __init__(self, path: str = "alerts.jsonl"):
+        self.path = path
+
+    def emit(self, alerts: list) -> None:
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(a) + "\n" for a in alerts)
+
+
+class WebhookSink:
+    """
+    Posts each batch of alerts to a URL as JSON, e.g. to the stand-in server's `/webhook`.  Failed posts are printed and dropped.
+    """
+
+    def __init__(self, url: str, timeout: float = 5):
+        self.url = url
+        self.timeout = timeout
+
+    def emit(self, alerts: list) -> None:
+        request = urllib.request.Request(self.url, json.dumps({"alerts": alerts}).encode(), {"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except OSError as e:
+            print(f"{self.url}: {e}")
+
+
+SINKS = {"stdout": StdoutSink, "file": FileSink, "webhook": WebhookSink}
+
+def make_sink(spec: dict):
+    """
+    Returns the sink described by a dictionary such as `{"type": "file", "path": "alerts.jsonl"}`.
+    """
+    options = dict(spec)
+    kind = options.pop("type", None)
+    if kind not in SINKS:
+        raise ValueError(f"\n>> Alert sink type must be one of {', '.join(SINKS)}, not {kind}.\n")
+    return SINKS[kind](**options)
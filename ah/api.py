@@ -4,14 +4,36 @@ api.py
 
 Functions that interface with the NexusHub API.
 """
+import os
+import json
+import datetime
 import requests
-from ah.misc import Datetime
+import itertools
+import ah.metrics as metrics
+import ah.catalog as catalog
+import ah.transport as transport
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ah.cache import TTLCache
+from ah.decode import decode_prices
+from ah.series import PriceSeries
+from ah.misc import Datetime, utc_to_local
 
+TIMEOUT = 30            # Seconds to wait on NexusHub before giving up on a request.
+MAX_WORKERS = 16        # Default number of concurrent requests for the batch functions.
+ROW_BYTES = 330         # Approximate memory taken by one decoded price row.
+HISTORY_START = datetime.datetime(2022, 9, 1)      # NexusHub has no scans of the current game version before this.
+BASE_URL = os.environ.get("NEXUSHUB_URL", "https://api.nexushub.co/wow-classic/v1").rstrip("/")
 
+TRANSPORT = transport.from_spec(os.environ.get("AH_TRANSPORT", "http"))
 
+CACHE = TTLCache(ttl=3600, maxBytes=256*2**20, staleTtl=600, sizeof=lambda data: data.nbytes if isinstance(data, PriceSeries) else len(data)*ROW_BYTES)
+metrics.register("api_cache", CACHE.stats)
 
 
-def server_history(itemname: str, realm = "skyfury", faction = "alliance", timerange: int = None, convert_timezone = True, condensed = False, rounded = True) -> list:
+
+
+
+def server_history(itemname: str, realm = "skyfury", faction = "alliance", timerange: int = None, convert_timezone = True, condensed = False, rounded = True, timezone = "US/Eastern") -> list:
     """
     Get historical price & quantity data for a particular item on a particular server.
 
@@ -22,6 +44,7 @@ def server_history(itemname: str, realm = "skyfury", faction = "alliance", timer
     `faction`:   The faction on the given realm.  Default is `alliance`.
     `timerange`:   The number of days worth of historical price data to retrieve.  If left as `None`, its entire history will be retrieved.
     `convert_timezone`:   Whether or not to convert the timestamps to the local timezone.  Default is `True`.
+    `timezone`:    The `pytz` name of the local timezone to convert to.  Default is `US/Eastern`.
     `condensed`:   Whether or not to return the data in a condensed format (i.e., only the `marketValue` and `quantity` fields).  Default is `False`.
     `rounded`:   Whether or not to round the `marketValue`, `minBuyout`, and `quantity` fields to the nearest copper/integer.  Default is `True`.
 
@@ -38,37 +61,10 @@ def server_history(itemname: str, realm = "skyfury", faction = "alliance", timer
     >>>     ...
     >>> ]
     """
-    if not timerange:
-        now = Datetime.now(rtype="datetime")
-        timerange = (now.month-9)*30 + now.day + 2
-    itemname = itemname.lower().replace(' ', '-')
-    url = f"https://api.nexushub.co/wow-classic/v1/items/{realm.lower()}-{faction.lower()}/{itemname}/prices?timerange={timerange}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()["data"]
-        if condensed:
-            condensed_data = []
-            for i in range(len(data)):
-                condensed_data.append({
-                    'marketValue': int(round(data[i]['marketValue'],0)) if rounded else data[i]['marketValue'],
-                    'quantity': int(round(data[i]['quantity'],0)) if rounded else data[i]['quantity']
-                })
-            return condensed_data
-        if convert_timezone:
-            import datetime, pytz
-            for i in range(len(data)):
-                dt = datetime.datetime.strptime(data[i]['scannedAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
-                dt = dt.replace(tzinfo=pytz.utc).astimezone(pytz.timezone('US/Eastern'))
-                data[i]['scannedAt'] = dt.strftime("%m-%d-%Y %H:%M")
-                data[i]['scannedAt'] = datetime.datetime.strptime(data[i]['scannedAt'],"%m-%d-%Y %H:%M")
-                # data[i]['scannedAt'] = datetime.datetime(data[i]['scannedAt'].year, data[i]['scannedAt'].month, data[i]['scannedAt'].day, data[i]['scannedAt'].hour, data[i]['scannedAt'].minute, 0)
-        if rounded:
-            for i in range(len(data)):
-                data[i]['marketValue'] = int(round(data[i]['marketValue'],0))
-                data[i]['minBuyout'] = int(round(data[i]['minBuyout'],0))
-                data[i]['quantity'] = int(round(data[i]['quantity'],0))
-        return data
-    else: return {}
+    if not timerange: timerange = default_timerange()
+    data = fetch(server_url(itemname, realm, faction, timerange))
+    if data is None: return {}
+    return format_history(data, convert_timezone, condensed, rounded, timezone)
 
 
 
@@ -79,7 +75,7 @@ def server_history(itemname: str, realm = "skyfury", faction = "alliance", timer
 
 
 
-def region_history(itemname: str, region = "us", timerange: int = None, convert_timezone = True, condensed = False, rounded = True) -> list:
+def region_history(itemname: str, region = "us", timerange: int = None, convert_timezone = True, condensed = False, rounded = True, timezone = "US/Eastern") -> list:
     """
     Get historical price & quantity data for a particular item for an entire region.
 
@@ -89,6 +85,7 @@ def region_history(itemname: str, region = "us", timerange: int = None, convert_
     `region`:   The region to get historical price data for.  Default is `us`.
     `timerange`:   The number of days worth of historical price data to retrieve.  If left as `None`, its entire history will be retrieved.
     `convert_timezone`:   Whether or not to convert the timestamps to the local timezone.  Default is `True`.
+    `timezone`:    The `pytz` name of the local timezone to convert to.  Default is `US/Eastern`.
     `condensed`:   Whether or not to return the data in a condensed format (i.e., only the `marketValue` and `quantity` fields).  Default is `True`.
     `rounded`:   Whether or not to round the `marketValue`, `minBuyout`, and `quantity` fields to the nearest copper/integer.  Default is `True`.
 
@@ -105,37 +102,304 @@ def region_history(itemname: str, region = "us", timerange: int = None, convert_
     >>>     ...
     >>> ]
     """
-    if not timerange:
-        now = Datetime.now(rtype="datetime")
-        timerange = (now.month-9)*30 + now.day + 2
-    itemname = itemname.lower().replace(' ', '-')
-    url = f"https://api.nexushub.co/wow-classic/v1/items/{region.lower()}/{itemname}/prices?timerange={timerange}&region=true"
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()["data"]
-        if condensed:
-            condensed_data = []
-            for i in range(len(data)):
-                condensed_data.append({
-                    'marketValue': int(round(data[i]['marketValue'],0)) if rounded else data[i]['marketValue'],
-                    'quantity': int(round(data[i]['quantity'],0)) if rounded else data[i]['quantity']
-                })
-            return condensed_data
-        if convert_timezone:
-            import datetime, pytz
-            for i in range(len(data)):
-                dt = datetime.datetime.strptime(data[i]['scannedAt'], "%Y-%m-%dT%H:%M:%S.%fZ")
-                dt = dt.replace(tzinfo=pytz.utc).astimezone(pytz.timezone('US/Eastern'))
-                data[i]['scannedAt'] = dt.strftime("%m-%d-%Y %H:%M")
-                data[i]['scannedAt'] = datetime.datetime.strptime(data[i]['scannedAt'],"%m-%d-%Y %H:%M")
-        if rounded:
-            for i in range(len(data)):
-                data[i]['marketValue'] = int(round(data[i]['marketValue'],0))
-                data[i]['minBuyout'] = int(round(data[i]['minBuyout'],0))
-                data[i]['quantity'] = int(round(data[i]['quantity'],0))
-        return data
-    else:
-        print(response.status_code)
-        return {}
+    if not timerange: timerange = default_timerange()
+    data = fetch(region_url(itemname, region, timerange))
+    if data is None: return {}
+    return format_history(data, convert_timezone, condensed, rounded, timezone)
+
+
+
+
+
+
+
+
+
+
+
+
+def default_timerange() -> int:
+    """
+    Returns the number of days needed to retrieve an item's entire history, i.e. the days since `HISTORY_START` plus a margin.
+    """
+    now = Datetime.now(rtype="datetime").replace(tzinfo=None)
+    return (now - HISTORY_START).days + 2
+
+
+
+
+
+def server_url(itemname: str, realm: str, faction: str, timerange: int) -> str:
+    """
+    Returns the NexusHub price history URL for an item on a particular server.
+    The item is resolved through the item catalog, so any spelling of a name gives the same URL; raises `ValueError` for unknown items.
+    """
+    itemname = catalog.slug(itemname)
+    return f"{BASE_URL}/items/{realm.lower()}-{faction.lower()}/{itemname}/prices?timerange={timerange}"
+
+
+
+
+
+def region_url(itemname: str, region: str, timerange: int) -> str:
+    """
+    Returns the NexusHub price history URL for an item across an entire region.
+    The item is resolved through the item catalog, so any spelling of a name gives the same URL; raises `ValueError` for unknown items.
+    """
+    itemname = catalog.slug(itemname)
+    return f"{BASE_URL}/items/{region.lower()}/{itemname}/prices?timerange={timerange}&region=true"
+
+
+
+
+
+def items_url() -> str:
+    """
+    Returns the NexusHub URL listing every item, used to build the item catalog.
+    """
+    return f"{BASE_URL}/items"
+
+
+
+
+
+def set_transport(newTransport: transport.Transport, baseUrl: str = None) -> None:
+    """
+    Replaces the transport used for every request in this module (e.g. with a `ReplayTransport`), and optionally the NexusHub base URL
+    (e.g. that of a local `ah.standin` server).  The response cache is cleared and the item catalog reloaded on next use.
+    """
+    global TRANSPORT, BASE_URL
+    TRANSPORT = newTransport
+    if baseUrl is not None:
+        BASE_URL = baseUrl.rstrip("/")
+    CACHE.clear()
+    catalog.reset()
+
+
+def reset_connections() -> None:
+    """
+    Gives this process its own connections, keeping the transport's kind and settings.
+
+    Call it first thing in worker processes forked from a process that has already made requests (e.g. to download the item catalog):
+    otherwise parent and workers share the pooled keep-alive sockets, and their responses get mixed up.
+    """
+    global TRANSPORT
+    TRANSPORT = TRANSPORT.clone()
+
+
+def reserve_connections(connections: int) -> None:
+    """
+    Grows the transport's connection pool to at least `connections`.  Call it with the worker count before requesting from a thread pool,
+    so workers beyond the pool size don't have their connections discarded after every request.
+    """
+    TRANSPORT.reserve(connections)
+
+
+
+
+
+def fetch(url: str, timeout: float = TIMEOUT, maxAge: float = None) -> list:
+    """
+    Requests the given NexusHub URL and returns the raw `data` list of the response, or `None` if the request failed or timed out.
+
+    Responses are kept in the shared `CACHE` for one scan interval, and concurrent requests for the same URL share one upstream request.
+    The returned list is shared with other callers and must not be modified.
+
+    Parameters
+    ----------
+    `url`:   The NexusHub URL.
+    `timeout`:   The number of seconds to wait on NexusHub.  Default is `TIMEOUT`.
+    `maxAge`:   If given, the oldest cached response (in seconds) that may be returned.  `0` always requests, but still joins a request already in flight.
+    """
+    return CACHE.get(url, lambda: _request(url, timeout), maxAge)
+
+
+def _request(url: str, timeout: float) -> list:
+    """
+    Requests the given NexusHub URL, bypassing the cache.
+    """
+    try:
+        with metrics.span("fetch"):
+            status, body = TRANSPORT.get(url, timeout)
+    except (requests.RequestException, OSError) as e:
+        print(f"{url}: {e}")
+        metrics.count("fetch_errors")
+        return None
+    metrics.count("bytes_downloaded", len(body))
+    if status != 200:
+        print(status)
+        metrics.count("fetch_errors")
+        return None
+    with metrics.span("decode"):
+        data = json.loads(body)["data"]
+    metrics.count("rows_downloaded", len(data))
+    return data
+
+
+def fetch_series(url: str, timeout: float = TIMEOUT, maxAge: float = None, convert_timezone = True, rounded = True, timezone = "US/Eastern") -> PriceSeries:
+    """
+    Like `fetch`, but decodes the response as it streams in, straight into the columns of a `PriceSeries`, without ever holding the
+    whole response text or a list of row dicts.  Use it for large histories, where peak memory would otherwise be several times the result.
+
+    Parameters
+    ----------
+    `convert_timezone`, `rounded`, `timezone`:   As in `PriceSeries.from_payload`.
+
+    Returns
+    -------
+    A `PriceSeries`, or `None` if the request failed or timed out.  It is shared with other callers and must not be modified.
+    """
+    return CACHE.get(f"series:{url}:{convert_timezone}:{rounded}:{timezone}", lambda: _request_series(url, timeout, convert_timezone, rounded, timezone), maxAge)
+
+
+def _request_series(url: str, timeout: float, convert_timezone: bool, rounded: bool, timezone: str) -> PriceSeries:
+    """
+    Streams and decodes the given NexusHub URL, bypassing the cache.
+    """
+    def counted(chunks):
+        for chunk in chunks:
+            metrics.count("bytes_downloaded", len(chunk))
+            yield chunk
+    try:
+        with metrics.span("fetch"):
+            status, chunks = TRANSPORT.stream(url, timeout)
+            if status != 200:
+                for _ in chunks: pass       # release the connection
+                print(status)
+                metrics.count("fetch_errors")
+                return None
+            with metrics.span("decode"):
+                times, *columns = decode_prices(counted(chunks), rounded)
+    except (requests.RequestException, OSError, ValueError) as e:
+        print(f"{url}: {e}")
+        metrics.count("fetch_errors")
+        return None
+    metrics.count("rows_downloaded", len(times))
+    if convert_timezone and len(times):
+        times = utc_to_local(times, timezone)
+    return PriceSeries(times, *columns)
+
+
+
+
+
+@metrics.timed("format")
+def format_history(data: list, convert_timezone = True, condensed = False, rounded = True, timezone = "US/Eastern") -> list:
+    """
+    Formats raw NexusHub price data into the structure returned by `server_history` and `region_history`.
+    The given rows are not modified.
+
+    Parameters
+    ----------
+    `data`:   The raw `data` list of a NexusHub price history response.
+    `convert_timezone`:   Whether or not to convert the timestamps to the local timezone.  Default is `True`.
+    `timezone`:   The `pytz` name of the local timezone to convert to.  Default is `US/Eastern`.
+    `condensed`:   Whether or not to return only the `marketValue` and `quantity` fields.  Default is `False`.
+    `rounded`:   Whether or not to round the `marketValue`, `minBuyout`, and `quantity` fields to the nearest copper/integer.  Default is `True`.
+    """
+    if condensed:
+        condensed_data = []
+        for i in range(len(data)):
+            condensed_data.append({
+                'marketValue': int(round(data[i]['marketValue'],0)) if rounded else data[i]['marketValue'],
+                'quantity': int(round(data[i]['quantity'],0)) if rounded else data[i]['quantity']
+            })
+        return condensed_data
+    data = [dict(row) for row in data]
+    if convert_timezone and data:
+        times = utc_to_local([row['scannedAt'] for row in data], timezone).tolist()
+        for i in range(len(data)):
+            data[i]['scannedAt'] = times[i]
+    if rounded:
+        for i in range(len(data)):
+            data[i]['marketValue'] = int(round(data[i]['marketValue'],0))
+            data[i]['minBuyout'] = int(round(data[i]['minBuyout'],0))
+            data[i]['quantity'] = int(round(data[i]['quantity'],0))
+    return data
+
+
 
 
+
+
+
+
+
+
+
+def server_history_many(items: list, realms: list = ["skyfury"], factions: list = ["alliance"], timerange: int = None, maxWorkers: int = MAX_WORKERS, timeout: float = TIMEOUT, **kwargs):
+    """
+    Concurrently gets historical price & quantity data for every combination of the given items, realms and factions.
+    Requests run on a bounded thread pool over the transport's pooled keep-alive connections, and results are yielded as soon as each one finishes.
+
+    Parameters
+    ----------
+    `items`:   The standard names of the items to get data for.
+    `realms`:   The servers to get historical price data from.  Default is `["skyfury"]`.
+    `factions`:   The factions on each realm.  Default is `["alliance"]`.
+    `timerange`:   The number of days worth of historical price data to retrieve.  If left as `None`, the entire history will be retrieved.
+    `maxWorkers`:   The maximum number of requests in flight at once.  Default is `MAX_WORKERS`.
+    `timeout`:   The number of seconds to wait on each request.  Default is `TIMEOUT`.
+    `**kwargs`:   Passed on to `format_history` (`convert_timezone`, `condensed`, `rounded`, `timezone`).
+
+    Yields
+    ------
+    Tuples of the form `((itemname, realm, faction), data)`, in order of completion, where `data` is as returned by `server_history` (`{}` for items not in the catalog).
+    """
+    if not timerange: timerange = default_timerange()
+    keys = list(itertools.product(items, realms, factions))
+    yield from _fetch_many(keys, lambda key: server_url(*key, timerange), maxWorkers, timeout, kwargs)
+
+
+
+
+
+def region_history_many(items: list, regions: list = ["us"], timerange: int = None, maxWorkers: int = MAX_WORKERS, timeout: float = TIMEOUT, **kwargs):
+    """
+    Concurrently gets historical price & quantity data for every combination of the given items and regions.
+    Requests run on a bounded thread pool over the transport's pooled keep-alive connections, and results are yielded as soon as each one finishes.
+
+    Parameters
+    ----------
+    `items`:   The standard names of the items to get data for.
+    `regions`:   The regions to get historical price data for.  Default is `["us"]`.
+    `timerange`:   The number of days worth of historical price data to retrieve.  If left as `None`, the entire history will be retrieved.
+    `maxWorkers`:   The maximum number of requests in flight at once.  Default is `MAX_WORKERS`.
+    `timeout`:   The number of seconds to wait on each request.  Default is `TIMEOUT`.
+    `**kwargs`:   Passed on to `format_history` (`convert_timezone`, `condensed`, `rounded`, `timezone`).
+
+    Yields
+    ------
+    Tuples of the form `((itemname, region), data)`, in order of completion, where `data` is as returned by `region_history` (`{}` for items not in the catalog).
+    """
+    if not timerange: timerange = default_timerange()
+    keys = list(itertools.product(items, regions))
+    yield from _fetch_many(keys, lambda key: region_url(*key, timerange), maxWorkers, timeout, kwargs)
+
+
+
+
+
+def _fetch_many(keys: list, url: callable, maxWorkers: int, timeout: float, formatting: dict):
+    """
+    Fetches the URL of every key (given by `url(key)`) on a thread pool and yields `(key, data)` as each request completes.
+    Failed requests, and keys whose item isn't in the catalog, yield `{}`, matching `server_history` and `region_history`.
+    If the consumer stops early (or drops the generator), the requests not yet started are cancelled instead of waited for.
+    """
+    reserve_connections(maxWorkers)
+    pool = ThreadPoolExecutor(max_workers=maxWorkers)
+    try:
+        futures, unknown = {}, []
+        for key in keys:
+            try:
+                futures[pool.submit(fetch, url(key), timeout)] = key
+            except ValueError as e:
+                print(f"{key}: {str(e).strip()}")
+                unknown.append(key)
+        for key in unknown:
+            yield key, {}
+        for future in as_completed(futures):
+            data = future.result()
+            yield futures[future], ({} if data is None else format_history(data, **formatting))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
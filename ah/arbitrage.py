@@ -0,0 +1,238 @@
+"""
+arbitrage.py
+============
+
+Cross-market spread scanner: compares every tracked server's price of every watchlist item with a reference price
+(the region's, or else the median of all tracked servers), and ranks the biggest and most persistent gaps.
+
+All histories are bucketed into one `items x markets x time` array, and spreads, z-scores and persistence are computed
+for every item and market at once, so thousands of items on dozens of markets take seconds.
+
+Usage:
+>>> python -m ah.arbitrage watchlist.json --days 7 --top 20
+"""
+import argparse
+import warnings
+import numpy as np
+import ah.api as api
+from concurrent.futures import ThreadPoolExecutor
+from ah.data import get_server_history, get_region_history
+from ah.series import PriceSeries
+from ah.watchlist import Watchlist
+
+
+
+
+
+def cube(histories: dict, items: list, markets: list, numHoursPerBucket: int = 2, start = None, end = None) -> tuple:
+    """
+    Buckets many price histories onto one shared time grid, in one vectorized pass.
+
+    Parameters
+    ----------
+    `histories`: Dictionary mapping `(item, market)` to a `PriceSeries`.  Missing pairs are left empty.
+    `items`, `markets`: The order of the first two axes.
+    `numHoursPerBucket`: The width of each time bucket, in hours.  Default is `2`.
+    `start`, `end`: Optional bounds of the grid, as anything `numpy` can convert to `datetime64[m]`.  Default is the span of all histories.
+
+    Returns
+    -------
+    `times`: The start of each bucket, as a `datetime64[m]` array of length `T`.
+    `prices`: Array of shape `(len(items), len(markets), T)` holding the mean price in each bucket, `nan` where there were no scans.
+    """
+    width = numHoursPerBucket * 60
+    itemIndex = {item: i for i, item in enumerate(items)}
+    marketIndex = {market: m for m, market in enumerate(markets)}
+    pairs = [(key, PriceSeries.coerce(series)) for key, series in histories.items()
+             if key[0] in itemIndex and key[1] in marketIndex and len(series)]
+    if not pairs:
+        return np.empty(0, dtype="datetime64[m]"), np.empty((len(items), len(markets), 0))
+    lengths = np.array([len(series) for _, series in pairs])
+    cell = np.repeat([itemIndex[i] * len(markets) + marketIndex[m] for (i, m), _ in pairs], lengths)
+    minutes = np.concatenate([series.times for _, series in pairs]).astype(np.int64)
+    prices = np.concatenate([series.prices for _, series in pairs])
+    first = minutes.min() // width if start is None else np.datetime64(start, "m").astype(np.int64) // width
+    last = minutes.max() // width if end is None else (np.datetime64(end, "m").astype(np.int64) - 1) // width
+    numBuckets = int(last - first + 1)
+    bucket = minutes // width - first
+    keep = (bucket >= 0) & (bucket < numBuckets) & ~np.isnan(prices)
+    flat = cell[keep] * numBuckets + bucket[keep]
+    size = len(items) * len(markets) * numBuckets
+    sums = np.bincount(flat, weights=prices[keep], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(invalid="ignore"):
+        means = (sums / counts).reshape(len(items), len(markets), numBuckets)
+    times = ((first + np.arange(numBuckets)) * width).astype("datetime64[m]")
+    return times, means
+
+
+
+
+
+def scan(prices: np.ndarray, reference: np.ndarray = None, window: int = 84, persistenceWindow: int = 12, minSpread: float = 0.05, maxGap: int = 6) -> dict:
+    """
+    Computes the spread of every item on every market against a reference price, for the whole cube at once.
+
+    Parameters
+    ----------
+    `prices`: Array of shape `(items, markets, T)`, as returned by `cube`.
+    `reference`: Optional array of shape `(items, T)` (e.g. the region prices).  Default is the median price across markets.
+    `window`: The number of trailing buckets the z-score is computed over.  Default is `84` (one week of 2 hour buckets).
+    `persistenceWindow`: The number of trailing buckets persistence is measured over.  Default is `12` (one day of 2 hour buckets).
+    `minSpread`: The relative spread a bucket needs to count towards persistence.  Default is `0.05` (5%).
+    `maxGap`: The number of buckets a price is carried forward over missing scans.  Default is `6`.
+
+    Returns
+    -------
+    Dictionary of arrays of shape `(items, markets)`:
+    >>> {
+    >>>     "price": latest price,
+    >>>     "reference": latest reference price,
+    >>>     "spread": latest relative spread, (price - reference) / reference,
+    >>>     "zscore": latest spread in standard deviations from its mean over `window`,
+    >>>     "persistence": fraction of the last `persistenceWindow` buckets with a spread of at least `minSpread` in the same direction
+    >>> }
+    """
+    prices = _ffill(prices, maxGap)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)         # all-nan slices
+        if reference is None:
+            reference = np.nanmedian(prices, axis=1)
+        reference = _ffill(reference, maxGap)
+        spreads = prices / reference[:, None, :] - 1
+        latest = spreads[..., -1]
+        recent = spreads[..., -window:]
+        zscore = (latest - np.nanmean(recent, axis=-1)) / np.nanstd(recent, axis=-1)
+        tail = spreads[..., -persistenceWindow:]
+        direction = np.sign(latest)[..., None]
+        same = (np.sign(tail) == direction) & (np.abs(tail) >= minSpread)
+        persistence = same.sum(axis=-1) / np.maximum((~np.isnan(tail)).sum(axis=-1), 1)
+    zscore[~np.isfinite(zscore)] = np.nan
+    return {"price": prices[..., -1], "reference": np.broadcast_to(reference[:, -1:], latest.shape),
+            "spread": latest, "zscore": zscore, "persistence": persistence}
+
+
+def _ffill(values: np.ndarray, limit: int) -> np.ndarray:
+    """
+    Carries the last valid value forward along the last axis over up to `limit` missing values.
+    """
+    if not values.shape[-1]:
+        return values
+    index = np.arange(values.shape[-1])
+    valid = ~np.isnan(values)
+    lastValid = np.maximum.accumulate(np.where(valid, index, -1), axis=-1)
+    filled = np.take_along_axis(values, np.maximum(lastValid, 0), axis=-1)
+    return np.where((lastValid >= 0) & (index - lastValid <= limit), filled, np.nan)
+
+
+
+
+
+def top(stats: dict, items: list, markets: list, n: int = 20, by: str = "spread", minPersistence: float = 0.5) -> list:
+    """
+    Returns the `n` largest opportunities found by `scan`, largest first.
+
+    Parameters
+    ----------
+    `stats`: The output of `scan`.
+    `items`, `markets`: The labels of the first two axes.
+    `n`: The number of opportunities to return.  Default is `20`.
+    `by`: What to rank by: the size of the `spread`, of the `zscore`, or the `persistence`.  Default is `spread`.
+    `minPersistence`: Opportunities less persistent than this are ignored.  Default is `0.5`.
+
+    Returns
+    -------
+    List of dictionaries of the form:
+    >>> {"item": "Saronite Ore", "market": "Skyfury-Alliance", "direction": "buy", "price": 1234.0, "reference": 1400.0, "spread": -0.118, "zscore": -2.4, "persistence": 0.83}
+    """
+    if by not in ("spread", "zscore", "persistence"):
+        raise ValueError(f"\n>> `by` must be one of spread, zscore or persistence, not {by}.\n")
+    score = np.abs(stats[by]).ravel().copy()
+    score[~(stats["persistence"].ravel() >= minPersistence) | np.isnan(stats["spread"].ravel())] = -np.inf
+    n = min(n, int(np.isfinite(score).sum()))
+    if not n:
+        return []
+    best = np.argpartition(-score, n-1)[:n]
+    best = best[np.argsort(-score[best])]
+    results = []
+    for i, m in zip(*np.unravel_index(best, stats["spread"].shape)):
+        row = {field: float(stats[field][i, m]) for field in ("price", "reference", "spread", "zscore", "persistence")}
+        results.append({"item": items[i], "market": markets[m], "direction": "buy" if row["spread"] < 0 else "sell", **row})
+    return results
+
+
+
+
+
+def load(watchlist: Watchlist, numDays: int = 7, maxWorkers: int = 8) -> tuple:
+    """
+    Loads the raw histories of every item of `watchlist` on every tracked server, and in its first region.
+
+    Returns
+    -------
+    `histories`: Dictionary mapping `(item, "Realm-Faction")` to a `PriceSeries`.
+    `regionHistories`: Dictionary mapping `(item, region)` to a `PriceSeries`.
+    """
+    region = watchlist.regions[0] if watchlist.regions else "US"
+    def server(pair):
+        item, (realm, faction) = pair
+        return (item, f"{realm}-{faction}"), get_server_history(item, realm, faction, numDays, avg=False)
+    def regional(item):
+        return (item, region), get_region_history(item, region, numDays, avg=False)
+    api.reserve_connections(maxWorkers)
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        histories = dict(pool.map(server, [(item, s) for item in watchlist.items for s in watchlist.servers()]))
+        regionHistories = dict(pool.map(regional, watchlist.items))
+    return histories, regionHistories
+
+
+
+
+
+def opportunities(watchlist: Watchlist, numDays: int = 7, n: int = 20, by: str = "spread", numHoursPerBucket: int = 2, useRegion: bool = True,
+                  minSpread: float = 0.05, minPersistence: float = 0.5, maxWorkers: int = 8) -> list:
+    """
+    Loads the watchlist's histories and returns its top `n` cross-market opportunities.  See `scan` and `top`.
+
+    Parameters
+    ----------
+    `useRegion`: Whether to measure spreads against the region price (`True`) or the median of the tracked servers (`False`).  Default is `True`.
+    """
+    histories, regionHistories = load(watchlist, numDays, maxWorkers)
+    items = watchlist.items
+    markets = [f"{realm}-{faction}" for realm, faction in watchlist.servers()]
+    times, prices = cube(histories, items, markets, numHoursPerBucket)
+    reference = None
+    if useRegion and len(times):
+        region = watchlist.regions[0] if watchlist.regions else "US"
+        _, reference = cube(regionHistories, items, [region], numHoursPerBucket, times[0], times[-1] + numHoursPerBucket*60)
+        reference = reference[:, 0, :]
+    bucketsPerDay = 24 // numHoursPerBucket or 1
+    stats = scan(prices, reference, window=bucketsPerDay*min(numDays, 7), persistenceWindow=bucketsPerDay, minSpread=minSpread)
+    return top(stats, items, markets, n, by, minPersistence)
+
+
+
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rank the biggest cross-market price spreads of a watchlist.")
+    parser.add_argument("watchlist", help="Path of the watchlist JSON file.")
+    parser.add_argument("--days", type=int, default=7, help="Days of history to compare.")
+    parser.add_argument("--top", type=int, default=20, help="Number of opportunities to show.")
+    parser.add_argument("--by", default="spread", choices=["spread", "zscore", "persistence"], help="What to rank by.")
+    parser.add_argument("--min-spread", type=float, default=0.05, help="Relative spread counted as persistent.")
+    parser.add_argument("--min-persistence", type=float, default=0.5, help="Ignore spreads less persistent than this.")
+    parser.add_argument("--median", action="store_true", help="Compare against the median of the tracked servers instead of the region.")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum concurrent requests.")
+    args = parser.parse_args()
+    results = opportunities(Watchlist.load(args.watchlist), args.days, args.top, args.by, useRegion=not args.median,
+                            minSpread=args.min_spread, minPersistence=args.min_persistence, maxWorkers=args.workers)
+    for r in results:
+        print(f"{r['direction']:>4} {r['item']:<30} {r['market']:<24} {r['price']:>12.0f} vs {r['reference']:>12.0f}   "
+              f"{r['spread']:+7.1%}   z {r['zscore']:+5.1f}   persistence {r['persistence']:.0%}")
+
+
+
+if __name__ == "__main__":
+    main()
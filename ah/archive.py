@@ -0,0 +1,197 @@
+"""
+archive.py
+==========
+
+Compact, append-only binary archive of price histories, one file per market and item, read through memory maps.
+
+Each file is a 16-byte header followed by fixed-width 20-byte records:
+>>> time         int64   UTC scan time, in minutes since 1970-01-01 (`datetime64[m]`)
+>>> marketValue  int32   copper
+>>> minBuyout    int32   copper
+>>> quantity     int32
+
+Missing values are stored as `-1`.  New scans are only ever appended, in time order, so opening a history of any length is a
+single `mmap` call and slicing it by time is a binary search.  Readers in different processes share the file's pages through the OS cache.
+
+Examples
+--------
+>>> archive = Archive("archive")
+>>> archive.append("skyfury-alliance", "saronite-ore", api.fetch(url))
+>>> archive.series("skyfury-alliance", "saronite-ore", start="2023-01-01")
+"""
+import os
+import fcntl
+import numpy as np
+from ah.series import PriceSeries
+
+MAGIC = b"AHPS"
+VERSION = 1
+HEADER = np.dtype([("magic", "S4"), ("version", "<u2"), ("recordSize", "<u2"), ("reserved", "<u8")])
+RECORD = np.dtype([("time", "<i8"), ("marketValue", "<i4"), ("minBuyout", "<i4"), ("quantity", "<i4")])
+MISSING = -1
+VALUES = ("marketValue", "minBuyout", "quantity")
+
+
+
+
+
+class Archive:
+    """
+    Folder of append-only binary price histories, laid out as `<directory>/<market>/<item>.ahps`.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Parameters
+        ----------
+        `directory`: The folder holding the archive.  Created on the first append.
+        """
+        self.directory = directory
+
+
+    def path(self, market: str, item: str) -> str:
+        """
+        Returns the file holding the history of `item` on `market`.
+        """
+        return os.path.join(self.directory, market, f"{item}.ahps")
+
+
+    def records(self, market: str, item: str, start = None, end = None) -> np.ndarray:
+        """
+        Memory-maps the history of `item` on `market` and returns its records scanned in `[start, end)`, without copying.
+
+        Parameters
+        ----------
+        `start`, `end`: Optional UTC bounds, as anything `numpy` can convert to `datetime64[m]`.
+
+        Returns
+        -------
+        Read-only structured array of `RECORD`s, oldest first.  Empty if the item was never archived.
+        """
+        path = self.path(market, item)
+        if not os.path.exists(path):
+            return np.empty(0, dtype=RECORD)
+        size = os.path.getsize(path)
+        count = (size - HEADER.itemsize) // RECORD.itemsize      # ignores a record still being written
+        if count <= 0:
+            return np.empty(0, dtype=RECORD)
+        header = np.fromfile(path, dtype=HEADER, count=1)[0]
+        if header["magic"] != MAGIC or header["recordSize"] != RECORD.itemsize:
+            raise ValueError(f"\n>> '{path}' is not a version {VERSION} price archive.\n")
+        records = np.memmap(path, dtype=RECORD, mode="r", offset=HEADER.itemsize, shape=(count,))
+        times = records["time"]
+        lo = 0 if start is None else np.searchsorted(times, _minutes(start))
+        hi = count if end is None else np.searchsorted(times, _minutes(end))
+        return records[lo:hi]
+
+
+    def series(self, market: str, item: str, start = None, end = None) -> PriceSeries:
+        """
+        Returns the history of `item` on `market` scanned in `[start, end)` as a `PriceSeries` with UTC times.
+
+        `times` is a view of the memory-mapped file; the value columns are converted to `float64` (with `nan` for missing values),
+        which copies only the requested range.
+        """
+        records = self.records(market, item, start, end)
+        times = records["time"].view("datetime64[m]")
+        columns = [np.where(records[field] == MISSING, np.nan, records[field]) for field in VALUES]
+        return PriceSeries(times, *columns)
+
+
+    def last_time(self, market: str, item: str):
+        """
+        Returns the UTC time of the newest archived scan of `item` on `market` as a `datetime64[m]`, or `None` if there is none.
+        """
+        records = self.records(market, item)
+        return records["time"][-1].astype("datetime64[m]") if len(records) else None
+
+
+    def append(self, market: str, item: str, data) -> int:
+        """
+        Appends the scans of `item` on `market` that are newer than the newest archived one.
+
+        Parameters
+        ----------
+        `data`: Raw NexusHub rows (UTC `scannedAt` strings), or a `PriceSeries` with UTC times.
+
+        Returns
+        -------
+        The number of scans appended.
+        """
+        new = to_records(data)
+        path = self.path(market, item)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)       # one writer at a time; readers never block
+            try:
+                size = f.seek(0, os.SEEK_END)
+                if size < HEADER.itemsize:
+                    f.truncate(0)
+                    header = np.zeros(1, dtype=HEADER)
+                    header[0] = (MAGIC, VERSION, RECORD.itemsize, 0)
+                    f.write(header.tobytes())
+                    size = HEADER.itemsize
+                else:
+                    torn = (size - HEADER.itemsize) % RECORD.itemsize
+                    if torn:                    # left behind by a crashed writer
+                        size -= torn
+                        f.truncate(size)
+                if size > HEADER.itemsize:
+                    last = np.fromfile(path, dtype=RECORD, count=1, offset=size - RECORD.itemsize)[0]["time"]
+                    new = new[new["time"] > last]
+                f.write(new.tobytes())
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return len(new)
+
+
+    def sync(self, historyStore, market: str, item: str) -> int:
+        """
+        Appends the scans of `item` on `market` that `historyStore` (an `ah.store.HistoryStore`) holds but the archive does not yet.
+
+        Returns
+        -------
+        The number of scans appended.
+        """
+        last = self.last_time(market, item)
+        start = "" if last is None else f"{(last + 1).astype('datetime64[ms]')}Z"
+        return self.append(market, item, historyStore.read(market, item, start))
+
+
+
+
+
+def to_records(data) -> np.ndarray:
+    """
+    Converts raw NexusHub rows or a UTC `PriceSeries` to `RECORD`s, sorted by time and with duplicate times dropped.
+    """
+    if isinstance(data, PriceSeries):
+        times = data.times
+        columns = [data.prices, data.minBuyouts, data.quantities]
+    else:
+        n = len(data)
+        times = np.char.rstrip(np.asarray([row["scannedAt"] for row in data], dtype=str), "Z").astype("datetime64[m]") if n else np.empty(0, dtype="datetime64[m]")
+        columns = [np.fromiter((np.nan if row.get(field) is None else row[field] for row in data), dtype=np.float64, count=n) for field in VALUES]
+    records = np.empty(len(times), dtype=RECORD)
+    records["time"] = np.asarray(times, dtype="datetime64[m]").view(np.int64)
+    limit = np.iinfo(np.int32).max
+    for field, column in zip(VALUES, columns):
+        column = np.asarray(column, dtype=np.float64)
+        records[field] = np.where(np.isnan(column), MISSING, np.clip(np.round(np.nan_to_num(column)), 0, limit))
+    records = records[np.argsort(records["time"], kind="stable")]
+    if len(records) > 1:
+        records = records[np.r_[True, records["time"][1:] != records["time"][:-1]]]
+    return records
+
+
+
+
+
+def _minutes(value) -> np.int64:
+    """
+    Converts a time (string, `datetime` or `datetime64`) to minutes since the epoch.
+    """
+    if isinstance(value, str):
+        value = value.rstrip("Z")
+    return np.datetime64(value, "m").astype(np.int64)
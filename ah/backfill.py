@@ -0,0 +1,202 @@
+"""
+backfill.py
+===========
+
+Resumable bulk download of the entire history of every `(item, market)` pair of a watchlist into the local history store.
+
+The pairs are split into chunks that worker processes fetch in parallel, within a shared upstream rate limit.
+Only the main process writes to the store, one transaction per pair, and it records every finished pair in a JSON
+checkpoint, so an interrupted backfill picks up where it stopped instead of starting over.
+
+Usage:
+>>> python -m ah.backfill watchlist.json --workers 4 --rate 5 --checkpoint backfill.json
+"""
+import os
+import json
+import time
+import random
+import argparse
+import datetime
+import ah.api as api
+import ah.store as store
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from ah.misc import RateLimiter
+from ah.watchlist import Watchlist
+
+_limiter = None             # per worker process, see `_init_worker`
+
+
+
+
+
+def fetch_chunk(chunk: list, timerange: int, threads: int = 2, retries: int = 4, backoff: float = 2) -> list:
+    """
+    Fetches the raw history of every `(item, market)` pair of `chunk`.  Runs in a worker process.
+
+    Parameters
+    ----------
+    `chunk`: List of `(item, market)` pairs, where `market` is a `(realm, faction)` tuple or a region name.
+    `timerange`: The number of days of history to request.
+    `threads`: The number of requests this process keeps in flight.  Default is `2`.
+    `retries`: Number of times a failed request is retried.  Default is `4`.
+    `backoff`: Seconds to wait before the first retry; doubled for each following one.  Default is `2`.
+
+    Returns
+    -------
+    List of `(item, market, rows)` tuples, where `rows` is the raw NexusHub data, or `None` if every attempt failed.
+    """
+    def fetch(pair):
+        item, market = pair
+        _, _, url = _source(item, market)
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2**(attempt-1) * random.uniform(0.5, 1.5))
+            if _limiter is not None:
+                _limiter.wait()
+            rows = api.fetch(url(timerange), maxAge=0)
+            if rows is not None:
+                return item, market, rows
+        return item, market, None
+
+    api.reserve_connections(threads)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(fetch, chunk))
+
+
+def _init_worker(rate: float) -> None:
+    """
+    Gives each worker process its own connections and its share of the upstream rate limit, and turns off its response cache
+    (nothing is requested twice).
+    """
+    global _limiter
+    api.reset_connections()
+    _limiter = RateLimiter(rate, burst=1)
+    api.CACHE.maxBytes = 0
+
+
+def _source(item: str, market) -> tuple:
+    """
+    Returns the store's `(market, slug, url)` for a watchlist pair.
+    """
+    return store.server_source(item, *market) if isinstance(market, (tuple, list)) else store.region_source(item, market)
+
+
+def pair_key(item: str, market) -> str:
+    """
+    Returns the checkpoint key of an `(item, market)` pair, e.g. `skyfury-alliance/saronite-ore`.
+    """
+    market, slug, _ = _source(item, market)
+    return f"{market}/{slug}"
+
+
+
+
+
+def load_checkpoint(path: str) -> dict:
+    """
+    Reads a backfill checkpoint, or returns an empty one if `path` doesn't exist.
+
+    Returns
+    -------
+    Dictionary of the form:
+    >>> {"done": ["skyfury-alliance/saronite-ore", ...], "failed": ["us/frost-lotus", ...]}
+    """
+    if not path or not os.path.exists(path):
+        return {"done": [], "failed": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, checkpoint: dict) -> None:
+    """
+    Atomically writes a backfill checkpoint, so a crash mid-write never loses earlier progress.
+    """
+    if not path:
+        return
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(path + ".tmp", path)
+
+
+
+
+
+def backfill(watchlist: Watchlist, historyStore: store.HistoryStore = None, checkpoint: str = None, timerange: int = None, workers: int = 4,
+             threads: int = 2, chunkSize: int = 20, rate: float = 5, retries: int = 4, backoff: float = 2, verbose: bool = True) -> dict:
+    """
+    Downloads the full history of every pair of `watchlist` that the checkpoint doesn't list as done, and stores it.
+    Pairs that failed in an earlier run are tried again.
+
+    Parameters
+    ----------
+    `watchlist`: The items and markets to backfill.
+    `historyStore`: The store to write to.  Default is the shared store read by `ah.data`.
+    `checkpoint`: Path of the JSON checkpoint to resume from and update.  Default is `None`, i.e. no checkpointing.
+    `timerange`: The number of days of history to request.  Default is everything since `ah.api.HISTORY_START`.
+    `workers`: The number of fetching processes.  Default is `4`.
+    `threads`: The number of requests each process keeps in flight.  Default is `2`.
+    `chunkSize`: The number of pairs handed to a process at once.  Default is `20`.
+    `rate`: The maximum average number of requests per second, across all processes.  Default is `5`.
+    `retries`, `backoff`: Retry policy for failed requests.  See `fetch_chunk`.
+    `verbose`: Whether or not to print progress after each chunk.  Default is `True`.
+
+    Returns
+    -------
+    Dictionary of the form:
+    >>> {"pairs": 6000, "skipped": 2000, "done": 3990, "failed": 10, "scans": 41000000, "seconds": 9012.5}
+    """
+    start = time.monotonic()
+    historyStore = historyStore or store.default_store()
+    timerange = timerange or api.default_timerange()
+    state = load_checkpoint(checkpoint)
+    done = set(state["done"])
+    failed = set(state["failed"])
+    pairs = watchlist.pairs()
+    todo = [(item, market) for item, market in pairs if pair_key(item, market) not in done]
+    chunks = [todo[i:i+chunkSize] for i in range(0, len(todo), chunkSize)]
+    summary = {"pairs": len(pairs), "skipped": len(pairs) - len(todo), "done": 0, "failed": 0, "scans": 0, "seconds": 0}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rate / workers,)) as pool:
+        futures = [pool.submit(fetch_chunk, chunk, timerange, threads, retries, backoff) for chunk in chunks]
+        for i, future in enumerate(as_completed(futures), 1):
+            now = datetime.datetime.utcnow()
+            since = (now - datetime.timedelta(days=timerange)).strftime(store.ISO_FORMAT)
+            for item, market, rows in future.result():
+                key = pair_key(item, market)
+                if rows is None:
+                    failed.add(key)
+                    summary["failed"] += 1
+                    continue
+                marketKey, slug, _ = _source(item, market)
+                summary["scans"] += historyStore.write(marketKey, slug, rows, since=since, checkedAt=now.strftime(store.ISO_FORMAT))
+                done.add(key)
+                failed.discard(key)
+                summary["done"] += 1
+            save_checkpoint(checkpoint, {"done": sorted(done), "failed": sorted(failed)})
+            if verbose:
+                print(f"[{i}/{len(chunks)}] {summary['done']} pairs done, {summary['failed']} failed, {summary['scans']} scans stored")
+    summary["seconds"] = round(time.monotonic() - start, 1)
+    return summary
+
+
+
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Download the full history of a watchlist into the local history store.")
+    parser.add_argument("watchlist", help="Path of the watchlist JSON file.")
+    parser.add_argument("--db", default=store.DEFAULT_PATH, help="Path of the history store.")
+    parser.add_argument("--checkpoint", default="backfill.json", help="Path of the checkpoint to resume from.")
+    parser.add_argument("--days", type=int, default=None, help="Days of history to fetch.  Default is the entire history.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of fetching processes.")
+    parser.add_argument("--threads", type=int, default=2, help="Concurrent requests per process.")
+    parser.add_argument("--chunk-size", type=int, default=20, help="Pairs per chunk.")
+    parser.add_argument("--rate", type=float, default=5, help="Maximum requests per second, in total.")
+    args = parser.parse_args()
+    summary = backfill(Watchlist.load(args.watchlist), store.HistoryStore(args.db), args.checkpoint, args.days, args.workers,
+                       args.threads, args.chunk_size, args.rate)
+    print(f"Backfilled {summary['done']} pairs ({summary['skipped']} already done, {summary['failed']} failed): {summary['scans']} scans in {summary['seconds']} s")
+
+
+
+if __name__ == "__main__":
+    main()
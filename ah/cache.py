@@ -0,0 +1,140 @@
+"""
+cache.py
+========
+
+Thread-safe in-process cache shared by every session of the app.
+"""
+import sys
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+
+
+
+class TTLCache:
+    """
+    Bounded cache with time-to-live expiry, LRU eviction by size, stale-while-revalidate, and single-flight loading.
+
+    Concurrent misses for the same key wait on one in-flight load instead of each loading the value themselves.
+    Entries older than `ttl` but younger than `ttl + staleTtl` are still served while one background refresh runs.
+
+    Examples
+    --------
+    >>> cache = TTLCache(ttl=3600, maxBytes=64*2**20)
+    >>> data = cache.get(url, lambda: download(url))
+    >>> cache.stats()
+        {'hits': 12, 'misses': 3, 'stale': 1, 'coalesced': 4, 'evictions': 0, 'entries': 3, 'bytes': 181234}
+    """
+
+    def __init__(self, ttl: float = 3600, maxBytes: int = 256*2**20, staleTtl: float = 600, sizeof: callable = sys.getsizeof):
+        """
+        Parameters
+        ----------
+        `ttl`: Seconds an entry is served as fresh.  Default is `3600`, one NexusHub scan interval.
+        `maxBytes`: The total size the cache may grow to before least recently used entries are evicted.  Default is 256 MiB.
+        `staleTtl`: Seconds past `ttl` during which an entry is still served while it is refreshed in the background.  Default is `600`.
+        `sizeof`: Function returning the size in bytes of a cached value.  Default is `sys.getsizeof`.
+        """
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.staleTtl = staleTtl
+        self.sizeof = sizeof
+        self._entries = OrderedDict()       # key -> (value, size, storedAt), least recently used first
+        self._inflight = {}                 # key -> Future of the load in progress
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counts = {"hits": 0, "misses": 0, "stale": 0, "coalesced": 0, "evictions": 0}
+
+
+    def get(self, key, loader: callable, maxAge: float = None):
+        """
+        Returns the cached value for `key`, calling `loader()` to load it if it is missing or expired.
+        A `loader` result of `None` is returned but not cached.
+
+        Parameters
+        ----------
+        `key`: Any hashable key.
+        `loader`: Function taking no arguments that returns the value.
+        `maxAge`: If given, overrides `ttl` for this call and disables stale serving.  `0` always loads, but still shares a load already in flight.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = time.monotonic() - entry[2]
+                if age < (self.ttl if maxAge is None else maxAge):
+                    self._entries.move_to_end(key)
+                    self._counts["hits"] += 1
+                    return entry[0]
+                if maxAge is None and age < self.ttl + self.staleTtl:
+                    self._entries.move_to_end(key)
+                    self._counts["stale"] += 1
+                    if key not in self._inflight:
+                        future = self._inflight[key] = Future()
+                        threading.Thread(target=self._load, args=(key, loader, future), daemon=True).start()
+                    return entry[0]
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self._counts["misses"] += 1
+            else:
+                self._counts["coalesced"] += 1
+        if leader:
+            self._load(key, loader, future)
+        return future.result()
+
+
+    def _load(self, key, loader: callable, future: Future) -> None:
+        """
+        Runs `loader`, caches its result and resolves `future`.
+        """
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            return
+        with self._lock:
+            self._inflight.pop(key, None)
+            if value is not None:
+                self._store(key, value)
+        future.set_result(value)
+
+
+    def _store(self, key, value) -> None:
+        """
+        Adds `value` under `key` and evicts least recently used entries until the cache fits in `maxBytes`.  Must hold the lock.
+        """
+        size = self.sizeof(value)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        if size > self.maxBytes:
+            return
+        self._entries[key] = (value, size, time.monotonic())
+        self._bytes += size
+        while self._bytes > self.maxBytes:
+            _, (_, evictedSize, _) = self._entries.popitem(last=False)
+            self._bytes -= evictedSize
+            self._counts["evictions"] += 1
+
+
+    def stats(self) -> dict:
+        """
+        Returns the hit, miss, stale, coalesced and eviction counters, and the current number of entries and bytes.
+        """
+        with self._lock:
+            return dict(self._counts, entries=len(self._entries), bytes=self._bytes)
+
+
+    def clear(self) -> None:
+        """
+        Removes every entry.  Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -0,0 +1,265 @@
+"""
+catalog.py
+==========
+
+Local catalog of every item NexusHub knows, with indexes for instant autocomplete, fuzzy suggestions and canonical slugs.
+
+Names are resolved against the catalog before any price request is made, so a typo is rejected (with suggestions) without a
+round trip, and every spelling of a valid name ("saronite ore", "Saronite  Ore", "36912") maps to the same slug and cache key.
+
+The catalog is downloaded once from `<NexusHub>/items` and cached in `CATALOG_PATH`.  If it can't be loaded at all, names
+fall back to the old `name.lower().replace(' ', '-')` slugs, unchecked.
+
+Examples
+--------
+>>> catalog = default_catalog()
+>>> catalog.complete("saro")        # [{"itemId": 36912, "name": "Saronite Ore", "slug": "saronite-ore"}, ...]
+>>> catalog.suggest("saronit ore")  # [{"itemId": 36912, "name": "Saronite Ore", ...}, ...]
+>>> slug("Saronite ore")            # "saronite-ore"
+"""
+import os
+import re
+import json
+import time
+import bisect
+import threading
+import numpy as np
+import ah.api as api
+import ah.metrics as metrics
+
+CATALOG_PATH = "items.json"
+MAX_AGE = 7 * 86400         # Seconds before the cached catalog is downloaded again; items are added only with patches.
+
+
+
+
+
+class Catalog:
+    """
+    In-memory index of items, each a dictionary of the form `{"itemId": 36912, "name": "Saronite Ore", "slug": "saronite-ore"}`.
+
+    Exact lookups are dictionary hits, prefix completion is a binary search over every word suffix of every name, and fuzzy
+    suggestions rank items by the trigrams they share with the query, counted with one `np.bincount`.
+    """
+
+    def __init__(self, items: list):
+        """
+        Parameters
+        ----------
+        `items`: List of item dictionaries with `itemId`, `name` and `slug` keys.
+        """
+        self.items = sorted(items, key=lambda item: item["name"].lower())
+        self._byKey = {}
+        for i, item in enumerate(self.items):
+            for key in (str(item["itemId"]), item["slug"], normalize(item["name"]), slugify(item["name"])):
+                self._byKey.setdefault(key, i)
+        # prefix index: "saronite ore" is found by "saro" and by "ore"
+        prefixes = []
+        for i, item in enumerate(self.items):
+            words = normalize(item["name"]).split(" ")
+            prefixes.extend((" ".join(words[w:]), w, i) for w in range(len(words)))
+        prefixes.sort()
+        self._prefixKeys = [key for key, _, _ in prefixes]
+        self._prefixOwners = [(w, i) for _, w, i in prefixes]
+        # trigram index
+        postings = {}
+        self._gramCounts = np.zeros(len(self.items))
+        for i, item in enumerate(self.items):
+            grams = trigrams(normalize(item["name"]))
+            self._gramCounts[i] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        self._postings = {gram: np.array(owners, dtype=np.int64) for gram, owners in postings.items()}
+
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+    def get(self, query) -> dict:
+        """
+        Returns the item with the given ID, slug or (case- and spacing-insensitive) name, or `None` if there is none.
+        """
+        query = str(query).strip()
+        i = self._byKey.get(query)
+        if i is None:
+            i = self._byKey.get(normalize(query), self._byKey.get(slugify(query)))
+        return None if i is None else self.items[i]
+
+
+    def complete(self, prefix: str, limit: int = 10) -> list:
+        """
+        Returns up to `limit` items with a name, or a word of the name onwards, starting with `prefix`.
+        Names that start with `prefix` come first, then shorter names.
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        found = {}
+        start = bisect.bisect_left(self._prefixKeys, prefix)
+        for key, (word, i) in zip(self._prefixKeys[start:start + 50*limit], self._prefixOwners[start:start + 50*limit]):
+            if not key.startswith(prefix):
+                break
+            found[i] = min(word, found.get(i, word))
+        ranked = sorted(found, key=lambda i: (found[i] > 0, len(self.items[i]["name"]), self.items[i]["name"]))
+        return [self.items[i] for i in ranked[:limit]]
+
+
+    def suggest(self, text: str, limit: int = 5, minScore: float = 0.3) -> list:
+        """
+        Returns up to `limit` items whose names look most like `text`, best first, even if `text` is misspelled.
+
+        Parameters
+        ----------
+        `minScore`: The minimum similarity (Dice coefficient of trigrams, between `0` and `1`) of a suggestion.  Default is `0.3`.
+        """
+        grams = trigrams(normalize(text))
+        lists = [self._postings[gram] for gram in grams if gram in self._postings]
+        if not lists:
+            return []
+        shared = np.bincount(np.concatenate(lists), minlength=len(self.items))
+        score = 2 * shared / (len(grams) + self._gramCounts)
+        limit = min(limit, len(score))
+        best = np.argpartition(-score, limit-1)[:limit]
+        best = best[np.argsort(-score[best], kind="stable")]
+        return [self.items[i] for i in best if score[i] >= minScore]
+
+
+    def slug(self, name: str) -> str:
+        """
+        Returns the canonical slug of the item named `name` (or with that ID or slug).
+
+        Raises `ValueError`, listing the closest matches, if there is no such item.
+        """
+        item = self.get(name)
+        if item is None:
+            metrics.count("catalog_rejects")
+            suggestions = ", ".join(s["name"] for s in self.suggest(name))
+            hint = f"  Did you mean: {suggestions}?" if suggestions else ""
+            raise ValueError(f"\n>> Unknown item '{name}'.{hint}\n")
+        return item["slug"]
+
+
+    @classmethod
+    def load(cls, path: str = CATALOG_PATH, maxAge: float = MAX_AGE) -> "Catalog":
+        """
+        Returns the catalog cached at `path`, downloading it again if it is older than `maxAge` seconds or from another NexusHub instance.
+        A stale cached catalog is used if the download fails.  Returns `None` if there is neither.
+        A cached file that can't be read (e.g. truncated by an interrupted save) counts as missing.
+        """
+        url = api.items_url()
+        cached = None
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    cached = json.load(f)
+                if not isinstance(cached, dict) or not isinstance(cached.get("items"), list):
+                    raise ValueError("not a saved catalog")
+            except (OSError, ValueError) as e:
+                print(f"{path}: {e}")
+                cached = None
+            if cached is None or cached.get("source") != url:
+                cached = None
+            elif time.time() - os.path.getmtime(path) < maxAge:
+                return cls(cached["items"])
+        items = download(url)
+        if items is None:
+            return cls(cached["items"]) if cached else None
+        catalog = cls(items)
+        if path:
+            catalog.save(path, url)
+        return catalog
+
+
+    def save(self, path: str, source: str = None) -> None:
+        """
+        Writes the catalog to a JSON file, noting the URL it was downloaded from.
+        The file is replaced atomically, so readers never see a partial catalog.
+        """
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"       # processes may save at once
+        with open(temp, "w") as f:
+            json.dump({"source": source, "items": self.items}, f)
+        os.replace(temp, path)
+
+
+
+
+
+def download(url: str = None) -> list:
+    """
+    Downloads the list of all items from NexusHub, as item dictionaries.  Returns `None` if the request failed.
+    """
+    url = url or api.items_url()
+    try:
+        status, body = api.TRANSPORT.get(url, api.TIMEOUT)
+        rows = json.loads(body) if status == 200 else None
+    except (OSError, ValueError) as e:
+        print(f"{url}: {e}")
+        return None
+    if rows is None:
+        print(status)
+        return None
+    rows = rows.get("data", rows) if isinstance(rows, dict) else rows
+    return [{"itemId": row["itemId"], "name": row["name"], "slug": row.get("uniqueName") or slugify(row["name"])} for row in rows]
+
+
+
+
+
+RETRY_AFTER = 300           # Seconds before trying again to load a catalog that couldn't be loaded.
+_default = None
+_loadedAt = None
+
+def default_catalog() -> Catalog:
+    """
+    Returns the shared catalog cached at `CATALOG_PATH`, loading it on first use.  `None` if it couldn't be loaded.
+    """
+    global _default, _loadedAt
+    if _loadedAt is None or (_default is None and time.monotonic() - _loadedAt > RETRY_AFTER):
+        _default = Catalog.load(CATALOG_PATH)
+        _loadedAt = time.monotonic()
+    return _default
+
+
+def reset() -> None:
+    """
+    Forgets the shared catalog, so it is loaded again (e.g. from another NexusHub instance) on next use.
+    """
+    global _default, _loadedAt
+    _default, _loadedAt = None, None
+
+
+def slug(name: str) -> str:
+    """
+    Returns the canonical slug of an item name using the shared catalog, or the unchecked `slugify`-style slug if there is no catalog.
+    Raises `ValueError` for names that aren't in the catalog.
+    """
+    catalog = default_catalog()
+    if catalog is None:
+        return name.lower().replace(' ', '-')
+    return catalog.slug(name)
+
+
+
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercases `text` and collapses its whitespace, e.g. `"  Saronite   ORE"` becomes `"saronite ore"`.
+    """
+    return " ".join(str(text).lower().split())
+
+
+def slugify(name: str) -> str:
+    """
+    Returns the NexusHub-style slug of an item name, e.g. `"Adder's Tongue"` becomes `"adders-tongue"`.
+    """
+    return re.sub(r"[^a-z0-9]+", "-", name.lower().replace("'", "")).strip("-")
+
+
+def trigrams(text: str) -> set:
+    """
+    Returns the set of 3-character substrings of `text`, padded so that short words and word starts count too.
+    """
+    padded = f"  {text} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
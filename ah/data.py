@@ -5,13 +5,20 @@ data.py
 Functions for getting auction data from the NexusHub API and returning it in more useful forms.
 """
 import ah.api as api
+import ah.store as store
 import datetime
+import warnings
+import numpy as np
+import ah.metrics as metrics
+from collections import deque
+from ah.misc import rolling_weighted_average
+from ah.series import PriceSeries, Bars
 
 
 
 
 
-def get_server_history(item: str, server: str = "Skyfury", faction: str = "Alliance", numDays: int = None, avg: bool = True) -> dict:
+def get_server_history(item: str, server: str = "Skyfury", faction: str = "Alliance", numDays: int = None, avg: bool = True, useStore: bool = True, how: str = "mean") -> PriceSeries:
     """
     Returns the price & quantity history of an item for the specified faction/server.
 
@@ -21,23 +28,27 @@ def get_server_history(item: str, server: str = "Skyfury", faction: str = "Allia
     `server`: The name of the server.  Default is `Skyfury`.
     `faction`: The faction on the given server.  Default is `Alliance`.
     `numDays`: The number of days to get the price history for. If `None`, then the entire history is returned.
-    `avg`: Whether or not to average the data over 2 hours.  Default is `True`.
+    `avg`: Whether or not to average the data over 2 hours (or, for long ranges read from the store, over the rollup tier picked by `ah.store.plan`).  Default is `True`.
+    `useStore`: Whether or not to read through the local history store, only requesting new scans from NexusHub.  Default is `True`.
+    `how`: How to average, if `avg` is `True`: `mean` weights every scan equally, `vwap` weights each scan's price by its quantity.  Default is `mean`.
 
     Returns
     -------
-    Dictionary of lists of the form:
-    >>> {
-    >>>     "prices": [123456, 123456, ...],
-    >>>     "quantities": [123456, 123456, ...],
-    >>>     "times": ["MM-DD-YYYY HH:MM", "MM-DD-YYYY HH:MM", ...]
-    >>> }
-    """
-    itemData = api.server_history(item, server, faction, numDays)
-    prices = [i["marketValue"] for i in itemData]
-    quantities = [i["quantity"] for i in itemData]
-    times = [i["scannedAt"] for i in itemData]
-    data = {"prices": prices, "quantities": quantities, "times": times}
-    if avg: data = average(data)
+    A `PriceSeries`, whose `prices`, `quantities` and `times` columns can also be read dict-style:
+    >>> data["prices"]          # array([123456., 123456., ...])
+    >>> data["quantities"]      # array([123456., 123456., ...])
+    >>> data["times"]           # array(['YYYY-MM-DDTHH:MM', ...], dtype='datetime64[m]')
+    """
+    tier = store.plan(numDays or api.default_timerange()) if useStore and avg else None
+    if tier:            # long range: read pre-aggregated bars instead of every scan
+        with metrics.span("store"):
+            return store.server_bars(item, server, faction, numDays, tier).to_series("vwap" if how == "vwap" else "mean")
+    if useStore:
+        with metrics.span("store"):
+            data = store.server_series(item, server, faction, numDays)
+    else:
+        data = api.fetch_series(api.server_url(item, server, faction, numDays or api.default_timerange())) or PriceSeries.empty()
+    if avg: data = average(data, how=how)
     return data
 
 
@@ -49,7 +60,7 @@ def get_server_history(item: str, server: str = "Skyfury", faction: str = "Allia
 
 
 
-def get_region_history(item: str, region: str = "US", numDays: int = None, avg: bool = True) -> dict:
+def get_region_history(item: str, region: str = "US", numDays: int = None, avg: bool = True, useStore: bool = True, how: str = "mean") -> PriceSeries:
     """
     Returns the price & quantity history of an item for the US region as a whole.
 
@@ -58,23 +69,27 @@ def get_region_history(item: str, region: str = "US", numDays: int = None, avg:
     `item`: The name of the item.
     `region`: The region to get historical price data for.  Default is `US`.
     `numDays`: The number of days to get the price history for. If `None`, then the entire history is returned.
-    `avg`: Whether or not to average the data over 2 hours.  Default is `True`.
+    `avg`: Whether or not to average the data over 2 hours (or, for long ranges read from the store, over the rollup tier picked by `ah.store.plan`).  Default is `True`.
+    `useStore`: Whether or not to read through the local history store, only requesting new scans from NexusHub.  Default is `True`.
+    `how`: How to average, if `avg` is `True`: `mean` weights every scan equally, `vwap` weights each scan's price by its quantity.  Default is `mean`.
 
     Returns
     -------
-    Dictionary of lists of the form:
-    >>> {
-    >>>     "prices": [123456, 123456, ...],
-    >>>     "quantities": [123456, 123456, ...],
-    >>>     "times": ["MM-DD-YYYY HH:MM", "MM-DD-YYYY HH:MM", ...]
-    >>> }
-    """
-    itemData = api.region_history(item, region, numDays)
-    prices = [i["marketValue"] for i in itemData]
-    quantities = [i["quantity"] for i in itemData]
-    times = [i["scannedAt"] for i in itemData]
-    data = {"prices": prices, "quantities": quantities, "times": times}
-    if avg: data = average(data)
+    A `PriceSeries`, whose `prices`, `quantities` and `times` columns can also be read dict-style:
+    >>> data["prices"]          # array([123456., 123456., ...])
+    >>> data["quantities"]      # array([123456., 123456., ...])
+    >>> data["times"]           # array(['YYYY-MM-DDTHH:MM', ...], dtype='datetime64[m]')
+    """
+    tier = store.plan(numDays or api.default_timerange()) if useStore and avg else None
+    if tier:            # long range: read pre-aggregated bars instead of every scan
+        with metrics.span("store"):
+            return store.region_bars(item, region, numDays, tier).to_series("vwap" if how == "vwap" else "mean")
+    if useStore:
+        with metrics.span("store"):
+            data = store.region_series(item, region, numDays)
+    else:
+        data = api.fetch_series(api.region_url(item, region, numDays or api.default_timerange())) or PriceSeries.empty()
+    if avg: data = average(data, how=how)
     return data
 
 
@@ -86,55 +101,178 @@ def get_region_history(item: str, region: str = "US", numDays: int = None, avg:
 
 
 
-def average(dataset1: dict, dataset2: dict = None, numHoursToAverage: int = 2) -> dict:
+def average(dataset1: PriceSeries, dataset2: PriceSeries = None, numHoursToAverage: int = 2, how: str = "mean") -> PriceSeries:
     """
-    Averages the given dataset(s) over the given number of hours.
+    Averages the given dataset(s) over wall-clock buckets of the given number of hours.
 
     Parameters
     ----------
-    `dataset1`: Dataset #1.
+    `dataset1`: Dataset #1, as a `PriceSeries` or a dict of lists.
     `dataset2`: Dataset #2. If `None`, then only the `dataset1` is averaged and returned.
     `numHoursToAverage`: The number of hours to average the data over (ex: `2` for 2-hour average, `12` for 12-hour average, etc).
+    `how`: `mean` for a plain average, or `vwap` to weight each price by its quantity.  Any other aggregation of `resample` also works.  Default is `mean`.
 
     Returns
     -------
-    `averagedDataset1`: The modified version of dataset #1, with the same structure.
-    `averagedDataset2`: The modified version of dataset #2, with the same structure, if `dataset2` was given.
+    `averagedDataset1`: The averaged version of dataset #1, as a `PriceSeries`.
+    `averagedDataset2`: The averaged version of dataset #2, as a `PriceSeries`, if `dataset2` was given.
     """
-    startIndex = len(dataset1["prices"]) % numHoursToAverage
-    # if only one dataset is given, then just average that one
     if dataset2 is None:
-        # create a new dataset to hold the averaged data
-        averagedDataset = {"prices": [], "quantities": [], "times": []}
-        # loop through the dataset and average the data
-        for i in range(startIndex, len(dataset1["times"]), numHoursToAverage):
-            # get the average price and quantity
-            avgPrice = sum(dataset1["prices"][i:i+numHoursToAverage]) / numHoursToAverage
-            avgQuantity = sum(dataset1["quantities"][i:i+numHoursToAverage]) / numHoursToAverage
-            # add the average price and quantity to the new dataset
-            averagedDataset["prices"].append(avgPrice)
-            averagedDataset["quantities"].append(avgQuantity)
-            averagedDataset["times"].append(dataset1["times"][i])
-        return averagedDataset
-    # if two datasets are given, then average both of them
+        return resample(dataset1, f"{numHoursToAverage}h", how)
+    return tuple(resample([dataset1, dataset2], f"{numHoursToAverage}h", how))
+
+
+
+
+
+
+
+
+
+
+FREQUENCY_UNITS = {"m": 1, "h": 60, "d": 1440, "w": 10080}
+WEEK_ORIGIN = 4 * 1440          # Minutes from the epoch (a Thursday) to the first Monday, so weekly buckets start on Mondays.
+
+@metrics.timed("aggregate")
+def resample(series, freq: str = "2h", how: str = "mean"):
+    """
+    Groups the scans of one or many series into wall-clock time buckets and aggregates each bucket, in one vectorized pass.
+    Buckets are aligned to the clock (e.g. `2h` buckets start on even hours, `1d` at midnight, `1w` on Mondays), so missed scans never shift later buckets.
+
+    Parameters
+    ----------
+    `series`: A `PriceSeries` (or dict of lists), or a list of them.  Each must be sorted by time.
+    `freq`: The bucket width, as a number followed by `m`, `h`, `d` or `w` (ex: `2h`, `12h`, `1d`, `1w`).  Default is `2h`.
+    `how`: The aggregation: `mean`, `vwap`, `median`, `sum`, `first`, `last`, `min`, `max` or `ohlc`.  Default is `mean`.
+    `vwap` weights the prices and minimum buyouts by the quantities (buckets without any quantity fall back to the mean) and averages the quantities.
+
+    Returns
+    -------
+    For `ohlc`, a `Bars` of the prices; otherwise a `PriceSeries` with each column aggregated.  A list of them if a list was given.
+    Each bucket is labelled with its start time, and empty buckets are omitted.
+    """
+    many = isinstance(series, (list, tuple))
+    series = [PriceSeries.coerce(s) for s in (series if many else [series])]
+    width = _frequency(freq)
+    origin = WEEK_ORIGIN if freq.endswith("w") else 0
+    # concatenate everything and find where the (series, bucket) key changes
+    lengths = np.array([len(s) for s in series])
+    owner = np.repeat(np.arange(len(series)), lengths)
+    minutes = np.concatenate([s.times for s in series]).astype(np.int64) if lengths.sum() else np.empty(0, dtype=np.int64)
+    buckets = (minutes - origin) // width
+    change = (np.diff(buckets) != 0) | (np.diff(owner) != 0)
+    starts = np.concatenate(([0], np.flatnonzero(change) + 1)) if len(minutes) else np.empty(0, dtype=np.int64)
+    ends = np.append(starts[1:], len(minutes))
+    counts = ends - starts
+    times = (buckets[starts] * width + origin).astype("datetime64[m]")
+    columns = {field: np.concatenate([getattr(s, field) for s in series]) for field in ("prices", "minBuyouts", "quantities")}
+    if how == "ohlc":
+        prices = columns["prices"]
+        quantities = columns["quantities"]
+        volume = _aggregate(quantities, starts, ends, "sum")
+        vwap = _vwap(prices, quantities, starts, ends)
+        results = [Bars(times, prices[starts], _aggregate(prices, starts, ends, "max"), _aggregate(prices, starts, ends, "min"),
+                        prices[ends-1], _aggregate(quantities, starts, ends, "mean"), counts,
+                        _aggregate(prices, starts, ends, "mean"), vwap, volume, _aggregate(columns["minBuyouts"], starts, ends, "mean"))]
+    elif how == "vwap":
+        quantities = columns["quantities"]
+        results = [PriceSeries(times, _vwap(columns["prices"], quantities, starts, ends), _vwap(columns["minBuyouts"], quantities, starts, ends),
+                               _aggregate(quantities, starts, ends, "mean"))]
+    else:
+        results = [PriceSeries(times, *(_aggregate(columns[field], starts, ends, how) for field in ("prices", "minBuyouts", "quantities")))]
+    # split the buckets back up by series
+    splits = np.cumsum(np.bincount(owner[starts], minlength=len(series)))[:-1] if len(starts) else np.zeros(len(series)-1, dtype=np.int64)
+    bounds = list(zip(np.concatenate(([0], splits)), np.append(splits, len(starts))))
+    results = [results[0][a:b] for a,b in bounds]
+    return results if many else results[0]
+
+
+def _frequency(freq: str) -> int:
+    """
+    Returns the width in minutes of a frequency string such as `2h` or `1w`.
+    """
+    unit = freq[-1:].lower()
+    if unit not in FREQUENCY_UNITS or not freq[:-1].isdigit() or int(freq[:-1]) < 1:
+        raise ValueError(f"\n>> `freq` must be a positive number followed by m, h, d or w, not {freq}.\n")
+    return int(freq[:-1]) * FREQUENCY_UNITS[unit]
+
+
+def _aggregate(values: np.ndarray, starts: np.ndarray, ends: np.ndarray, how: str) -> np.ndarray:
+    """
+    Aggregates `values[starts[i]:ends[i]]` for every bucket `i` at once.
+    """
+    if not len(starts):
+        return np.empty(0)
+    if how == "mean":
+        return np.add.reduceat(values, starts) / (ends - starts)
+    if how == "sum":
+        return np.add.reduceat(values, starts)
+    if how == "min":
+        return np.minimum.reduceat(values, starts)
+    if how == "max":
+        return np.maximum.reduceat(values, starts)
+    if how == "first":
+        return values[starts]
+    if how == "last":
+        return values[ends-1]
+    if how == "median":
+        group = np.repeat(np.arange(len(starts)), ends - starts)
+        ordered = values[np.lexsort((values, group))]
+        return (ordered[starts + (ends-starts-1)//2] + ordered[starts + (ends-starts)//2]) / 2
+    raise ValueError(f"\n>> `how` must be one of mean, vwap, median, sum, first, last, min, max or ohlc, not {how}.\n")
+
+
+def _vwap(values: np.ndarray, quantities: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Returns the quantity-weighted mean of `values[starts[i]:ends[i]]` for every bucket `i` at once, in O(n): one `reduceat` of `values*quantities`
+    and one of `quantities`, as in `ah.misc.rolling_weighted_average`.  Missing (`nan`) values or quantities count as a weight of `0`.
+    Buckets without any quantity fall back to the plain mean of their values.
+    """
+    if not len(starts):
+        return np.empty(0)
+    present = ~np.isnan(values)
+    valid = present & ~np.isnan(quantities)
+    weights = np.where(valid, quantities, 0)
+    weighted = np.add.reduceat(np.where(valid, values, 0) * weights, starts)
+    total = np.add.reduceat(weights, starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.add.reduceat(np.where(present, values, 0), starts) / np.add.reduceat(present, starts)
+        return np.where(total > 0, weighted / total, mean)
+
+
+
+
+
+
+
+
+
+
+@metrics.timed("vwap")
+def rolling_vwap(series, window: int = 12, minQuantity: float = 0):
+    """
+    Returns the rolling volume-weighted average price of one or many series: each point's price is the quantity-weighted mean of the last `window` scans.
+    Equal-length series are computed together as one 2-D array; every window costs O(1) thanks to running sums (see `ah.misc.rolling_weighted_average`).
+
+    Parameters
+    ----------
+    `series`: A `PriceSeries` (or dict of lists), or a list of them.
+    `window`: The number of scans in each window.  Default is `12`.
+    `minQuantity`: Windows with a total quantity of at most this are `nan`.  Default is `0`.
+
+    Returns
+    -------
+    A `PriceSeries` with the rolling VWAP as its prices (a list of them if a list was given).  Quantities and minimum buyouts are unchanged.
+    """
+    many = isinstance(series, (list, tuple))
+    series = [PriceSeries.coerce(s) for s in (series if many else [series])]
+    lengths = {len(s) for s in series}
+    if len(lengths) == 1:
+        vwaps = rolling_weighted_average(np.stack([s.prices for s in series]), np.stack([s.quantities for s in series]), window, minQuantity)
     else:
-        # create new datasets to hold the averaged data
-        averagedDataset1 = {"prices": [], "quantities": [], "times": []}
-        averagedDataset2 = {"prices": [], "quantities": [], "times": []}
-        # loop through the datasets and average the data
-        for i in range(startIndex, len(dataset1["times"]), numHoursToAverage):
-            avgPrice1 = sum(dataset1["prices"][i:i+numHoursToAverage]) / numHoursToAverage
-            avgQuantity1 = sum(dataset1["quantities"][i:i+numHoursToAverage]) / numHoursToAverage
-            avgPrice2 = sum(dataset2["prices"][i:i+numHoursToAverage]) / numHoursToAverage
-            avgQuantity2 = sum(dataset2["quantities"][i:i+numHoursToAverage]) / numHoursToAverage
-            # add the average price and quantity to the new datasets
-            averagedDataset1["prices"].append(avgPrice1)
-            averagedDataset1["quantities"].append(avgQuantity1)
-            averagedDataset1["times"].append(dataset1["times"][i])
-            averagedDataset2["prices"].append(avgPrice2)
-            averagedDataset2["quantities"].append(avgQuantity2)
-            averagedDataset2["times"].append(dataset2["times"][i])
-        return averagedDataset1, averagedDataset2
+        vwaps = [rolling_weighted_average(s.prices, s.quantities, window, minQuantity) for s in series]
+    results = [PriceSeries(s.times, vwap, s.minBuyouts, s.quantities) for s, vwap in zip(series, vwaps)]
+    return results if many else results[0]
 
 
 
@@ -145,31 +283,48 @@ def average(dataset1: dict, dataset2: dict = None, numHoursToAverage: int = 2) -
 
 
 
-def align(dataset1: dict, dataset2: dict) -> dict:
+@metrics.timed("align")
+def align(*datasets: PriceSeries, toleranceMinutes: int = 30) -> tuple:
     """
-    Aligns the two given datasets such that the dates of their last elements are within an hour of one another, and their lengths are equal.
+    Aligns the given datasets by timestamp, pairing every point of the first dataset with the nearest point in time of each other dataset.
+    Points of the first dataset without a match within `toleranceMinutes` in every other dataset are dropped, so all results have equal lengths.
 
     Parameters
     ----------
-    `dataset1`: Dataset #1.
-    `dataset2`: Dataset #2.
+    `*datasets`: Two or more datasets, as `PriceSeries` or dicts of lists, each sorted by time.  The first one (e.g. the server data) is the reference.
+    `toleranceMinutes`: The maximum time difference, in minutes, between matched points.  Default is `30`.
 
     Returns
     -------
-    `alignedDataset1`: The modified version of dataset #1, with the same structure.
-    `alignedDataset2`: The modified version of dataset #2, with the same structure.
+    `alignedDatasets`: One `PriceSeries` per dataset, all of the same length, with matching points at the same positions.
+    """
+    datasets = [PriceSeries.coerce(d) for d in datasets]
+    reference = datasets[0].times.astype(np.int64)
+    keep = np.ones(len(reference), dtype=bool)
+    matches = []
+    for dataset in datasets[1:]:
+        match, found = _nearest(dataset.times.astype(np.int64), reference, toleranceMinutes)
+        matches.append(match)
+        keep &= found
+    aligned = [datasets[0][keep]]
+    for dataset, match in zip(datasets[1:], matches):
+        aligned.append(dataset[match[keep]])
+    return tuple(aligned)
+
+
+def _nearest(times: np.ndarray, targets: np.ndarray, tolerance: int) -> tuple:
     """
-    len1 = len(dataset1["times"])
-    len2 = len(dataset2["times"])
-    if len1 > len2:
-        dataset1["times"] = dataset1["times"][len1-len2:]
-        dataset1["prices"] = dataset1["prices"][len1-len2:]
-        dataset1["quantities"] = dataset1["quantities"][len1-len2:]
-    elif len2 > len1:
-        dataset2["times"] = dataset2["times"][len2-len1:]
-        dataset2["prices"] = dataset2["prices"][len2-len1:]
-        dataset2["quantities"] = dataset2["quantities"][len2-len1:]
-    return dataset1, dataset2
+    For each of the sorted `targets`, returns the index of the nearest of the sorted `times`, and whether it is within `tolerance`.
+    """
+    if not len(times):
+        return np.zeros(len(targets), dtype=np.int64), np.zeros(len(targets), dtype=bool)
+    right = np.clip(np.searchsorted(times, targets), 0, len(times)-1)
+    left = np.maximum(right - 1, 0)
+    useLeft = np.abs(targets - times[left]) < np.abs(times[right] - targets)
+    nearest = np.where(useLeft, left, right)
+    return nearest, np.abs(times[nearest] - targets) <= tolerance
+
+
 
 
 
@@ -177,27 +332,138 @@ def align(dataset1: dict, dataset2: dict) -> dict:
 
 
 
-def replace_outliers(lst: dict, numStdDevs: int = 3) -> dict:
+
+@metrics.timed("downsample")
+def downsample(times: np.ndarray, *values: np.ndarray, numBuckets: int = 700) -> np.ndarray:
     """
-    Replaces outliers in the given list with the average of the list.
+    Picks the points worth drawing when plotting long series at a fixed width, so rendering cost doesn't grow with the history.
+
+    The time axis is split into `numBuckets` equal-width buckets (e.g. one per pixel column), and the first, last, minimum and
+    maximum point of each bucket is kept for every series in `values`.  Spikes and the last point are therefore always kept.
 
     Parameters
     ----------
-    `lst`: The list to replace outliers in.
-    `numStdDevs`: The number of standard deviations away from the mean that an outlier is.
+    `times`: Sorted array of times (`datetime64` or numeric).
+    `*values`: One or more arrays of the same length as `times`.
+    `numBuckets`: The number of buckets to split the time axis into.  Default is `700`.
 
     Returns
     -------
-    `list`: The modified version of the list, with the same structure.
-    """
-    import numpy as np
-    # get the mean and standard deviation of the data
-    mean = np.mean(lst)
-    stdDev = np.std(lst)
-    print(f"  Mean: {mean:.2f}")
-    print(f"  Standard Deviation: {stdDev:.2f}")
-    # loop through the data and replace outliers with the mean
-    for i in range(len(lst)):
-        if lst[i] > mean + numStdDevs * stdDev or lst[i] < mean - numStdDevs * stdDev:
-            lst[i] = mean
-    return lst
+    Sorted array of the indices to keep.  Every index is returned if there are no more than `4*numBuckets` points.
+    """
+    n = len(times)
+    if n <= 4*numBuckets:
+        return np.arange(n)
+    t = np.asarray(times).astype(np.int64)
+    t = t - t[0]
+    bucket = t * numBuckets // (t[-1] + 1)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+    ends = np.append(starts[1:], n)
+    keep = [starts, ends - 1]
+    for v in values:
+        order = np.lexsort((v, bucket))
+        keep.append(order[starts])
+        keep.append(order[ends - 1])
+    return np.unique(np.concatenate(keep))
+
+
+
+
+
+
+
+
+
+
+MAD_SCALE = 1.4826          # Scales a median absolute deviation to a standard deviation, for normally distributed data.
+
+@metrics.timed("outliers")
+def replace_outliers(lst: np.ndarray, numStdDevs: int = 3, window: int = 24, minPeriods: int = 12) -> tuple:
+    """
+    Replaces outliers in the given list with a rolling median (Hampel filter).
+
+    Each point is compared with the median of the `window` points before it; the spread is estimated robustly from their
+    median absolute deviation (scaled to match a standard deviation).  Only earlier points are used, so the result for a
+    point never changes once later scans arrive, and it matches what `OutlierFilter` produces one scan at a time.
+
+    Parameters
+    ----------
+    `lst`: The list or array to replace outliers in.  A matrix is filtered row by row.
+    `numStdDevs`: The number of (robust) standard deviations away from the rolling median that an outlier is.
+    `window`: The number of previous points each point is compared with.  Default is `24`, i.e. one day of hourly scans.
+    `minPeriods`: The number of previous points needed before a point can be flagged.  Default is `12`.
+
+    Returns
+    -------
+    `array`: A copy of `lst` as a `numpy` array, with outliers replaced by their rolling median.
+    `mask`: A boolean array, `True` where a point was replaced.
+    """
+    values = np.array(lst, dtype=np.float64)
+    padded = np.concatenate((np.full(values.shape[:-1] + (window,), np.nan), values), axis=-1)
+    history = np.lib.stride_tricks.sliding_window_view(padded, window, axis=-1)[..., :-1, :]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)        # all-nan windows at the start of the series
+        median = np.nanmedian(history, axis=-1)
+        spread = MAD_SCALE * np.nanmedian(np.abs(history - median[..., None]), axis=-1)
+    enough = np.sum(~np.isnan(history), axis=-1) >= minPeriods
+    mask = enough & (spread > 0) & (np.abs(values - median) > numStdDevs * spread)
+    values[mask] = median[mask]
+    return values, mask
+
+
+
+
+
+
+
+
+
+
+class OutlierFilter:
+    """
+    Streaming version of `replace_outliers`, for checking one new scan at a time.
+
+    Keeps only the last `window` values, so each update takes constant time regardless of the length of the history.
+
+    Examples
+    --------
+    >>> f = OutlierFilter(history=data.prices)
+    >>> price, isOutlier = f.update(newPrice)
+    """
+
+    def __init__(self, numStdDevs: int = 3, window: int = 24, minPeriods: int = 12, history: list = None):
+        """
+        Parameters
+        ----------
+        `numStdDevs`: The number of (robust) standard deviations away from the rolling median that an outlier is.
+        `window`: The number of previous values each new value is compared with.  Default is `24`.
+        `minPeriods`: The number of previous values needed before a value can be flagged.  Default is `12`.
+        `history`: Optional existing values to start from; only the last `window` are kept.
+        """
+        self.numStdDevs = numStdDevs
+        self.minPeriods = minPeriods
+        self.window = deque(maxlen=window)
+        if history is not None:
+            self.window.extend(np.asarray(history, dtype=np.float64)[-window:])
+
+
+    def update(self, value: float) -> tuple:
+        """
+        Checks `value` against the current window, then adds it to the window.
+
+        Returns
+        -------
+        `value`: `value`, or the rolling median if it is an outlier.
+        `isOutlier`: Whether `value` was replaced.
+        """
+        isOutlier = False
+        replacement = value
+        if len(self.window) >= self.minPeriods:
+            history = np.fromiter(self.window, dtype=np.float64, count=len(self.window))
+            median = np.median(history)
+            spread = MAD_SCALE * np.median(np.abs(history - median))
+            if spread > 0 and abs(value - median) > self.numStdDevs * spread:
+                isOutlier = True
+                replacement = median
+        self.window.append(value)
+        return replacement, isOutlier
@@ -0,0 +1,170 @@
+"""
+decode.py
+=========
+
+Streaming decoder of NexusHub price history responses.
+
+Instead of parsing the whole response into a list of dicts, the body is read chunk by chunk and each row's values are
+written straight into typed column buffers, so peak memory stays close to the size of the final arrays.
+
+Examples
+--------
+>>> status, chunks = transport.stream(url, timeout)
+>>> times, marketValues, minBuyouts, quantities = decode_prices(chunks)
+"""
+import json
+import codecs
+import numpy as np
+from array import array
+
+_decoder = json.JSONDecoder()
+WHITESPACE = " \t\n\r"
+FIELDS = ("marketValue", "minBuyout", "quantity")
+
+
+
+
+
+class _Reader:
+    """
+    Text buffer over an iterator of byte chunks, refilled on demand.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.done = False
+
+
+    def more(self) -> bool:
+        """
+        Appends the next chunk to the buffer, dropping what has already been consumed.  Returns `False` at the end of the body.
+        """
+        if self.done:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.done = True
+            text = self.utf8.decode(b"", final=True)
+        else:
+            text = self.utf8.decode(chunk)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character without consuming it, or `""` at the end of the body.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.more():
+                return self.buffer[self.pos:self.pos+1]
+
+
+    def expect(self, char: str) -> None:
+        """
+        Consumes the next non-whitespace character, which must be `char`.
+        """
+        if self.peek() != char:
+            raise ValueError(f"\n>> Malformed price history response: expected '{char}' at offset {self.pos}.\n")
+        self.pos += 1
+
+
+    def value(self):
+        """
+        Decodes the next JSON value, reading more of the body until it is complete.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.done:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.done:
+                    raise
+            self.more()
+
+
+
+
+
+def decode_prices(chunks, rounded: bool = False) -> tuple:
+    """
+    Decodes a NexusHub price history response body, given as an iterable of byte chunks, into columns.
+
+    Parameters
+    ----------
+    `chunks`: The response body, e.g. the chunks of `Transport.stream`.
+    `rounded`: Whether or not to round the values to the nearest copper/integer.  Default is `False`.
+
+    Returns
+    -------
+    `times`: UTC scan times, as a `datetime64[m]` array.
+    `marketValues`, `minBuyouts`, `quantities`: `float64` arrays, with `nan` for missing values.
+
+    Raises `ValueError` if the body is truncated or malformed, e.g. a row isn't an object or lacks `scannedAt` or `marketValue`.
+    """
+    reader = _Reader(chunks)
+    stamps, columns = array("q"), [array("d") for _ in FIELDS]
+    reader.expect("{")
+    while reader.peek() != "}":
+        key = reader.value()
+        reader.expect(":")
+        if key != "data":
+            reader.value()          # other fields are small; decode and drop them
+        else:
+            reader.expect("[")
+            batch = []
+            while reader.peek() != "]":
+                row = _check_row(reader.value(), len(stamps) + len(batch))
+                batch.append(row["scannedAt"])
+                for column, field in zip(columns, FIELDS):
+                    value = row.get(field)
+                    column.append(np.nan if value is None else value)
+                if len(batch) >= 4096:
+                    _extend_times(stamps, batch)
+                    batch = []
+                if reader.peek() == ",":
+                    reader.pos += 1
+            _extend_times(stamps, batch)
+            reader.expect("]")
+        if reader.peek() == ",":
+            reader.pos += 1
+    reader.expect("}")
+    times = np.frombuffer(stamps, dtype="datetime64[m]") if len(stamps) else np.empty(0, dtype="datetime64[m]")
+    values = [np.frombuffer(column, dtype=np.float64) if len(column) else np.empty(0) for column in columns]
+    if rounded:
+        values = [np.round(column) for column in values]
+    return (times, *values)
+
+
+def _check_row(row, index: int) -> dict:
+    """
+    Returns `row` if it is a price row: an object with a `scannedAt` string, a `marketValue`, and numeric (or null) values.
+    Raises `ValueError` naming the row's index otherwise.
+    """
+    if not isinstance(row, dict):
+        raise ValueError(f"\n>> Malformed price history response: row {index} is not an object.\n")
+    if not isinstance(row.get("scannedAt"), str) or "marketValue" not in row:
+        raise ValueError(f"\n>> Malformed price history response: row {index} has no scannedAt or marketValue.\n")
+    for field in FIELDS:
+        value = row.get(field)
+        if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool)):
+            raise ValueError(f"\n>> Malformed price history response: row {index} has a non-numeric {field}.\n")
+    return row
+
+
+def _extend_times(stamps: array, batch: list) -> None:
+    """
+    Converts a batch of UTC `scannedAt` strings to minutes since the epoch and appends them to `stamps`.
+    """
+    if batch:
+        stamps.frombytes(np.char.rstrip(np.asarray(batch, dtype=str), "Z").astype("datetime64[m]").astype(np.int64).tobytes())
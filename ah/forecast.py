@@ -0,0 +1,372 @@
+"""
+forecast.py
+===========
+
+Short-term price forecasts with daily and weekly seasonality, for many histories at once.
+
+Each history is modelled in log prices as a level, smoothed exponentially, plus an hour-of-day and a day-of-week profile.
+All histories are put on one hourly grid and fitted together: the smoothing runs once over the time axis, with every
+step a vectorized update of all series.  New scans update the fitted state in O(1) per series, without refitting:
+`StoreForecaster` keeps the forecasts of a whole watchlist current from the history store, and the poller updates it after every poll.
+
+Usage:
+>>> python -m ah.forecast watchlist.json --days 28 --hours 48
+>>> python -m ah.poller watchlist.json --forecast forecast.npz
+"""
+import os
+import argparse
+import datetime
+import warnings
+import numpy as np
+import ah.store as store
+from ah.arbitrage import cube, load
+from ah.series import PriceSeries
+from ah.watchlist import Watchlist
+
+EPOCH_WEEKDAY = 3           # 1970-01-01 was a Thursday; weekdays are numbered from Monday = 0.
+
+
+
+
+
+class Forecaster:
+    """
+    Exponential smoothing model of many price series at once, with hour-of-day and day-of-week profiles.
+
+    State, for `N` series:
+    >>> level       (N,)      smoothed deseasonalized log price
+    >>> hourly      (N, 24)   hour-of-day profile, in log price
+    >>> weekly      (N, 7)    day-of-week profile, in log price
+    >>> variance    (N,)      smoothed variance of the one-step-ahead errors
+    >>> lastTime    datetime64[m] time of the latest step
+
+    Examples
+    --------
+    >>> model = Forecaster().fit(times, prices)       # prices: array of shape (N, T) on an hourly grid
+    >>> model.update(nextHour, newPrices)             # one new scan per series, `nan` where there is none
+    >>> times, mean, lower, upper = model.predict(48)
+    """
+
+    def __init__(self, alpha: float = 0.1, gamma: float = 0.05, delta: float = 0.02, beta: float = 0.05, z: float = 1.645):
+        """
+        Parameters
+        ----------
+        `alpha`: Smoothing of the level.  Default is `0.1`.
+        `gamma`: Smoothing of the hour-of-day profile.  Default is `0.05`.
+        `delta`: Smoothing of the day-of-week profile.  Default is `0.02`.
+        `beta`: Smoothing of the error variance.  Default is `0.05`.
+        `z`: Half-width of the forecast bands, in standard deviations.  Default is `1.645` (a 90% band).
+        """
+        self.alpha, self.gamma, self.delta, self.beta, self.z = alpha, gamma, delta, beta, z
+        self.level = self.hourly = self.weekly = self.variance = self.lastTime = None
+
+
+    def fit(self, times: np.ndarray, prices: np.ndarray) -> "Forecaster":
+        """
+        Fits the model to many series on a shared hourly grid.
+
+        Parameters
+        ----------
+        `times`: The hourly grid, as a `datetime64[m]` array of length `T`.
+        `prices`: Array of shape `(N, T)`, with `nan` where a series has no scan.
+        """
+        logs = _log(prices)
+        hours, days = _hour(times), _weekday(times)
+        # start from the average profiles and spread over the whole window, then smooth through it
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)         # series without any scan
+            residual = logs - np.nanmean(logs, axis=1, keepdims=True)
+            self.variance = np.nan_to_num(np.nanvar(residual, axis=1))
+        self.hourly = _profile(residual, hours, 24)
+        self.weekly = _profile(residual - self.hourly[:, hours], days, 7)
+        self.level = np.full(len(logs), np.nan)
+        for t in range(logs.shape[1]):
+            self._step(logs[:, t], hours[t], days[t])
+        self.lastTime = times[-1] if len(times) else None
+        return self
+
+
+    def update(self, time, prices: np.ndarray) -> "Forecaster":
+        """
+        Updates the fitted state with one new scan per series, in O(1) per series.
+
+        Parameters
+        ----------
+        `time`: The time of the new scans, as anything `numpy` can convert to `datetime64[m]`.
+        `prices`: Array of length `N`, with `nan` for series without a new scan.
+        """
+        time = np.datetime64(time, "m")
+        self._step(_log(prices), _hour(time), _weekday(time))
+        self.lastTime = time if self.lastTime is None else max(self.lastTime, time)
+        return self
+
+
+    def _step(self, y: np.ndarray, hour: int, day: int) -> None:
+        """
+        One smoothing step of every series.  Series with a `nan` observation keep their state.
+        """
+        seasonal = self.hourly[:, hour] + self.weekly[:, day]
+        new = np.isnan(self.level) & ~np.isnan(y)
+        self.level[new] = (y - seasonal)[new]
+        ok = ~np.isnan(y) & ~new
+        error = y - seasonal - self.level
+        self.level = np.where(ok, self.level + self.alpha*error, self.level)
+        residual = y - self.level
+        self.hourly[:, hour] = np.where(ok, self.hourly[:, hour] + self.gamma*(residual - self.weekly[:, day] - self.hourly[:, hour]), self.hourly[:, hour])
+        self.weekly[:, day] = np.where(ok, self.weekly[:, day] + self.delta*(residual - self.hourly[:, hour] - self.weekly[:, day]), self.weekly[:, day])
+        self.variance = np.where(ok, (1 - self.beta)*self.variance + self.beta*error**2, self.variance)
+
+
+    def predict(self, hours: int = 48) -> tuple:
+        """
+        Forecasts every series for the next `hours` hours.
+
+        Returns
+        -------
+        `times`: The forecast times, as a `datetime64[m]` array of length `hours`.
+        `mean`, `lower`, `upper`: Arrays of shape `(N, hours)` with the point forecast and the band around it, in prices.
+        """
+        if self.level is None:
+            raise ValueError(f"\n>> The forecaster must be fitted before it can predict.\n")
+        steps = np.arange(1, hours + 1)
+        times = self.lastTime + steps.astype("timedelta64[h]")
+        center = self.level[:, None] + self.hourly[:, _hour(times)] + self.weekly[:, _weekday(times)]
+        spread = self.z * np.sqrt(self.variance[:, None] * (1 + (steps - 1) * self.alpha**2))
+        return times, np.exp(center), np.exp(center - spread), np.exp(center + spread)
+
+
+    def save(self, path: str, **extra) -> None:
+        """
+        Saves the fitted state, and any `extra` arrays, to a `.npz` file.
+        """
+        np.savez(path, level=self.level, hourly=self.hourly, weekly=self.weekly, variance=self.variance, lastTime=np.datetime64(self.lastTime, "m"),
+                 params=np.array([self.alpha, self.gamma, self.delta, self.beta, self.z]), **extra)
+
+
+    @classmethod
+    def load(cls, path: str) -> "Forecaster":
+        """
+        Loads a state saved with `save`.
+        """
+        with np.load(path) as f:
+            model = cls(*f["params"])
+            model.level, model.hourly, model.weekly, model.variance = f["level"], f["hourly"], f["weekly"], f["variance"]
+            lastTime = f["lastTime"][()]
+            model.lastTime = None if np.isnat(lastTime) else lastTime
+        return model
+
+
+
+
+
+class StoreForecaster:
+    """
+    A `Forecaster` of every `(item, market)` pair of a watchlist, fitted from the local history store and then kept current from it:
+    each newer scan costs one O(1) `Forecaster.update` step per series instead of a refit.
+
+    If `path` is given, the state is saved there after every update, and picked up again by the next `StoreForecaster` of the same watchlist.
+    """
+
+    def __init__(self, watchlist: Watchlist, historyStore: store.HistoryStore = None, numDays: int = 28, path: str = None, **params):
+        """
+        Parameters
+        ----------
+        `watchlist`: The items and markets to forecast.
+        `historyStore`: The store to read scans from.  Default is the shared store read by `ah.data`.
+        `numDays`: The days of stored scans to fit when there is no saved state to resume, and to fold in for series not seen yet.  Default is `28`.
+        `path`: Optional `.npz` file the state is saved to and resumed from.  Default is `None`.
+        `**params`: Smoothing parameters passed on to `Forecaster`.
+        """
+        self.store = historyStore or store.default_store()
+        self.numDays = numDays
+        self.path = path
+        self.labels, self.series = [], []
+        for item, market in watchlist.pairs():
+            if isinstance(market, tuple):
+                self.labels.append((item, f"{market[0]}-{market[1]}"))
+                self.series.append(store.server_source(item, *market)[:2])
+            else:
+                self.labels.append((item, market))
+                self.series.append(store.region_source(item, market)[:2])
+        if not (path and os.path.exists(path) and self._resume(path)):
+            self.fit(numDays, **params)
+
+
+    def fit(self, numDays: int = 28, **params) -> "StoreForecaster":
+        """
+        Fits the model from scratch to the last `numDays` days of stored scans.
+        """
+        since = (datetime.datetime.utcnow() - datetime.timedelta(days=numDays)).strftime(store.ISO_FORMAT)
+        times, prices = self._grid([since] * len(self.series))
+        self.model = Forecaster(**params).fit(times, prices)
+        # the local hour of the newest scan already folded in, per series, in minutes since the epoch
+        stamps = np.where(np.isnan(prices), -1, times.astype(np.int64))
+        self.seen = stamps.max(axis=1, initial=-1)
+        return self
+
+
+    def update(self) -> int:
+        """
+        Folds every stored scan from a later hour than the last one folded in into the model, one O(1) step per new hour.
+
+        Returns
+        -------
+        The number of series updated.
+        """
+        floor = (datetime.datetime.utcnow() - datetime.timedelta(days=self.numDays)).strftime(store.ISO_FORMAT)
+        # a day before the last local hour seen covers any UTC offset
+        times, prices = self._grid([floor if seen < 0 else np.datetime64(int(seen) - 1440, "m").item().strftime(store.ISO_FORMAT) for seen in self.seen])
+        prices[times.astype(np.int64)[None, :] <= self.seen[:, None]] = np.nan
+        fresh = ~np.isnan(prices)
+        for t in np.flatnonzero(fresh.any(axis=0)):
+            self.model.update(times[t], prices[:, t])
+        self.seen = np.maximum(self.seen, np.where(fresh, times.astype(np.int64), -1).max(axis=1, initial=-1))
+        if self.path:
+            self.save(self.path)
+        return int(fresh.any(axis=1).sum())
+
+
+    def predict(self, hours: int = 48) -> dict:
+        """
+        Forecasts every pair for the next `hours` hours.
+
+        Returns
+        -------
+        As `forecast`, keyed by `(item, "Realm-Faction")` and `(item, region)`.
+        """
+        times, mean, lower, upper = self.model.predict(hours)
+        return {label: {"times": times, "prices": mean[i], "lower": lower[i], "upper": upper[i]} for i, label in enumerate(self.labels)}
+
+
+    def save(self, path: str) -> None:
+        """
+        Saves the model, with the series it covers and the newest scan hour folded in for each.
+        """
+        self.model.save(path, keys=np.array([f"{market}/{slug}" for market, slug in self.series]), seen=self.seen)
+
+
+    def _grid(self, starts: list) -> tuple:
+        """
+        Reads the stored scans of each series from its UTC timestamp in `starts` onto one local hourly grid, as `(times, prices)` of shapes `(T,)` and `(N, T)`.
+        """
+        histories = {(i, 0): PriceSeries.from_payload(self.store.read(market, slug, start), timezone=self.store.timezone)
+                     for i, ((market, slug), start) in enumerate(zip(self.series, starts))}
+        times, prices = cube(histories, list(range(len(self.series))), [0], numHoursPerBucket=1)
+        return times, prices[:, 0, :]
+
+
+    def _resume(self, path: str) -> bool:
+        """
+        Loads the state saved at `path`, if it covers exactly this watchlist's series.  Returns whether it did.
+        """
+        with np.load(path) as f:
+            if f["keys"].tolist() != [f"{market}/{slug}" for market, slug in self.series]:
+                return False
+            self.seen = f["seen"]
+        self.model = Forecaster.load(path)
+        return True
+
+
+
+
+
+def forecast(histories: dict, hours: int = 48, **params) -> dict:
+    """
+    Fits one `Forecaster` to many price histories at once and forecasts each of them.
+
+    Parameters
+    ----------
+    `histories`: Dictionary mapping any key to a `PriceSeries` (or dict of lists).
+    `hours`: The number of hours to forecast.  Default is `48`.
+    `**params`: Smoothing parameters passed on to `Forecaster`.
+
+    Returns
+    -------
+    Dictionary mapping each key to a dictionary of the form:
+    >>> {"times": array([...], dtype='datetime64[m]'), "prices": array([...]), "lower": array([...]), "upper": array([...])}
+    """
+    keys = list(histories)
+    times, prices = cube({(key, 0): series for key, series in histories.items()}, keys, [0], numHoursPerBucket=1)
+    if not len(times):
+        return {}
+    model = Forecaster(**params).fit(times, prices[:, 0, :])
+    times, mean, lower, upper = model.predict(hours)
+    return {key: {"times": times, "prices": mean[i], "lower": lower[i], "upper": upper[i]} for i, key in enumerate(keys)}
+
+
+def forecast_watchlist(watchlist: Watchlist, numDays: int = 28, hours: int = 48, maxWorkers: int = 8, **params) -> dict:
+    """
+    Forecasts every item of `watchlist` on every tracked server and in its first region, from the last `numDays` days of scans.
+
+    Returns
+    -------
+    As `forecast`, keyed by `(item, "Realm-Faction")` and `(item, region)`.
+    """
+    histories, regionHistories = load(watchlist, numDays, maxWorkers)
+    return forecast({**histories, **regionHistories}, hours, **params)
+
+
+
+
+
+def _log(prices) -> np.ndarray:
+    """
+    Returns the log of the prices, with `nan` for missing or non-positive prices.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(prices > 0, np.log(prices), np.nan)
+
+
+def _hour(times) -> np.ndarray:
+    return (np.asarray(times, dtype="datetime64[m]").astype(np.int64) // 60) % 24
+
+
+def _weekday(times) -> np.ndarray:
+    return (np.asarray(times, dtype="datetime64[m]").astype(np.int64) // 1440 + EPOCH_WEEKDAY) % 7
+
+
+def _profile(residual: np.ndarray, slots: np.ndarray, numSlots: int) -> np.ndarray:
+    """
+    Returns the mean of each series' residuals in each slot (e.g. each hour of the day), centred to sum to zero.
+    Slots without data (e.g. odd hours of a series averaged over 2 hours) are interpolated from their neighbours, wrapping around.
+    """
+    valid = ~np.isnan(residual)
+    sums = np.zeros((len(residual), numSlots))
+    counts = np.zeros((len(residual), numSlots))
+    np.add.at(sums.T, slots, np.where(valid, residual, 0).T)
+    np.add.at(counts.T, slots, valid.T)
+    profile = sums / np.maximum(counts, 1)
+    # nearest slots with data before and after each slot, searched over three laps so that it wraps around
+    index = np.arange(3*numSlots)
+    filled = np.tile(counts > 0, 3)
+    before = np.maximum.accumulate(np.where(filled, index, -1), axis=1)[:, numSlots:2*numSlots]
+    after = np.minimum.accumulate(np.where(filled, index, 3*numSlots)[:, ::-1], axis=1)[:, ::-1][:, numSlots:2*numSlots]
+    known = before >= 0
+    weight = np.where(known, (index[numSlots:2*numSlots] - before) / np.maximum(after - before, 1), 0)
+    before, after = np.where(known, before % numSlots, 0), np.where(known, after % numSlots, 0)
+    profile = np.take_along_axis(profile, before, axis=1) * (1 - weight) + np.take_along_axis(profile, after, axis=1) * weight
+    profile = np.where(known, profile, 0)
+    return profile - profile.mean(axis=1, keepdims=True)
+
+
+
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Forecast the prices of a watchlist.")
+    parser.add_argument("watchlist", help="Path of the watchlist JSON file.")
+    parser.add_argument("--days", type=int, default=28, help="Days of history to fit.")
+    parser.add_argument("--hours", type=int, default=48, help="Hours to forecast.")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum concurrent requests.")
+    args = parser.parse_args()
+    results = forecast_watchlist(Watchlist.load(args.watchlist), args.days, args.hours, args.workers)
+    for (item, market), f in sorted(results.items()):
+        if np.isnan(f["prices"][-1]):
+            continue
+        print(f"{item:<30} {market:<24} in {args.hours} h: {f['prices'][-1]:>12.0f}   ({f['lower'][-1]:.0f} - {f['upper'][-1]:.0f})")
+
+
+
+if __name__ == "__main__":
+    main()
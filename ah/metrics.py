@@ -0,0 +1,208 @@
+"""
+metrics.py
+==========
+
+Lightweight per-stage instrumentation: span timings, counters (rows, bytes downloaded, ...), cache statistics and optional memory deltas.
+
+Everything is off by default, in which case spans and counters cost a single flag check.  Turn it on with the `AH_METRICS=1`
+environment variable (`AH_METRICS=memory` also traces memory deltas), or with `metrics.enable()`.
+
+Examples
+--------
+>>> with metrics.span("fetch"):
+>>>     ...
+>>> metrics.count("bytes_downloaded", len(body))
+>>> print(metrics.render_prometheus())
+"""
+import os
+import time
+import threading
+import functools
+import tracemalloc
+from contextlib import nullcontext
+
+ENABLED = os.environ.get("AH_METRICS", "0").lower() not in ("", "0", "false", "no")
+MEMORY = os.environ.get("AH_METRICS", "").lower() == "memory"
+
+_lock = threading.Lock()
+_spans = {}             # stage -> [calls, totalSeconds, maxSeconds, memoryDeltaBytes]
+_counters = {}          # name -> total
+_collectors = {}        # name -> function returning a dict of gauges, e.g. a cache's `stats`
+_NULL = nullcontext()
+
+
+
+
+
+def enable(on: bool = True, memory: bool = False) -> None:
+    """
+    Turns instrumentation on or off.
+
+    Parameters
+    ----------
+    `on`: Whether or not to record spans and counters.  Default is `True`.
+    `memory`: Whether or not to also record each span's change in traced memory.  Starts `tracemalloc`, which slows everything down.  Default is `False`.
+    """
+    global ENABLED, MEMORY
+    ENABLED = on
+    MEMORY = on and memory
+    if MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+
+
+
+class _Span:
+    """
+    Context manager recording the duration (and optionally memory delta) of one stage.
+    """
+    __slots__ = ("stage", "start", "memory")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.memory = tracemalloc.get_traced_memory()[0] if MEMORY and tracemalloc.is_tracing() else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        delta = tracemalloc.get_traced_memory()[0] - self.memory if self.memory is not None else 0
+        with _lock:
+            entry = _spans.setdefault(self.stage, [0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            entry[3] += delta
+        return False
+
+
+def span(stage: str):
+    """
+    Returns a context manager timing the enclosed block as `stage`, or a no-op one if instrumentation is off.
+    """
+    return _Span(stage) if ENABLED else _NULL
+
+
+def timed(stage: str) -> callable:
+    """
+    Decorator timing every call of the decorated function as `stage`.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _Span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: float = 1) -> None:
+    """
+    Adds `value` to the counter `name`, if instrumentation is on.
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def register(name: str, collector: callable) -> None:
+    """
+    Registers a function returning a dict of numeric gauges (e.g. `TTLCache.stats`) to include in every snapshot under `name`.
+    """
+    _collectors[name] = collector
+
+
+
+
+
+def snapshot() -> dict:
+    """
+    Returns the current metrics.
+
+    Returns
+    -------
+    Dictionary of the form:
+    >>> {
+    >>>     "spans": {"fetch": {"calls": 3, "seconds": 0.81, "maxSeconds": 0.4, "memoryBytes": 0}, ...},
+    >>>     "counters": {"bytes_downloaded": 123456, "rows_downloaded": 2160, ...},
+    >>>     "gauges": {"api_cache": {"hits": 12, "misses": 3, ...}, ...}
+    >>> }
+    """
+    with _lock:
+        spans = {stage: {"calls": e[0], "seconds": e[1], "maxSeconds": e[2], "memoryBytes": e[3]} for stage,e in _spans.items()}
+        counters = dict(_counters)
+    gauges = {name: collector() for name,collector in _collectors.items()}
+    return {"spans": spans, "counters": counters, "gauges": gauges}
+
+
+def reset() -> None:
+    """
+    Clears all recorded spans and counters.
+    """
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+def render_prometheus() -> str:
+    """
+    Returns the current metrics in the Prometheus text exposition format.
+    """
+    data = snapshot()
+    lines = [
+        "# TYPE ah_stage_calls_total counter",
+        *(f'ah_stage_calls_total{{stage="{s}"}} {v["calls"]}' for s,v in sorted(data["spans"].items())),
+        "# TYPE ah_stage_seconds_total counter",
+        *(f'ah_stage_seconds_total{{stage="{s}"}} {v["seconds"]:.6f}' for s,v in sorted(data["spans"].items())),
+        "# TYPE ah_stage_seconds_max gauge",
+        *(f'ah_stage_seconds_max{{stage="{s}"}} {v["maxSeconds"]:.6f}' for s,v in sorted(data["spans"].items())),
+    ]
+    if MEMORY:
+        lines.append("# TYPE ah_stage_memory_bytes_total counter")
+        lines.extend(f'ah_stage_memory_bytes_total{{stage="{s}"}} {v["memoryBytes"]}' for s,v in sorted(data["spans"].items()))
+    for name, value in sorted(data["counters"].items()):
+        lines.append(f"# TYPE ah_{name}_total counter")
+        lines.append(f"ah_{name}_total {value}")
+    for name, gauges in sorted(data["gauges"].items()):
+        for key, value in sorted(gauges.items()):
+            lines.append(f'ah_{key}{{source="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def write(path: str) -> None:
+    """
+    Writes the current metrics in the Prometheus text format to `path` (e.g. for the node exporter's textfile collector).
+    """
+    with open(path + ".tmp", "w") as f:
+        f.write(render_prometheus())
+    os.replace(path + ".tmp", path)
+
+
+def serve(port: int = 9108, host: str = "127.0.0.1"):
+    """
+    Serves the current metrics at `http://<host>:<port>/metrics` from a daemon thread, and returns the server.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            found = self.path.split("?")[0] == "/metrics"
+            body = render_prometheus().encode() if found else b"Not Found\n"
+            self.send_response(200 if found else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -4,19 +4,24 @@ misc.py
 
 Functions/classes used elsewhere that didn't have a home.
 """
+import pytz
+import numpy as np
+import ah.metrics as metrics
 from math import floor
+from functools import lru_cache
 
 
 
-def weighted_average(values: list, weights: list) -> float:
+def weighted_average(values: list, weights: list, axis: int = None) -> float:
     """
     Returns the weighted average of a list of values and a list of weights.
-    Note:  The weights don't have to sum to 1, but `values` and `weights` must have the same length.
+    Note:  The weights don't have to sum to 1, but `values` and `weights` must have the same length.
 
     Parameters
     ----------
-    `values` :   The list of values to compute the average of.
-    `weights` :   The list of weights to assign to each value.
+    `values` :   The list of values to compute the average of.  Can also be an array of many series.
+    `weights` :   The list of weights to assign to each value.
+    `axis` :   The axis to average along, for arrays of many series (ex: `-1` for one average per row).  Default is `None`, i.e. everything.
     
     Examples
     --------
@@ -24,13 +29,56 @@ def weighted_average(values: list, weights: list) -> float:
         6.0
     >>> weighted_average([4, 4, 8],  [1/4, 1/4, 1/2])
         6.0
+    >>> weighted_average([[3, 6], [4, 8]],  [[1, 1], [1, 3]],  axis=-1)
+        array([4.5, 7. ])
     """
-    if len(values) != len(weights):
+    values, weights = np.asarray(values, dtype=np.float64), np.asarray(weights, dtype=np.float64)
+    if values.shape != weights.shape:
         raise ValueError(f"\n>> `values` and `weights` must have the same length ({len(values)} vs {len(weights)}).\n")
-    total = 0
-    for value,weight in zip(values,weights):
-        total += value*weight
-    return total / sum(weights)
+    result = np.sum(values*weights, axis=axis) / np.sum(weights, axis=axis)
+    return float(result) if np.ndim(result) == 0 else result
+
+
+
+
+
+def rolling_weighted_average(values: np.ndarray, weights: np.ndarray, window: int, minWeight: float = 0) -> np.ndarray:
+    """
+    Returns the weighted average of every trailing `window` of values, along the last axis, in O(1) per window.
+    With prices and quantities this is the rolling volume-weighted average price (VWAP).
+
+    Running sums of `values*weights` and of `weights` are taken once, and each window's sums are the difference of two of them.
+    Missing (`nan`) values or weights count as a weight of `0`.
+
+    Parameters
+    ----------
+    `values`:   Array of values, or a 2-D array of many series (one per row).
+    `weights`:   Array of weights of the same shape.
+    `window`:   The number of points in each window.  The first `window-1` points use the shorter window available.
+    `minWeight`:   Windows with a total weight of at most this are `nan`.  Default is `0`.
+
+    Examples
+    --------
+    >>> rolling_weighted_average([10, 20, 30], [1, 1, 2], 2)
+        array([10. , 15. , 26.66666667])
+    """
+    values, weights = np.asarray(values, dtype=np.float64), np.asarray(weights, dtype=np.float64)
+    if values.shape != weights.shape:
+        raise ValueError(f"\n>> `values` and `weights` must have the same shape ({values.shape} vs {weights.shape}).\n")
+    if window < 1:
+        raise ValueError(f"\n>> `window` must be at least 1, not {window}.\n")
+    valid = ~(np.isnan(values) | np.isnan(weights))
+    weights = np.where(valid, weights, 0)
+    pad = [(0, 0)] * (values.ndim - 1) + [(1, 0)]
+    weighted = np.pad(np.cumsum(np.where(valid, values, 0) * weights, axis=-1), pad)
+    total = np.pad(np.cumsum(weights, axis=-1), pad)
+    n = values.shape[-1]
+    end = np.arange(1, n+1)
+    start = np.maximum(end - window, 0)
+    weightSums = total[..., end] - total[..., start]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result = (weighted[..., end] - weighted[..., start]) / weightSums
+    return np.where(weightSums > minWeight, result, np.nan)
 
 
 
@@ -62,24 +110,99 @@ def normalize(value,rangeStart,rangeEnd):
 
 
 
-def fix_bad_data(data1: list, data2: list, threshold: int = 3) -> list:
+@metrics.timed("timezone")
+def utc_to_local(timestamps: list, timezone: str = "US/Eastern") -> np.ndarray:
+    """
+    Converts NexusHub's UTC `scannedAt` strings to naive local times, in one batched step.
+    Seconds are truncated, matching the `"%m-%d-%Y %H:%M"` resolution used elsewhere.
+
+    Parameters
+    ----------
+    `timestamps`:   Sequence of ISO 8601 UTC strings of the form `2022-10-12T14:00:00.000Z`, or a `datetime64` array of UTC times.
+    `timezone`:   Any `pytz` timezone name.  Default is `US/Eastern`.
+
+    Returns
+    -------
+    A `numpy` array of `datetime64[m]` local times.
+
+    Examples
+    --------
+    >>> utc_to_local(["2022-10-12T14:00:00.000Z", "2022-12-01T14:00:00.000Z"])
+        array(['2022-10-12T10:00', '2022-12-01T09:00'], dtype='datetime64[m]')
+    """
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind == "M":
+        utc = timestamps.astype("datetime64[s]")
+    else:
+        utc = np.char.rstrip(timestamps.astype(str), "Z").astype("datetime64[s]")
+    transitions, offsets = _transition_table(timezone)
+    index = np.searchsorted(transitions, utc, side="right") - 1
+    return (utc + offsets[np.maximum(index, 0)]).astype("datetime64[m]")
+
+
+@lru_cache(maxsize=None)
+def _transition_table(timezone: str) -> tuple:
+    """
+    Returns the UTC transition times of `timezone` and the UTC offset in effect from each one, as `numpy` arrays.
+    """
+    tz = pytz.timezone(timezone)
+    if not hasattr(tz, "_utc_transition_times"):     # Fixed-offset zone, e.g. UTC.
+        offset = int(tz.utcoffset(Datetime.datetime(2000, 1, 1)).total_seconds())
+        return np.array(["0001-01-01"], dtype="datetime64[s]"), np.array([offset], dtype="timedelta64[s]")
+    transitions = np.array(tz._utc_transition_times, dtype="datetime64[s]")
+    offsets = np.array([int(info[0].total_seconds()) for info in tz._transition_info], dtype="timedelta64[s]")
+    return transitions, offsets
+
+
+
+
+
+@metrics.timed("repair")
+def fix_bad_data(data1: list, data2: list, threshold: int = 3, seed: int = None, window: int = 12) -> np.ndarray:
     """
     Fixes bad data in a list. `data1` is the good data (server prices), and `data2` is the bad data (region prices).
     `threshold` is the maximum multiple-difference between the two lists before the bad data is fixed.
+
+    Every region price more than `threshold` times the server price above it (after the first `window` points) is replaced
+    by the last good region price before it.  All points are flagged and filled at once, so the result is deterministic.
+
+    Parameters
+    ----------
+    `data1`:   The server prices.  Either one series, or a matrix with one item per row.
+    `data2`:   The region prices, with the same shape as `data1`.  Not modified.
+    `threshold`:   The multiple of the server price the region/server difference may reach before a point is flagged.  Default is `3`.
+    `seed`:   If given, filled points are jittered by up to ±1 standard deviation of the preceding `window` region/server differences,
+              drawn from a generator seeded with `seed`.  Default is `None`, meaning no jitter.
+    `window`:   The number of leading points that are never flagged, and the length of the jitter's standard deviation window.  Default is `12`.
+
+    Returns
+    -------
+    A new `numpy` array of fixed region prices, with the same shape as `data2`.
     """
-    import numpy as np
-    serverPrices = data1
-    regionPrices = data2
-    for i in range(len(serverPrices)):
-        diff = regionPrices[i] - serverPrices[i]
-        if diff > threshold*serverPrices[i] and i > 12:
-            lastGoodRegionPrice = regionPrices[i-1]
-            last12diffs = [regionPrices[x] - serverPrices[x] for x in range(i-12,i)]
-            for j in range(i, len(serverPrices)):
-                if (regionPrices[j] - serverPrices[j]) > threshold*serverPrices[j]:
-                    plusMinus1Stdev = (np.random.rand() * 2 - 1) * np.std(last12diffs)
-                    regionPrices[j] = lastGoodRegionPrice + plusMinus1Stdev
-    return regionPrices
+    serverPrices = np.asarray(data1, dtype=np.float64)
+    regionPrices = np.array(data2, dtype=np.float64)
+    diffs = regionPrices - serverPrices
+    bad = diffs > threshold*serverPrices
+    bad[..., :window+1] = False
+    if not bad.any():
+        return regionPrices
+    # index of the last good point at or before each point, carried forward along the time axis
+    index = np.broadcast_to(np.arange(regionPrices.shape[-1]), regionPrices.shape)
+    lastGood = np.maximum.accumulate(np.where(bad, 0, index), axis=-1)
+    fixed = np.where(bad, np.take_along_axis(regionPrices, lastGood, axis=-1), regionPrices)
+    if seed is not None:
+        # rolling standard deviation of the fixed differences over the `window` points ending at each last good point
+        fixedDiffs = fixed - serverPrices
+        zero = np.zeros(fixedDiffs.shape[:-1] + (1,))
+        sums = np.concatenate((zero, np.cumsum(fixedDiffs, axis=-1)), axis=-1)
+        squares = np.concatenate((zero, np.cumsum(fixedDiffs**2, axis=-1)), axis=-1)
+        start = lastGood + 1 - window
+        total = np.take_along_axis(sums, lastGood + 1, axis=-1) - np.take_along_axis(sums, start, axis=-1)
+        totalSquares = np.take_along_axis(squares, lastGood + 1, axis=-1) - np.take_along_axis(squares, start, axis=-1)
+        stdDevs = np.sqrt(np.maximum(totalSquares/window - (total/window)**2, 0))
+        noise = np.random.default_rng(seed).uniform(-1, 1, regionPrices.shape) * stdDevs
+        fixed = np.where(bad, fixed + noise, fixed)
+    return fixed
 
 
 """
@@ -191,3 +314,53 @@ class Datetime:
         Returns the number of seconds from now until the next minute.
         """
         return 60-(Datetime.datetime.now().second)
+
+
+
+
+
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket limiting how often something may happen.
+
+    Examples
+    --------
+    >>> limiter = RateLimiter(5)       # at most 5 calls per second on average
+    >>> limiter.wait()                 # blocks until a call is allowed
+    """
+    import time
+    import threading
+
+
+    def __init__(self, rate: float, burst: int = None):
+        """
+        Parameters
+        ----------
+        `rate`:   The average number of calls allowed per second.
+        `burst`:   The number of calls allowed back-to-back after a quiet period.  Default is `rate` rounded up.
+        """
+        if rate <= 0:
+            raise ValueError(f"\n>> `rate` must be positive, not {rate}.\n")
+        self.rate = rate
+        self.burst = burst or max(1, int(rate + 0.999))
+        self._tokens = float(self.burst)
+        self._last = RateLimiter.time.monotonic()
+        self._lock = RateLimiter.threading.Lock()
+
+
+    def wait(self) -> None:
+        """
+        Blocks until a call is allowed, then uses up one token.
+        """
+        while True:
+            with self._lock:
+                now = RateLimiter.time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            RateLimiter.time.sleep(delay)
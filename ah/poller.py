@@ -0,0 +1,174 @@
+"""
+poller.py
+=========
+
+Long-running poller that refreshes a watchlist into the local history store shortly after every NexusHub scan,
+so the plots are served from disk instead of waiting on NexusHub.
+
+Usage:
+>>> python -m ah.poller watchlist.json --days 40 --workers 8 --rate 5
+"""
+import time
+import random
+import argparse
+import ah.api as api
+import ah.store as store
+from ah.archive import Archive
+from ah.alerts import AlertEngine
+from ah.forecast import StoreForecaster
+from concurrent.futures import ThreadPoolExecutor
+from ah.misc import Datetime, RateLimiter
+from ah.watchlist import Watchlist
+
+
+
+
+
+class Poller:
+    """
+    Refreshes every `(item, market)` pair of a watchlist into a `HistoryStore` once per scan interval.
+
+    Each cycle wakes `offset` seconds (plus up to `jitter` random seconds) after the top of the hour, when the new scan is expected,
+    and refreshes all pairs on a bounded thread pool.  Requests are rate limited, and failed requests are retried with exponential backoff.
+    """
+
+    def __init__(self, watchlist: Watchlist, historyStore: store.HistoryStore = None, days: int = 40, maxWorkers: int = 8, rate: float = 5,
+                 offset: int = 300, jitter: int = 120, retries: int = 4, backoff: float = 2, archive: Archive = None,
+                 alerts: AlertEngine = None, forecaster: StoreForecaster = None):
+        """
+        Parameters
+        ----------
+        `watchlist`: The items and markets to keep up to date.
+        `historyStore`: The store to write to.  Default is the shared store read by `ah.data`.
+        `days`: The number of days of history to keep covered for each pair.  Default is `40`; longer app charts are read from the store's rollups.
+        `maxWorkers`: The maximum number of requests in flight at once.  Default is `8`.
+        `rate`: The maximum average number of requests per second.  Default is `5`.
+        `offset`: Seconds after the top of the hour to wake up at.  Default is `300`.
+        `jitter`: Maximum random extra seconds added to each wake-up, so several pollers don't hit NexusHub at once.  Default is `120`.
+        `retries`: Number of times a failed request is retried.  Default is `4`.
+        `backoff`: Seconds to wait before the first retry; doubled for each following one.  Default is `2`.
+        `archive`: Optional binary `Archive` that every new scan is also appended to.  Default is `None`.
+        `alerts`: Optional `AlertEngine` checked against the newest scans after every poll.  Default is `None`.
+        `forecaster`: Optional `StoreForecaster` updated with the newest scans after every poll.  Default is `None`.
+        """
+        self.watchlist = watchlist
+        self.store = historyStore or store.default_store()
+        self.days = days
+        self.maxWorkers = maxWorkers
+        self.limiter = RateLimiter(rate)
+        self.offset = offset
+        self.jitter = jitter
+        self.retries = retries
+        self.backoff = backoff
+        self.archive = archive
+        self.alerts = alerts
+        self.forecaster = forecaster
+
+
+    def poll(self) -> dict:
+        """
+        Refreshes every pair of the watchlist once, then checks the alert rules and updates the forecasts, if any.
+
+        Returns
+        -------
+        Dictionary of the form:
+        >>> {"pairs": 1000, "scans": 980, "failed": 2, "alerts": 3, "seconds": 41.3}
+        """
+        start = time.monotonic()
+        api.reserve_connections(self.maxWorkers)
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            results = list(pool.map(lambda pair: self.refresh(*pair), self.watchlist.pairs()))
+        failed = sum(r is None for r in results)
+        alerts = self.alerts.check(self.store) if self.alerts is not None else []
+        if self.forecaster is not None:
+            self.forecaster.update()
+        return {"pairs": len(results), "scans": sum(r for r in results if r), "failed": failed, "alerts": len(alerts), "seconds": round(time.monotonic() - start, 1)}
+
+
+    def refresh(self, item: str, market) -> int:
+        """
+        Refreshes one `(item, market)` pair, retrying with exponential backoff if NexusHub or the store fails
+        (e.g. "database is locked" while another process writes the same store).
+
+        Returns
+        -------
+        The number of new scans stored, or `None` if every attempt failed.
+        """
+        market, slug, url = store.server_source(item, *market) if isinstance(market, tuple) else store.region_source(item, market)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2**(attempt-1) * random.uniform(0.5, 1.5))
+            self.limiter.wait()
+            try:
+                added = self.store.refresh(market, slug, self.days, url, force=True)
+                if added is not None:
+                    if self.archive is not None:
+                        self.archive.sync(self.store, market, slug)
+                    return added
+            except Exception as e:
+                print(f"{item} on {market}: {e}")
+        return None
+
+
+    def seconds_until_next_poll(self) -> float:
+        """
+        Returns the number of seconds until the next scan is expected to be available, plus jitter.
+        """
+        seconds = Datetime.seconds_until_next_hour() + self.offset
+        if seconds > 3600:          # this hour's scan is still to come
+            seconds -= 3600
+        return seconds + random.uniform(0, self.jitter)
+
+
+    def run(self, once: bool = False) -> None:
+        """
+        Polls immediately, then again after every expected scan, until interrupted.  A poll that fails is printed and skipped.
+
+        Parameters
+        ----------
+        `once`: If `True`, poll only once and return.
+        """
+        while True:
+            try:
+                summary = self.poll()
+            except Exception as e:
+                print(f"[{Datetime.now()}] poll failed: {e}")
+            else:
+                print(f"[{Datetime.now()}] refreshed {summary['pairs']} pairs: {summary['scans']} new scans, {summary['failed']} failed, {summary['alerts']} alerts, {summary['seconds']} s")
+            if once:
+                return
+            time.sleep(self.seconds_until_next_poll())
+
+
+
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Keep the local history store up to date for a watchlist.")
+    parser.add_argument("watchlist", help="Path of the watchlist JSON file.")
+    parser.add_argument("--db", default=store.DEFAULT_PATH, help="Path of the history store.")
+    parser.add_argument("--days", type=int, default=40, help="Days of history to keep covered.")
+    parser.add_argument("--workers", type=int, default=8, help="Maximum concurrent requests.")
+    parser.add_argument("--rate", type=float, default=5, help="Maximum requests per second.")
+    parser.add_argument("--offset", type=int, default=300, help="Seconds after the hour to poll at.")
+    parser.add_argument("--jitter", type=int, default=120, help="Maximum random extra seconds per poll.")
+    parser.add_argument("--archive", default=None, help="Folder of a binary archive to also append new scans to, and read them back from.")
+    parser.add_argument("--alerts", default=None, help="Path of a JSON file of alert rules to check after every poll.")
+    parser.add_argument("--forecast", default=None, help="Path of a .npz file to keep the watchlist's forecasts current in.")
+    parser.add_argument("--once", action="store_true", help="Poll once and exit.")
+    args = parser.parse_args()
+    watchlist = Watchlist.load(args.watchlist)
+    archive = Archive(args.archive) if args.archive else None
+    historyStore = store.HistoryStore(args.db, archive=archive)
+    poller = Poller(watchlist, historyStore, args.days, args.workers, args.rate, args.offset, args.jitter,
+                    archive=archive, alerts=AlertEngine.load(args.alerts, watchlist, historyStore) if args.alerts else None,
+                    forecaster=StoreForecaster(watchlist, historyStore, path=args.forecast) if args.forecast else None)
+    try:
+        poller.run(once=args.once)
+    except KeyboardInterrupt:
+        pass
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+series.py
+=========
+
+Compact, column-oriented containers for price histories.
+"""
+import numpy as np
+import ah.metrics as metrics
+from ah.misc import utc_to_local
+
+
+
+
+
+class PriceSeries:
+    """
+    Price & quantity history of one item on one market, stored as contiguous `numpy` columns.
+
+    `times` is a `datetime64[m]` array, and `prices` (market value), `minBuyouts` and `quantities` are `float64` arrays of the same length.
+    Slicing returns a new `PriceSeries` whose columns are views of this one, so no data is copied.
+    For compatibility with the old dict-of-lists format, the columns can also be read as `series["prices"]`, `series["quantities"]` and `series["times"]`.
+
+    Examples
+    --------
+    >>> series = PriceSeries.from_payload(api.fetch(url))
+    >>> series[-48:]            # last 48 scans, as a view
+    >>> series["prices"]        # same as series.prices
+    """
+    __slots__ = ("times", "prices", "minBuyouts", "quantities")
+    FIELDS = ("times", "prices", "minBuyouts", "quantities")
+
+
+    def __init__(self, times, prices, minBuyouts = None, quantities = None):
+        """
+        Parameters
+        ----------
+        `times`: Scan times, as anything `numpy` can convert to `datetime64[m]`.
+        `prices`: Market values.
+        `minBuyouts`: Minimum buyouts.  Default is `None`, which fills the column with `nan`.
+        `quantities`: Quantities.  Default is `None`, which fills the column with `nan`.
+        """
+        self.times = np.asarray(times, dtype="datetime64[m]")
+        self.prices = np.asarray(prices, dtype=np.float64)
+        n = len(self.times)
+        self.minBuyouts = np.full(n, np.nan) if minBuyouts is None else np.asarray(minBuyouts, dtype=np.float64)
+        self.quantities = np.full(n, np.nan) if quantities is None else np.asarray(quantities, dtype=np.float64)
+        if not (n == len(self.prices) == len(self.minBuyouts) == len(self.quantities)):
+            raise ValueError(f"\n>> All columns of a `PriceSeries` must have the same length.\n")
+
+
+    @classmethod
+    @metrics.timed("parse")
+    def from_payload(cls, data: list, convert_timezone = True, rounded = True, timezone = "US/Eastern") -> "PriceSeries":
+        """
+        Builds a `PriceSeries` straight from the raw `data` list of a NexusHub price history response.
+
+        Parameters
+        ----------
+        `data`: Raw NexusHub rows, with UTC `scannedAt` strings.
+        `convert_timezone`: Whether or not to convert the timestamps to `timezone`.  Default is `True`.
+        `rounded`: Whether or not to round the values to the nearest copper/integer.  Default is `True`.
+        `timezone`: The `pytz` name of the local timezone.  Default is `US/Eastern`.
+        """
+        n = len(data)
+        scannedAt = [row["scannedAt"] for row in data]
+        if convert_timezone:
+            times = utc_to_local(scannedAt, timezone) if n else np.empty(0, dtype="datetime64[m]")
+        else:
+            times = np.char.rstrip(np.asarray(scannedAt, dtype=str), "Z").astype("datetime64[m]")
+        columns = [np.fromiter((row[field] for row in data), dtype=np.float64, count=n) for field in ("marketValue", "minBuyout", "quantity")]
+        if rounded:
+            columns = [np.round(column) for column in columns]
+        return cls(times, *columns)
+
+
+    @classmethod
+    def coerce(cls, data) -> "PriceSeries":
+        """
+        Returns `data` as a `PriceSeries`, converting it first if it is a dict of lists with `times`, `prices` and `quantities` keys.
+        """
+        if isinstance(data, cls):
+            return data
+        return cls(data["times"], data["prices"], data.get("minBuyouts"), data.get("quantities"))
+
+
+    @classmethod
+    def empty(cls) -> "PriceSeries":
+        """
+        Returns a `PriceSeries` with no scans.
+        """
+        return cls(np.empty(0, dtype="datetime64[m]"), np.empty(0))
+
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+
+    def __getitem__(self, key):
+        """
+        `series["prices"]` returns a column; any other key (slice, index array, boolean mask) selects rows and returns a new `PriceSeries`.
+        Slices are views and do not copy.
+        """
+        if isinstance(key, str):
+            if key not in self.FIELDS:
+                raise KeyError(key)
+            return getattr(self, key)
+        if isinstance(key, (int, np.integer)):
+            key = slice(key, key+1 if key != -1 else None)
+        return PriceSeries(self.times[key], self.prices[key], self.minBuyouts[key], self.quantities[key])
+
+
+    def __setitem__(self, key: str, value) -> None:
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        column = np.asarray(value, dtype="datetime64[m]" if key == "times" else np.float64)
+        if len(column) != len(self):
+            raise ValueError(f"\n>> `{key}` must have length {len(self)}, not {len(column)}.\n")
+        setattr(self, key, column)
+
+
+    def __repr__(self) -> str:
+        if not len(self):
+            return "PriceSeries([])"
+        return f"PriceSeries({len(self)} scans, {self.times[0]} to {self.times[-1]})"
+
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The total size of the columns, in bytes.
+        """
+        return self.times.nbytes + self.prices.nbytes + self.minBuyouts.nbytes + self.quantities.nbytes
+
+
+
+
+
+class Bars:
+    """
+    Open/high/low/close bars of a price history, one per time bucket, as returned by `ah.data.resample(..., how="ohlc")`.
+
+    `times` holds the start of each bucket, `quantities` the mean quantity listed during the bucket, and `counts` the number of scans it contains.
+    `mean` is the mean price, `vwap` the quantity-weighted mean price (the mean if nothing was listed), `volume` the total quantity over all scans, and `minBuyouts` the mean minimum buyout.
+    """
+    __slots__ = ("times", "open", "high", "low", "close", "quantities", "counts", "mean", "vwap", "volume", "minBuyouts")
+    FIELDS = ("times", "open", "high", "low", "close", "quantities", "counts", "mean", "vwap", "volume", "minBuyouts")
+
+
+    def __init__(self, times, open, high, low, close, quantities, counts, mean = None, vwap = None, volume = None, minBuyouts = None):
+        self.times = np.asarray(times, dtype="datetime64[m]")
+        self.open = np.asarray(open, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.quantities = np.asarray(quantities, dtype=np.float64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        n = len(self.times)
+        self.mean = np.full(n, np.nan) if mean is None else np.asarray(mean, dtype=np.float64)
+        self.vwap = np.full(n, np.nan) if vwap is None else np.asarray(vwap, dtype=np.float64)
+        self.volume = np.full(n, np.nan) if volume is None else np.asarray(volume, dtype=np.float64)
+        self.minBuyouts = np.full(n, np.nan) if minBuyouts is None else np.asarray(minBuyouts, dtype=np.float64)
+
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+
+    def __getitem__(self, key):
+        """
+        `bars["close"]` returns a column; any other key selects rows and returns a new `Bars`.  Slices are views.
+        """
+        if isinstance(key, str):
+            if key not in self.FIELDS:
+                raise KeyError(key)
+            return getattr(self, key)
+        return Bars(*(getattr(self, field)[key] for field in self.FIELDS))
+
+
+    def __repr__(self) -> str:
+        if not len(self):
+            return "Bars([])"
+        return f"Bars({len(self)} buckets, {self.times[0]} to {self.times[-1]})"
+
+
+    def to_series(self, price: str = "mean") -> PriceSeries:
+        """
+        Returns the bars as a `PriceSeries` of one point per bucket, using the `price` column (e.g. `mean`, `vwap` or `close`) as the prices.
+        """
+        return PriceSeries(self.times, self[price], self.minBuyouts, self.quantities)
@@ -0,0 +1,200 @@
+"""
+standin.py
+==========
+
+Small local stand-in for the NexusHub price history API, for developing, benchmarking and load testing without the live service.
+
+It serves `/wow-classic/v1/items/<market>/<item>/prices?timerange=<days>[&region=true]` with recorded responses (from a
+`RecordTransport` folder) when available, and otherwise with synthetic but deterministic hourly price histories.
+`/wow-classic/v1/items` lists the items of `ITEMS`, for the item catalog, and JSON posted to `/webhook` is kept in `server.webhooks`
+(for testing alert webhooks).
+Latency, error rate and history length are configurable.
+
+Usage:
+>>> python -m ah.standin --port 8800 --latency 0.05 --error-rate 0.01 --days 365
+>>> NEXUSHUB_URL=http://127.0.0.1:8800/wow-classic/v1 streamlit run app.py
+"""
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ah.transport import recording_path
+from ah.catalog import slugify
+
+PRICES_PATH = re.compile(r"^/wow-classic/v1/items/(?P<market>[^/]+)/(?P<item>[^/]+)/prices$")
+ITEMS_PATH = "/wow-classic/v1/items"
+WEBHOOK_PATH = "/webhook"
+ITEMS = [
+    (36912, "Saronite Ore"), (36910, "Titanium Ore"), (36909, "Cobalt Ore"), (36913, "Saronite Bar"), (41163, "Titanium Bar"),
+    (36916, "Cobalt Bar"), (36908, "Frost Lotus"), (36905, "Lichbloom"), (36906, "Icethorn"), (36903, "Adder's Tongue"),
+    (36901, "Goldclover"), (36904, "Tiger Lily"), (36907, "Talandra's Rose"), (37921, "Deadnettle"), (36860, "Eternal Fire"),
+    (35622, "Eternal Water"), (35624, "Eternal Earth"), (35623, "Eternal Air"), (35627, "Eternal Shadow"), (35625, "Eternal Life"),
+    (34054, "Infinite Dust"), (34052, "Dream Shard"), (34057, "Abyss Crystal"), (33470, "Frostweave Cloth"), (33568, "Borean Leather"),
+    (44128, "Arctic Fur"), (43013, "Chilled Meat"), (36918, "Scarlet Ruby"), (36921, "Autumn's Glow"), (36924, "Sky Sapphire"),
+]
+
+
+
+
+
+def synthetic_history(market: str, item: str, numDays: int, end: np.datetime64 = None) -> list:
+    """
+    Returns a synthetic NexusHub `data` list of hourly scans for the last `numDays` days.
+    The same market and item always produce the same prices, so results are reproducible.
+
+    Parameters
+    ----------
+    `market`: The market slug, e.g. `skyfury-alliance` or `us`.
+    `item`: The item slug.
+    `numDays`: The number of days of scans.
+    `end`: The time of the last scan.  Default is the start of the current UTC hour.
+    """
+    n = max(0, int(numDays) * 24)
+    end = np.datetime64("now", "h") if end is None else np.datetime64(end, "h")
+    seed = int.from_bytes(hashlib.sha1(f"{market}/{item}".encode()).digest()[:8], "little")
+    rng = np.random.default_rng(seed)
+    base = 10**rng.uniform(3, 6)
+    hours = np.arange(n)
+    # random walk with a daily cycle, in copper
+    walk = np.cumsum(rng.normal(0, 0.01, n))
+    marketValue = base * np.exp(walk - walk[-1] if n else walk) * (1 + 0.05*np.sin(2*np.pi*hours/24))
+    minBuyout = marketValue * rng.uniform(0.85, 1.0, n)
+    quantity = np.maximum(1, rng.poisson(max(1.0, 1e6/base), n) * (1 + 0.3*np.sin(2*np.pi*hours/24)))
+    times = np.datetime_as_string((end - np.arange(n)[::-1]).astype("datetime64[ms]"), unit="ms")
+    return [{"marketValue": float(m), "minBuyout": float(b), "quantity": float(q), "scannedAt": f"{t}Z"}
+            for m,b,q,t in zip(marketValue.round(2), minBuyout.round(2), quantity.round(0), times)]
+
+
+
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+    Request handler of the stand-in server.  Its settings are read from the server object (see `serve`).
+    """
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(max(0.0, random.gauss(server.latency, server.latency/4)))
+        if server.errorRate and random.random() < server.errorRate:
+            return self._send(500, {"error": "Internal Server Error"})
+        parts = urlsplit(self.path)
+        if parts.path.rstrip("/") == ITEMS_PATH:
+            return self._send(200, [{"itemId": itemId, "name": name, "uniqueName": slugify(name)} for itemId,name in ITEMS])
+        match = PRICES_PATH.match(parts.path)
+        if not match:
+            return self._send(404, {"error": "Not Found"})
+        if server.recordings:
+            path = recording_path(server.recordings, self.path)
+            if os.path.exists(path):
+                with open(path) as f:
+                    recording = json.load(f)
+                return self._send(recording["status"], recording["body"].encode())
+        query = parse_qs(parts.query)
+        timerange = int(query.get("timerange", ["7"])[0])
+        numDays = min(timerange, server.historyDays)
+        data = synthetic_history(match["market"], match["item"], numDays)
+        self._send(200, {"slug": match["item"], "data": data})
+
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip("/") != WEBHOOK_PATH:
+            return self._send(404, {"error": "Not Found"})
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            self.server.webhooks.append(json.loads(body))
+        except ValueError:
+            return self._send(400, {"error": "Bad Request"})
+        self._send(200, {"received": len(self.server.webhooks)})
+
+
+    def _send(self, status: int, payload) -> None:
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+
+
+
+def serve(host: str = "127.0.0.1", port: int = 8800, latency: float = 0.0, errorRate: float = 0.0, historyDays: int = 365,
+          recordings: str = None, verbose: bool = False, background: bool = False) -> ThreadingHTTPServer:
+    """
+    Starts the stand-in server.
+
+    Parameters
+    ----------
+    `host`, `port`: The address to listen on.  Port `0` picks a free port (see `server.server_address`).
+    `latency`: The mean number of seconds to wait before answering each request.  Default is `0`.
+    `errorRate`: The fraction of requests answered with a 500 error.  Default is `0`.
+    `historyDays`: The most days of synthetic history any item has.  Default is `365`.
+    `recordings`: Optional folder of responses saved by `RecordTransport`, served in preference to synthetic data.
+    `verbose`: Whether or not to log every request.  Default is `False`.
+    `background`: If `True`, serve from a daemon thread and return immediately; otherwise serve until interrupted.
+
+    Returns
+    -------
+    The server.  Its base URL for `ah.api.set_transport` is `http://<host>:<port>/wow-classic/v1`.
+    """
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.errorRate = errorRate
+    server.historyDays = historyDays
+    server.recordings = recordings
+    server.verbose = verbose
+    server.webhooks = []
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    return server
+
+
+def base_url(server: ThreadingHTTPServer) -> str:
+    """
+    Returns the NexusHub base URL of a running stand-in server.
+    """
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/wow-classic/v1"
+
+
+
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the NexusHub price history API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean seconds of latency per request.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with a 500.")
+    parser.add_argument("--days", type=int, default=365, help="Maximum days of synthetic history.")
+    parser.add_argument("--recordings", default=None, help="Folder of recorded responses to serve first.")
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args()
+    print(f"Serving http://{args.host}:{args.port}/wow-classic/v1")
+    serve(args.host, args.port, args.latency, args.error_rate, args.days, args.recordings, args.verbose)
+
+
+
+if __name__ == "__main__":
+    main()
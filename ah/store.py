@@ -0,0 +1,477 @@
+"""
+store.py
+========
+
+Local SQLite store of every NexusHub scan seen so far, so that only new scans have to be requested upstream.
+
+The store can be mirrored into a binary `ah.archive.Archive` (see `ah.poller --archive`); the scans the archive holds are then read from its
+memory map instead of SQLite.  The shared store uses the archive folder in the `AH_ARCHIVE` environment variable, if set:
+>>> AH_ARCHIVE=archive/ streamlit run app.py
+"""
+import os
+import sqlite3
+import datetime
+import threading
+import numpy as np
+from math import ceil
+import ah.api as api
+import ah.data as data
+import ah.catalog as catalog
+from ah.misc import utc_to_local
+from ah.archive import Archive
+from ah.series import PriceSeries, Bars
+
+DEFAULT_PATH = "history.db"
+ARCHIVE_PATH = os.environ.get("AH_ARCHIVE")        # Archive folder read by the shared store, if any.
+SCAN_INTERVAL = 3600        # NexusHub scans each realm roughly once an hour.
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+TIERS = {"2h": 120, "1d": 1440, "1w": 10080}        # rollup tier -> bucket width, in minutes
+RESOLUTION = 300            # Points a chart needs to look smooth; see `plan`.
+TIMEZONE = "US/Eastern"     # Local timezone the rollup buckets are aligned to, matching the default of `ah.data`.
+
+
+
+
+
+class HistoryStore:
+    """
+    Persistent store of raw NexusHub scans, keyed by market (`realm-faction` or region) and item.
+
+    Each `(market, item)` pair also remembers how far back it has been fetched and when it was last checked,
+    so repeat queries are answered from disk and only scans newer than the latest stored `scannedAt` are requested.
+
+    Every write also updates the pair's rollups: one OHLC bar per 2 hour, day and week (see `TIERS`), so long ranges can be read as a few hundred bars instead of thousands of scans.
+    Rollup buckets are aligned to local time, exactly like `ah.data.resample` buckets local scan times: days start at local midnight and weeks on local Mondays.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH, maxAge: int = SCAN_INTERVAL, timezone: str = TIMEZONE, archive: Archive = None):
+        """
+        Parameters
+        ----------
+        `path`: Path of the SQLite database file.  Default is `history.db`.
+        `maxAge`: Number of seconds a `(market, item)` pair is considered up to date after being checked upstream.  Default is one scan interval.
+        `timezone`: The `pytz` name of the timezone rollup buckets are aligned to.  Default is `TIMEZONE`.
+        `archive`: Optional `Archive` mirroring this store (see `Archive.sync`), read by `read_series` where it covers.  Default is `None`.
+        """
+        self.path = path
+        self.maxAge = maxAge
+        self.timezone = timezone
+        self.archive = archive
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS scans (
+                    market TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    scannedAt TEXT NOT NULL,
+                    marketValue REAL,
+                    minBuyout REAL,
+                    quantity REAL,
+                    PRIMARY KEY (market, item, scannedAt)
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS coverage (
+                    market TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    since TEXT NOT NULL,
+                    checkedAt TEXT NOT NULL,
+                    PRIMARY KEY (market, item)
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS rollups (
+                    market TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    tier TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    open REAL, high REAL, low REAL, close REAL,
+                    mean REAL, vwap REAL, volume REAL,
+                    quantity REAL, minBuyout REAL, count INTEGER,
+                    PRIMARY KEY (market, item, tier, bucket)
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+            # rollups bucketed in another timezone (or in UTC, before they were local) are dropped and rebuilt on next read
+            row = self._conn.execute("SELECT value FROM settings WHERE key='rollupTimezone'").fetchone()
+            if row is None or row[0] != timezone:
+                self._conn.execute("DELETE FROM rollups")
+                self._conn.execute("INSERT OR REPLACE INTO settings VALUES ('rollupTimezone', ?)", (timezone,))
+
+
+    def history(self, market: str, item: str, timerange: int, url: callable) -> list:
+        """
+        Returns the raw scans of `item` on `market` for the last `timerange` days, fetching only what is missing.
+
+        Parameters
+        ----------
+        `market`: The market key, e.g. `skyfury-alliance` or `us`.
+        `item`: The item slug.
+        `timerange`: The number of days of history wanted.
+        `url`: Function mapping a number of days to the NexusHub URL to request for this market and item.
+
+        Returns
+        -------
+        List of raw NexusHub rows (UTC `scannedAt` strings), oldest first.
+        """
+        now = datetime.datetime.utcnow()
+        start = (now - datetime.timedelta(days=timerange)).strftime(ISO_FORMAT)
+        self.refresh(market, item, timerange, url, now)
+        return self.read(market, item, start)
+
+
+    def series(self, market: str, item: str, timerange: int, url: callable) -> PriceSeries:
+        """
+        As `history`, but returns a `PriceSeries` in the store's timezone, read with `read_series`.
+        """
+        now = datetime.datetime.utcnow()
+        start = (now - datetime.timedelta(days=timerange)).strftime(ISO_FORMAT)
+        self.refresh(market, item, timerange, url, now)
+        return self.read_series(market, item, start)
+
+
+    def refresh(self, market: str, item: str, timerange: int, url: callable, now: datetime.datetime = None, force: bool = False) -> int:
+        """
+        Brings the stored scans of `item` on `market` up to date for the last `timerange` days.
+        Nothing is requested if the pair was checked less than `maxAge` seconds ago and already covers the range, unless `force` is `True`.
+
+        Returns
+        -------
+        The number of new scans stored, or `None` if the upstream request failed.
+        """
+        now = now or datetime.datetime.utcnow()
+        start = (now - datetime.timedelta(days=timerange)).strftime(ISO_FORMAT)
+        with self._lock:
+            row = self._conn.execute("SELECT since, checkedAt FROM coverage WHERE market=? AND item=?", (market, item)).fetchone()
+            latest = self._conn.execute("SELECT MAX(scannedAt) FROM scans WHERE market=? AND item=?", (market, item)).fetchone()[0]
+        covered = row is not None and row[0] <= start
+        if covered:
+            checkedAt = datetime.datetime.strptime(row[1], ISO_FORMAT)
+            if (now - checkedAt).total_seconds() < self.maxAge and not force:
+                return 0
+            if latest is not None:      # Only ask for the days since the newest stored scan.
+                elapsed = now - datetime.datetime.strptime(latest, ISO_FORMAT)
+                timerange = min(timerange, max(1, ceil(elapsed.total_seconds() / 86400)))
+        data = api.fetch(url(timerange), maxAge=0)
+        if data is None:
+            return None
+        return self.write(market, item, data, since=row[0] if covered else start, checkedAt=now.strftime(ISO_FORMAT))
+
+
+    def write(self, market: str, item: str, data: list, since: str = None, checkedAt: str = None) -> int:
+        """
+        Stores raw NexusHub rows for `item` on `market`, ignoring scans that are already stored.
+
+        Parameters
+        ----------
+        `data`: Raw NexusHub rows.
+        `since`: If given, the earliest UTC `scannedAt` this pair is now known to be complete from.
+        `checkedAt`: If given, the UTC time this pair was last checked upstream.
+
+        Returns
+        -------
+        The number of new scans stored.
+        """
+        rows = [(market, item, d["scannedAt"], d["marketValue"], d["minBuyout"], d["quantity"]) for d in data]
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany("INSERT OR IGNORE INTO scans VALUES (?, ?, ?, ?, ?, ?)", rows)
+            added = self._conn.total_changes - before
+            if since is not None and checkedAt is not None:
+                self._conn.execute("""
+                    INSERT INTO coverage VALUES (?, ?, ?, ?)
+                    ON CONFLICT (market, item) DO UPDATE SET since = MIN(since, excluded.since), checkedAt = excluded.checkedAt
+                """, (market, item, since, checkedAt))
+        if added:
+            self.update_rollups(market, item, min(d["scannedAt"] for d in data))
+        return added
+
+
+    def read(self, market: str, item: str, start: str = "") -> list:
+        """
+        Returns the stored raw rows of `item` on `market` scanned at or after the UTC timestamp `start`, oldest first.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT scannedAt, marketValue, minBuyout, quantity FROM scans WHERE market=? AND item=? AND scannedAt >= ? ORDER BY scannedAt",
+                (market, item, start)
+            ).fetchall()
+        return [{"marketValue": r[1], "minBuyout": r[2], "quantity": r[3], "scannedAt": r[0]} for r in rows]
+
+
+    def read_series(self, market: str, item: str, start: str = "") -> PriceSeries:
+        """
+        Returns the stored scans of `item` on `market` scanned at or after the UTC timestamp `start`, as a `PriceSeries` in the store's timezone.
+        With an archive, the scans it holds are sliced from its memory map, and only newer ones are read from SQLite.
+        """
+        archived = self.archive.series(market, item, start or None) if self.archive is not None else None
+        if not archived:
+            return PriceSeries.from_payload(self.read(market, item, start), timezone=self.timezone)
+        newer = PriceSeries.from_payload(self.read(market, item, f"{(archived.times[-1] + 1).astype('datetime64[ms]')}Z"), timezone=self.timezone)
+        return PriceSeries(np.concatenate([utc_to_local(archived.times, self.timezone), newer.times]),
+                           *(np.concatenate([getattr(archived, field), getattr(newer, field)]) for field in ("prices", "minBuyouts", "quantities")))
+
+
+    def latest(self, market: str, item: str) -> dict:
+        """
+        Returns the newest stored raw row of `item` on `market`, or `None` if there is none.
+        """
+        with self._lock:
+            r = self._conn.execute(
+                "SELECT scannedAt, marketValue, minBuyout, quantity FROM scans WHERE market=? AND item=? ORDER BY scannedAt DESC LIMIT 1",
+                (market, item)
+            ).fetchone()
+        return None if r is None else {"marketValue": r[1], "minBuyout": r[2], "quantity": r[3], "scannedAt": r[0]}
+
+
+    def bars(self, market: str, item: str, timerange: int, url: callable, tier: str) -> Bars:
+        """
+        Returns the `tier` rollup bars of `item` on `market` covering the last `timerange` days, fetching any missing scans first.
+        Parameters are as in `history`.
+        """
+        now = datetime.datetime.utcnow()
+        start = _bucket_start((now - datetime.timedelta(days=timerange)).strftime(ISO_FORMAT), TIERS[tier], data.WEEK_ORIGIN if tier == "1w" else 0, self.timezone)
+        self.refresh(market, item, timerange, url, now)
+        with self._lock:
+            missing = self._conn.execute("SELECT 1 FROM rollups WHERE market=? AND item=? LIMIT 1", (market, item)).fetchone() is None
+        if missing:         # scans stored before rollups existed
+            self.update_rollups(market, item)
+        return self.rollups(market, item, tier, start)
+
+
+    def rollups(self, market: str, item: str, tier: str, start: str = "") -> Bars:
+        """
+        Returns the stored `tier` rollup bars of `item` on `market` whose bucket starts at or after `start`, oldest first.
+        Bar times, and `start`, are naive local times in the store's timezone.
+        """
+        if tier not in TIERS:
+            raise ValueError(f"\n>> `tier` must be one of {', '.join(TIERS)}, not {tier}.\n")
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT bucket, open, high, low, close, quantity, count, mean, vwap, volume, minBuyout FROM rollups
+                   WHERE market=? AND item=? AND tier=? AND bucket >= ? ORDER BY bucket""",
+                (market, item, tier, start)
+            ).fetchall()
+        if not rows:
+            return Bars(*([] for _ in Bars.FIELDS))
+        columns = list(zip(*rows))
+        times = np.char.rstrip(np.asarray(columns[0], dtype=str), "Z").astype("datetime64[m]")
+        return Bars(times, *(np.array(c, dtype=np.float64) for c in columns[1:]))
+
+
+    def update_rollups(self, market: str, item: str, since: str = "") -> None:
+        """
+        Recomputes every rollup bucket of `item` on `market` that contains a scan at or after the UTC timestamp `since`.
+        Only the buckets from the start of the week containing `since` onwards are rebuilt, so appending new scans stays cheap.
+        """
+        start = _bucket_start(since, TIERS["1w"], data.WEEK_ORIGIN, self.timezone) if since else ""
+        # a local week starts less than a day away from the same UTC time; scans read before it only complete no bucket and are dropped
+        readFrom = f"{(np.datetime64(start, 'm') - np.timedelta64(1, 'D')).astype('datetime64[ms]')}Z" if start else ""
+        series = self.read_series(market, item, readFrom)
+        rows = []
+        for tier in TIERS:
+            bars = data.resample(series, tier, "ohlc")
+            if start:
+                bars = bars[np.searchsorted(bars.times, np.datetime64(start, "m")):]
+            buckets = np.datetime_as_string(bars.times.astype("datetime64[ms]"), unit="ms")
+            rows.extend((market, item, tier, b, *values) for b,*values in zip(
+                buckets, *(bars[f].tolist() for f in ("open", "high", "low", "close", "mean", "vwap", "volume", "quantities", "minBuyouts", "counts"))
+            ))
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+    def close(self) -> None:
+        """
+        Closes the underlying database connection.
+        """
+        self._conn.close()
+
+
+
+
+
+def plan(numDays: int, resolution: int = RESOLUTION) -> str:
+    """
+    Picks the coarsest rollup tier that still gives a chart of `numDays` days at least `resolution` points.
+
+    Returns
+    -------
+    The tier name (ex: `1d` for a year), or `None` if even the finest tier is too coarse and raw scans should be read instead.
+    """
+    for tier, width in sorted(TIERS.items(), key=lambda kv: -kv[1]):
+        if numDays * 1440 / width >= resolution:
+            return tier
+    return None
+
+
+def _bucket_start(timestamp: str, width: int, origin: int = 0, timezone: str = None) -> str:
+    """
+    Returns the start of the `width`-minute bucket containing the UTC timestamp `timestamp`, as a UTC `ISO_FORMAT` string,
+    or, if `timezone` is given, as the naive local ISO string of the bucket in that timezone (the format rollup buckets are stored in).
+    """
+    if timezone is None:
+        minutes = np.datetime64(timestamp.rstrip("Z"), "m").astype(np.int64)
+    else:
+        minutes = utc_to_local([timestamp], timezone)[0].astype(np.int64)
+    start = (minutes - origin) // width * width + origin
+    start = np.datetime64(int(start), "m").astype("datetime64[ms]")
+    return f"{start}Z" if timezone is None else f"{start}"
+
+
+
+
+
+_default = None
+
+def default_store() -> HistoryStore:
+    """
+    Returns the shared `HistoryStore` at `DEFAULT_PATH`, reading the archive at `ARCHIVE_PATH` if set, opening it on first use.
+    """
+    global _default
+    if _default is None:
+        _default = HistoryStore(DEFAULT_PATH, archive=Archive(ARCHIVE_PATH) if ARCHIVE_PATH else None)
+    return _default
+
+
+
+
+
+def server_source(itemname: str, realm: str, faction: str) -> tuple:
+    """
+    Returns the `(market, item, url)` arguments identifying an item on a particular server to `HistoryStore.history` and `HistoryStore.refresh`.
+    """
+    market = f"{realm.lower()}-{faction.lower()}"
+    slug = catalog.slug(itemname)
+    return market, slug, lambda days: api.server_url(itemname, realm, faction, days)
+
+
+
+
+
+def region_source(itemname: str, region: str) -> tuple:
+    """
+    Returns the `(market, item, url)` arguments identifying an item across a region to `HistoryStore.history` and `HistoryStore.refresh`.
+    """
+    slug = catalog.slug(itemname)
+    return region.lower(), slug, lambda days: api.region_url(itemname, region, days)
+
+
+
+
+
+def server_payload(itemname: str, realm = "skyfury", faction = "alliance", timerange: int = None, store: HistoryStore = None) -> list:
+    """
+    Returns the raw NexusHub rows for an item on a particular server, reading through `store`.
+    Only scans newer than the latest stored one are requested from NexusHub.
+
+    Parameters
+    ----------
+    `store`: The `HistoryStore` to use.  Default is the shared store at `DEFAULT_PATH`.
+    """
+    if not timerange: timerange = api.default_timerange()
+    store = store or default_store()
+    market, slug, url = server_source(itemname, realm, faction)
+    return store.history(market, slug, timerange, url)
+
+
+
+
+
+def region_payload(itemname: str, region = "us", timerange: int = None, store: HistoryStore = None) -> list:
+    """
+    Returns the raw NexusHub rows for an item across an entire region, reading through `store`.
+    Only scans newer than the latest stored one are requested from NexusHub.
+
+    Parameters
+    ----------
+    `store`: The `HistoryStore` to use.  Default is the shared store at `DEFAULT_PATH`.
+    """
+    if not timerange: timerange = api.default_timerange()
+    store = store or default_store()
+    market, slug, url = region_source(itemname, region)
+    return store.history(market, slug, timerange, url)
+
+
+
+
+
+def server_series(itemname: str, realm = "skyfury", faction = "alliance", timerange: int = None, store: HistoryStore = None) -> PriceSeries:
+    """
+    As `server_payload`, but returns a `PriceSeries` in local time, read from the store's archive where it covers.
+    """
+    if not timerange: timerange = api.default_timerange()
+    store = store or default_store()
+    market, slug, url = server_source(itemname, realm, faction)
+    return store.series(market, slug, timerange, url)
+
+
+
+
+
+def region_series(itemname: str, region = "us", timerange: int = None, store: HistoryStore = None) -> PriceSeries:
+    """
+    As `region_payload`, but returns a `PriceSeries` in local time, read from the store's archive where it covers.
+    """
+    if not timerange: timerange = api.default_timerange()
+    store = store or default_store()
+    market, slug, url = region_source(itemname, region)
+    return store.series(market, slug, timerange, url)
+
+
+
+
+
+def server_history(itemname: str, realm = "skyfury", faction = "alliance", timerange: int = None, convert_timezone = True, condensed = False, rounded = True, timezone = "US/Eastern", store: HistoryStore = None) -> list:
+    """
+    Store-backed version of `ah.api.server_history`, with the same parameters and return format.
+
+    Parameters
+    ----------
+    `store`: The `HistoryStore` to use.  Default is the shared store at `DEFAULT_PATH`.
+    """
+    data = server_payload(itemname, realm, faction, timerange, store)
+    return api.format_history(data, convert_timezone, condensed, rounded, timezone)
+
+
+
+
+
+def region_history(itemname: str, region = "us", timerange: int = None, convert_timezone = True, condensed = False, rounded = True, timezone = "US/Eastern", store: HistoryStore = None) -> list:
+    """
+    Store-backed version of `ah.api.region_history`, with the same parameters and return format.
+
+    Parameters
+    ----------
+    `store`: The `HistoryStore` to use.  Default is the shared store at `DEFAULT_PATH`.
+    """
+    data = region_payload(itemname, region, timerange, store)
+    return api.format_history(data, convert_timezone, condensed, rounded, timezone)
+
+
+
+
+
+def server_bars(itemname: str, realm = "skyfury", faction = "alliance", timerange: int = None, tier: str = "1d", store: HistoryStore = None) -> Bars:
+    """
+    Returns the `tier` rollup bars (local bucket times) of an item on a particular server for the last `timerange` days, reading through `store`.
+    """
+    if not timerange: timerange = api.default_timerange()
+    store = store or default_store()
+    market, slug, url = server_source(itemname, realm, faction)
+    return store.bars(market, slug, timerange, url, tier)
+
+
+
+
+
+def region_bars(itemname: str, region = "us", timerange: int = None, tier: str = "1d", store: HistoryStore = None) -> Bars:
+    """
+    Returns the `tier` rollup bars (local bucket times) of an item across an entire region for the last `timerange` days, reading through `store`.
+    """
+    if not timerange: timerange = api.default_timerange()
+    store = store or default_store()
+    market, slug, url = region_source(itemname, region)
+    return store.bars(market, slug, timerange, url, tier)
@@ -0,0 +1,205 @@
+"""
+transport.py
+============
+
+Pluggable ways of getting a response for a NexusHub URL: live over HTTP, recording live responses to disk, or replaying them from disk.
+
+The transport used by `ah.api` can be chosen with the `AH_TRANSPORT` environment variable:
+>>> AH_TRANSPORT=http                    # live requests (default)
+>>> AH_TRANSPORT=record:recordings/      # live requests, saving every successful response
+>>> AH_TRANSPORT=replay:recordings/      # no network; serve saved responses, 404 otherwise
+"""
+import os
+import json
+import hashlib
+import requests
+import threading
+from urllib.parse import urlsplit
+
+
+
+
+
+class Transport:
+    """
+    Base class of all transports.
+    """
+
+    def get(self, url: str, timeout: float) -> tuple:
+        """
+        Requests `url` and returns `(statusCode, body)`, where `body` is the raw response bytes.
+        Raises `requests.RequestException` or `OSError` if no response could be obtained.
+        """
+        raise NotImplementedError
+
+
+    def stream(self, url: str, timeout: float, chunkSize: int = 2**16) -> tuple:
+        """
+        Like `get`, but returns `(statusCode, chunks)`, where `chunks` iterates over the response body in pieces of about `chunkSize` bytes.
+        Transports that can't stream return the whole body as one chunk.
+        """
+        status, body = self.get(url, timeout)
+        return status, iter((body,))
+
+
+    def clone(self) -> "Transport":
+        """
+        Returns a transport that behaves like this one but shares none of its connections, e.g. for a forked worker process.
+        Transports without connections return themselves.
+        """
+        return self
+
+
+    def reserve(self, connections: int) -> None:
+        """
+        Makes sure up to `connections` requests can be in flight at once without waiting for, or discarding, pooled connections.
+        Call it before starting that many threads.  Transports without connections ignore it.
+        """
+
+
+
+
+
+class HTTPTransport(Transport):
+    """
+    Live requests over a `requests.Session` whose keep-alive connections are pooled.
+    The pool grows to the largest number of connections `reserve`d, so no thread pool outgrows it.
+    """
+
+    def __init__(self, poolSize: int = 16):
+        """
+        Parameters
+        ----------
+        `poolSize`: The initial maximum number of connections kept open per host.  Default is `16`.
+        """
+        self.poolSize = 0
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self.reserve(poolSize)
+
+
+    def reserve(self, connections: int) -> None:
+        with self._lock:
+            if connections <= self.poolSize:
+                return
+            self.poolSize = connections
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=connections)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+
+
+    def get(self, url: str, timeout: float) -> tuple:
+        response = self.session.get(url, timeout=timeout)
+        return response.status_code, response.content
+
+
+    def stream(self, url: str, timeout: float, chunkSize: int = 2**16) -> tuple:
+        response = self.session.get(url, timeout=timeout, stream=True)
+        def chunks():
+            with response:
+                yield from response.iter_content(chunkSize)
+        return response.status_code, chunks()
+
+
+    def clone(self) -> "HTTPTransport":
+        return HTTPTransport(self.poolSize)
+
+
+
+
+
+class RecordTransport(Transport):
+    """
+    Passes requests on to another transport, and saves every successful response in `directory` for `ReplayTransport`.
+    """
+
+    def __init__(self, directory: str, inner: Transport = None):
+        """
+        Parameters
+        ----------
+        `directory`: The folder to save responses in.  Created if missing.
+        `inner`: The transport that makes the actual requests.  Default is a new `HTTPTransport`.
+        """
+        self.directory = directory
+        self.inner = inner or HTTPTransport()
+        os.makedirs(directory, exist_ok=True)
+
+
+    def get(self, url: str, timeout: float) -> tuple:
+        status, body = self.inner.get(url, timeout)
+        if status == 200:
+            path = recording_path(self.directory, url)
+            temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"       # threads may record the same URL at once
+            with open(temp, "w") as f:
+                json.dump({"url": request_key(url), "status": status, "body": body.decode()}, f)
+            os.replace(temp, path)
+        return status, body
+
+
+    def clone(self) -> "RecordTransport":
+        return RecordTransport(self.directory, self.inner.clone())
+
+
+    def reserve(self, connections: int) -> None:
+        self.inner.reserve(connections)
+
+
+
+
+
+class ReplayTransport(Transport):
+    """
+    Serves responses saved by `RecordTransport`, without any network access.  URLs that were never recorded get a 404.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Parameters
+        ----------
+        `directory`: The folder the responses were recorded in.
+        """
+        self.directory = directory
+
+
+    def get(self, url: str, timeout: float) -> tuple:
+        path = recording_path(self.directory, url)
+        if not os.path.exists(path):
+            return 404, b'{"error": "not recorded"}'
+        with open(path) as f:
+            recording = json.load(f)
+        return recording["status"], recording["body"].encode()
+
+
+
+
+
+def request_key(url: str) -> str:
+    """
+    Returns the part of `url` that identifies a request regardless of which host served it, i.e. its path and query.
+    """
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+def recording_path(directory: str, url: str) -> str:
+    """
+    Returns the file a response to `url` is recorded in.
+    """
+    return os.path.join(directory, hashlib.sha1(request_key(url).encode()).hexdigest() + ".json")
+
+
+
+
+
+def from_spec(spec: str) -> Transport:
+    """
+    Creates a transport from a spec of the form `http`, `record:<directory>` or `replay:<directory>`.
+    """
+    kind, _, directory = spec.partition(":")
+    if kind == "http":
+        return HTTPTransport()
+    if kind == "record" and directory:
+        return RecordTransport(directory)
+    if kind == "replay" and directory:
+        return ReplayTransport(directory)
+    raise ValueError(f"\n>> Invalid transport '{spec}'.  Use 'http', 'record:<directory>' or 'replay:<directory>'.\n")
@@ -0,0 +1,84 @@
+"""
+watchlist.py
+============
+
+The set of items and markets that are tracked continuously.
+"""
+import json
+import itertools
+from ah.catalog import default_catalog
+
+
+
+
+
+class Watchlist:
+    """
+    Items to track, and the realms, factions and regions to track them on.
+
+    Watchlists are stored as JSON files of the form:
+    >>> {
+    >>>     "items": ["Saronite Ore", "Titanium Ore", ...],
+    >>>     "realms": ["Skyfury", "Faerlina", "Whitemane"],
+    >>>     "factions": ["Alliance", "Horde"],
+    >>>     "regions": ["US"]
+    >>> }
+    """
+
+    def __init__(self, items: list, realms: list = ["Skyfury"], factions: list = ["Alliance"], regions: list = ["US"]):
+        """
+        Parameters
+        ----------
+        `items`: The names of the items to track.
+        `realms`: The servers to track them on.  Default is `["Skyfury"]`.
+        `factions`: The factions to track on each server.  Default is `["Alliance"]`.
+        `regions`: The regions to track them in.  Default is `["US"]`.
+        """
+        self.items = list(items)
+        self.realms = list(realms)
+        self.factions = list(factions)
+        self.regions = list(regions)
+
+
+    @classmethod
+    def load(cls, path: str) -> "Watchlist":
+        """
+        Reads a watchlist from a JSON file.  Raises `ValueError` if it lists items that aren't in the item catalog.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        if not config.get("items"):
+            raise ValueError(f"\n>> The watchlist at {path} has no items.\n")
+        catalog = default_catalog()
+        unknown = [item for item in config["items"] if catalog is not None and catalog.get(item) is None]
+        if unknown:
+            hints = "".join(f"\n>>   {item}" + (f" (did you mean {s[0]['name']}?)" if (s := catalog.suggest(item, 1)) else "") for item in unknown)
+            raise ValueError(f"\n>> The watchlist at {path} has unknown items:{hints}\n")
+        return cls(config["items"], config.get("realms", ["Skyfury"]), config.get("factions", ["Alliance"]), config.get("regions", ["US"]))
+
+
+    def save(self, path: str) -> None:
+        """
+        Writes the watchlist to a JSON file.
+        """
+        with open(path, "w") as f:
+            json.dump({"items": self.items, "realms": self.realms, "factions": self.factions, "regions": self.regions}, f, indent=4)
+
+
+    def servers(self) -> list:
+        """
+        Returns every `(realm, faction)` pair on the watchlist.
+        """
+        return list(itertools.product(self.realms, self.factions))
+
+
+    def pairs(self) -> list:
+        """
+        Returns every `(item, market)` pair to track, where `market` is a `(realm, faction)` tuple or a region name.
+        """
+        markets = self.servers() + self.regions
+        return list(itertools.product(self.items, markets))
+
+
+    def __len__(self) -> int:
+        return len(self.items) * (len(self.realms) * len(self.factions) + len(self.regions))
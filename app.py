@@ -3,7 +3,9 @@
 if __name__ == "__main__":
     import streamlit as st
     from streamlit.components.v1 import html
-    from plots import price, price_and_quantity, price_and_region
+    import ah.metrics as metrics
+    from ah.catalog import default_catalog
+    from plots import render
     
     st.set_page_config(
         page_title="AH Prices",
@@ -39,12 +41,24 @@ if __name__ == "__main__":
     st.write("")
 
     item = st.text_input("Item name", "Saronite Ore")
-    numDays = st.number_input("Number of days", 1, 40, 7)
+    catalog = default_catalog()         # None if NexusHub's item list is unavailable; names are then sent unchecked
+    if catalog is not None:
+        match = catalog.get(item)
+        if match is None:
+            suggestions = catalog.complete(item) or catalog.suggest(item)
+            st.error(f"Unknown item '{item}'.")
+            if not suggestions:
+                st.stop()
+            match = catalog.get(st.selectbox("Did you mean", [s["name"] for s in suggestions]))
+        item = match["name"]
+    numDays = st.number_input("Number of days", 1, 365, 7, help="Ranges longer than a few weeks are drawn from daily or weekly averages.")
 
     server = st.selectbox("Server", ["Skyfury", "Faerlina", "Whitemane"])
     faction = st.selectbox("Faction", ["Alliance", "Horde"])
 
     chartType = st.selectbox("Chart type", ["Price", "Price & Quantity", "Price & Region"], help="Select the type of chart you want to view.")
+    how = "vwap" if st.selectbox("Average", ["Mean", "Volume-weighted (VWAP)"], help="VWAP weights each scan by the quantity listed, which is closer to what thin markets trade at.") != "Mean" else "mean"
+    forecastHours = st.select_slider("Forecast", [0, 24, 48, 72], 0, format_func=lambda h: f"{h} h" if h else "Off", help="Forecast the next hours from the daily and weekly pattern of the price (Price chart only).") if chartType == "Price" else 0
 
     st.write("")
 
@@ -53,11 +67,21 @@ if __name__ == "__main__":
     # html(javascript, height=0)
 
     if st.button("Plot"):
-        if chartType == "Price":
-            st.pyplot(price(item, numDays, server, faction))
-            # disable the view fullscreen button (button title="View fullscreen" class="css-e370rw e191ei0e1")
-            # st.markdown("""<style>button[title="View fullscreen"]{display: none;}</style>""", unsafe_allow_html=True)
-        elif chartType == "Price & Quantity":
-            st.pyplot(price_and_quantity(item, numDays, server, faction))
-        elif chartType == "Price & Region":
-            st.pyplot(price_and_region(item, numDays, server, faction, replaceOutliers=True, threshold=3))
+        try:
+            if chartType == "Price":
+                st.image(render("price", item, numDays, server, faction, how=how, forecastHours=forecastHours))
+                # disable the view fullscreen button (button title="View fullscreen" class="css-e370rw e191ei0e1")
+                # st.markdown("""<style>button[title="View fullscreen"]{display: none;}</style>""", unsafe_allow_html=True)
+            elif chartType == "Price & Quantity":
+                st.image(render("price_and_quantity", item, numDays, server, faction, how=how))
+            elif chartType == "Price & Region":
+                st.image(render("price_and_region", item, numDays, server, faction, replaceOutliers=True, threshold=3, how=how))
+        except ValueError as e:
+            st.error(str(e).strip().lstrip("> "))
+
+    if metrics.ENABLED:      # AH_METRICS=1
+        with st.expander("Debug"):
+            spans = metrics.snapshot()["spans"]
+            st.table([{"stage": stage, "calls": s["calls"], "total ms": round(s["seconds"]*1000, 2), "max ms": round(s["maxSeconds"]*1000, 2)}
+                      for stage,s in sorted(spans.items(), key=lambda kv: -kv[1]["seconds"])])
+            st.code(metrics.render_prometheus())
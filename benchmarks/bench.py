@@ -0,0 +1,193 @@
+"""
+bench.py
+========
+
+Benchmarks every stage of the charting pipeline (fetch, parse, decode, aggregate, align, repair, render) and the full
+`plots.price_and_region` path, on synthetic histories served by a local `ah.standin` server.
+
+Each stage is timed over several repeats and its peak traced memory is recorded.  Results are saved as JSON so that
+two runs can be compared for regressions.
+
+Usage:
+>>> python benchmarks/bench.py --sizes 100 1000 10000 100000 1000000
+>>> python benchmarks/bench.py --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matplotlib
+matplotlib.use("Agg")
+
+import numpy as np
+import ah.api as api
+import ah.store as store
+import ah.catalog as catalog
+import ah.standin as standin
+import ah.transport as transport
+import plots
+from ah.series import PriceSeries
+from ah.decode import decode_prices
+from ah.misc import fix_bad_data
+from ah.data import average, align
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+
+
+
+def measure(function: callable, repeats: int) -> dict:
+    """
+    Calls `function` `repeats` times and returns its fastest and median wall time (seconds), and the peak memory it allocated (bytes).
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"min": min(times), "median": statistics.median(times), "peakBytes": peak}
+
+
+
+
+
+def stages(numScans: int, maxFetch: int) -> dict:
+    """
+    Returns the stages to benchmark for a history of `numScans` hourly scans, as a dict of name -> function taking no arguments.
+    """
+    numDays = max(1, numScans // 24)
+    payload = standin.synthetic_history("bench-alliance", "bench-item", numDays)
+    regionPayload = standin.synthetic_history("us", "bench-item", numDays)
+    server = PriceSeries.from_payload(payload)
+    region = PriceSeries.from_payload(regionPayload)
+    serverAvg, regionAvg = average(server), average(region)
+    body = json.dumps({"slug": "bench-item", "data": payload}).encode()
+    chunks = [body[i:i+2**16] for i in range(0, len(body), 2**16)]
+    result = {
+        "parse": lambda: PriceSeries.from_payload(payload),
+        "decode": lambda: PriceSeries.from_payload(json.loads(body)["data"]),
+        "stream": lambda: PriceSeries(*decode_prices(chunks, rounded=True)),
+        "aggregate": lambda: average(server),
+        "align": lambda: align(serverAvg, regionAvg),
+        "repair": lambda: fix_bad_data(serverAvg.prices, regionAvg.prices, 3),
+        "render": lambda: plots.rasterize(plots.generate_figure(serverAvg.times, [serverAvg.prices, regionAvg.prices])),
+    }
+    if numScans <= maxFetch:
+        url = api.server_url("Saronite Ore", "bench", "alliance", numDays)
+        result["fetch"] = lambda: api.fetch(url, maxAge=0)
+
+        def pipeline():
+            api.CACHE.clear()
+            plots.RENDER_CACHE.clear()
+            with tempfile.TemporaryDirectory() as folder:
+                store._default = store.HistoryStore(os.path.join(folder, "bench.db"))
+                plots.rasterize(plots.price_and_region("Saronite Ore", numDays, "bench", "alliance", "us"))
+                store._default.close()
+                store._default = None
+        result["pipeline"] = pipeline
+    return result
+
+
+
+
+
+def run(sizes: list, repeats: int, maxFetch: int) -> dict:
+    """
+    Runs every stage for every size against a fresh stand-in server, and returns the results.
+    """
+    server = standin.serve(port=0, historyDays=max(sizes)//24 + 1, background=True)
+    api.set_transport(transport.HTTPTransport(), standin.base_url(server))
+    catalog.CATALOG_PATH = None         # keep the stand-in's item list in memory only
+    results = []
+    for numScans in sizes:
+        for name, function in stages(numScans, maxFetch).items():
+            stats = measure(function, repeats)
+            results.append(dict(stage=name, scans=numScans, **stats))
+            print(f"{name:>10} {numScans:>9} scans   min {stats['min']*1000:10.2f} ms   median {stats['median']*1000:10.2f} ms   peak {stats['peakBytes']/2**20:8.2f} MiB")
+    server.shutdown()
+    return {"meta": metadata(), "results": results}
+
+
+def metadata() -> dict:
+    """
+    Returns the machine and commit a run was made on.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+
+
+
+def compare(oldPath: str, newPath: str, tolerance: float = 0.10) -> int:
+    """
+    Prints the change in median time of every stage between two saved runs.
+
+    Returns
+    -------
+    The number of stages more than `tolerance` slower in the new run.
+    """
+    with open(oldPath) as f:
+        old = {(r["stage"], r["scans"]): r for r in json.load(f)["results"]}
+    with open(newPath) as f:
+        new = {(r["stage"], r["scans"]): r for r in json.load(f)["results"]}
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key]["median"] / old[key]["median"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  <-- slower"
+            regressions += 1
+        print(f"{key[0]:>10} {key[1]:>9} scans   {old[key]['median']*1000:10.2f} ms -> {new[key]['median']*1000:10.2f} ms   x{ratio:5.2f}{flag}")
+    return regressions
+
+
+
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the fetch, parse, aggregate, align, repair and render stages.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="History lengths, in hourly scans.")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed repeats per stage.")
+    parser.add_argument("--max-fetch", type=int, default=100000, help="Largest history to run the fetch and pipeline stages on.")
+    parser.add_argument("--out", default=None, help="Where to save the results.  Default is benchmarks/results/<time>.json.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two saved runs instead of benchmarking.")
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+    results = run(sorted(args.sizes), args.repeats, args.max_fetch)
+    path = args.out or os.path.join(RESULTS, time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved {path}")
+
+
+
+if __name__ == "__main__":
+    main()
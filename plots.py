@@ -1,12 +1,19 @@
+import io
+import hashlib
 import datetime
 import numpy as np
 from math import ceil
 from ah.data import align
 from ah.data import average
+from ah.data import downsample
 from ah.misc import decimal
 from ah.data import replace_outliers
 from ah.data import get_server_history
 from ah.data import get_region_history
+from ah.series import PriceSeries
+from ah.forecast import forecast as forecast_prices
+from ah.cache import TTLCache
+import ah.metrics as metrics
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -19,6 +26,7 @@ MINUS_TWO_HOURS   = lambda dt:  dt - datetime.timedelta(hours=2)
 MINUS_THREE_HOURS = lambda dt:  dt - datetime.timedelta(hours=3)
 MINUS_FOUR_HOURS  = lambda dt:  dt - datetime.timedelta(hours=4)
 SCALE_FACTOR = lambda prices:  100 if prices[-1] < 10000 else 10000
+FORECAST_DAYS = 28          # Days of raw hourly scans the forecast is fitted to, however the chart itself is aggregated.
 
 
 from matplotlib import pyplot as plt
@@ -26,15 +34,18 @@ from matplotlib import pyplot as plt
 
 
 
-def generate_figure(times: list, prices: list, quantities: list = None) -> plt.Figure:
+@metrics.timed("figure")
+def generate_figure(times: np.ndarray, prices: np.ndarray = None, quantities: np.ndarray = None, forecast: dict = None) -> plt.Figure:
     """
     Generates a figure from the given data.
 
     Parameters
     ----------
-    `times`: List of times.
-    `prices`: List of prices. Can be just one list, but needs to be enclosed in `[]`. If passing in two, server prices should be first.
-    `quantities`: List of quantities. Default is `None`, meaning only price will be plotted. Note, only one list can be passed in for quantities.
+    `times`: Array of times, or a `PriceSeries` (in which case `prices` defaults to its prices; its quantities are only plotted if passed as `quantities`).
+    `prices`: Array of prices. Can be just one array, or a list of two arrays. If passing in two, server prices should be first.
+    `quantities`: Array of quantities. Default is `None`, meaning only price will be plotted. Note, only one array can be passed in for quantities.
+    `forecast`: Optional forecast to draw after the prices, as a dictionary with `times`, `prices`, `lower` and `upper` arrays (see `ah.forecast.forecast`).
+                Only drawn when a single price array is plotted.  Default is `None`.
 
     Returns
     -------
@@ -42,10 +53,24 @@ def generate_figure(times: list, prices: list, quantities: list = None) -> plt.F
     """
     global ylabel
     global serverYlabel
+    if isinstance(times, PriceSeries):
+        series = times
+        times = series.times
+        prices = series.prices if prices is None else prices
+    # only draw the points that can be seen at the figure's width
+    pixels = int(plt.rcParams["figure.figsize"][0] * plt.rcParams["figure.dpi"])
+    columns = [prices] if np.ndim(prices[0]) == 0 else list(prices)
+    if quantities is not None:
+        columns.append(quantities)
+    keep = downsample(times, *columns, numBuckets=pixels)
+    if len(keep) < len(times):
+        times = np.asarray(times)[keep]
+        prices = np.asarray(prices)[keep] if np.ndim(prices[0]) == 0 else [np.asarray(p)[keep] for p in prices]
+        quantities = None if quantities is None else np.asarray(quantities)[keep]
     if quantities is None:
-        if not isinstance(prices[0], list):     # If only one list is passed in, then it's the server prices.
+        if np.ndim(prices[0]) == 0:             # If only one array is passed in, then it's the server prices.
             scale = SCALE_FACTOR(prices)
-            prices = [price/scale for price in prices]
+            prices = np.asarray(prices) / scale
             ylabel = "Price (silver)" if scale==100 else "Price (gold)"
             fig, ax = plt.subplots()
             ax.plot(times, prices)
@@ -55,8 +80,14 @@ def generate_figure(times: list, prices: list, quantities: list = None) -> plt.F
             ax.set_ylabel(ylabel, fontsize=14, fontweight='bold', labelpad=20, color='#ebebd6')
             ax.tick_params(axis='y', which='major', labelsize=11, color='#0e1117', labelcolor='#ebebd6')
             ax.tick_params(axis='x', which='both', bottom=False, top=False, labelbottom=False)
-            ax.set_xlim(MINUS_THREE_HOURS(times[0]), PLUS_ONE_HOUR(times[-1]))
-            ax.set_ylim(min(prices)*0.6, max(prices)*1.3)
+            lastTime, top = times[-1], np.max(prices)
+            if forecast is not None and not np.all(np.isnan(forecast["prices"])):
+                ax.plot(forecast["times"], forecast["prices"] / scale, color="#FF9B44", linestyle="--")
+                ax.fill_between(forecast["times"], forecast["lower"] / scale, forecast["upper"] / scale, color="#FF9B44", alpha=0.2)
+                lastTime = forecast["times"][-1]
+                top = max(top, np.nanmax(forecast["upper"]) / scale)
+            ax.set_xlim(MINUS_THREE_HOURS(times[0]), PLUS_ONE_HOUR(lastTime))
+            ax.set_ylim(np.min(prices)*0.6, top*1.3)
             ax.grid(axis='x', which='both', color='#000000', linewidth=0.5, linestyle='-', alpha=0)
             ax.grid(axis='y', which='both', color='#CCCCCC', linewidth=0.5, linestyle='-', alpha=0)
             ax.set_facecolor('#0e1117')
@@ -67,8 +98,8 @@ def generate_figure(times: list, prices: list, quantities: list = None) -> plt.F
             regionPrices = prices[1]
             serverScale = SCALE_FACTOR(serverPrices)
             regionScale = SCALE_FACTOR(regionPrices)
-            serverPrices = [price/serverScale for price in serverPrices]
-            regionPrices = [price/regionScale for price in regionPrices]
+            serverPrices = np.asarray(serverPrices) / serverScale
+            regionPrices = np.asarray(regionPrices) / regionScale
             serverYlabel = "Price (silver)" if serverScale==100 else "Price (gold)"
             regionYlabel = "Price (silver)" if regionScale==100 else "Price (gold)"
             fig, ax1 = plt.subplots()
@@ -86,19 +117,19 @@ def generate_figure(times: list, prices: list, quantities: list = None) -> plt.F
             lines2, labels2 = ax2.get_legend_handles_labels()
             ax1.legend(lines + lines2, labels + labels2, loc=0, fontsize=10)
             ax1.set_xlim(MINUS_HALF_HOUR(times[0]), (times[-1]))
-            ax1.set_ylim( min(min(serverPrices),min(regionPrices))*0.6, max(max(serverPrices),max(regionPrices))*1.3 )
-            ax2.set_ylim( min(min(serverPrices),min(regionPrices))*0.6, max(max(serverPrices),max(regionPrices))*1.3 )
+            ax1.set_ylim( min(np.min(serverPrices),np.min(regionPrices))*0.6, max(np.max(serverPrices),np.max(regionPrices))*1.3 )
+            ax2.set_ylim( min(np.min(serverPrices),np.min(regionPrices))*0.6, max(np.max(serverPrices),np.max(regionPrices))*1.3 )
             ax1.grid(axis='x', which='both', color='#000000', linewidth=1.5, alpha=0)
             ax1.grid(axis='y', which='both', color='#CCCCCC', linewidth=0.5, linestyle='-', alpha=0.5)
             ax2.grid(False)
             return fig
     else:
-        if isinstance(prices[0], list):
+        if np.ndim(prices[0]) > 0:
             print("\n>>> Error: If quantities are passed in, only one price list should be passed in.\n")
             return None
         else:
             scale = SCALE_FACTOR(prices)
-            prices = [price/scale for price in prices]
+            prices = np.asarray(prices) / scale
             ylabel = "Price (silver)" if scale==100 else "Price (gold)"
             fig, ax1 = plt.subplots()
             ax2 = ax1.twinx()
@@ -115,8 +146,8 @@ def generate_figure(times: list, prices: list, quantities: list = None) -> plt.F
             lines2, labels2 = ax2.get_legend_handles_labels()
             ax1.legend(lines + lines2, labels + labels2, loc=0, fontsize=10)
             ax1.set_xlim(MINUS_TWO_HOURS(times[0]), PLUS_ONE_HOUR(times[-1]))
-            ax1.set_ylim(min(prices)*0.6, max(prices)*1.3)
-            ax2.set_ylim(min(quantities)*0.8, max(quantities)*5)
+            ax1.set_ylim(np.min(prices)*0.6, np.max(prices)*1.3)
+            ax2.set_ylim(np.min(quantities)*0.8, np.max(quantities)*5)
             ax1.grid(axis='x', which='both', color='#000000', linewidth=1.5, alpha=0)
             ax1.grid(axis='y', which='both', color='#CCCCCC', linewidth=0.5, linestyle='-', alpha=0.5)
             ax2.grid(False)
@@ -124,7 +155,17 @@ def generate_figure(times: list, prices: list, quantities: list = None) -> plt.F
 
 
 
-def price(item: str, numDays: int = None, server: str = "Skyfury", faction: str = "Alliance", replaceOutliers: bool = False, threshold: int = 2) -> None:
+def history_days(times: np.ndarray) -> int:
+    """
+    Returns the number of calendar days spanned by the given array of times.
+    """
+    return int((times[-1] - times[0]).astype("timedelta64[D]").astype(int)) + 1
+
+
+
+
+
+def price(item: str, numDays: int = None, server: str = "Skyfury", faction: str = "Alliance", replaceOutliers: bool = False, threshold: int = 2, how: str = "mean", forecastHours: int = 0) -> plt.Figure:
     """
     Plots the price of an item over time.
 
@@ -136,15 +177,29 @@ def price(item: str, numDays: int = None, server: str = "Skyfury", faction: str
     `faction`: The faction of the server to plot. If `None`, then the default is "Alliance".
     `replaceOutliers`: If `True`, then outliers will be replaced with the median price. If `False`, then outliers will be left as is. If `None`, then the default is `False`.
     `threshold`: The threshold for the prices to be considered outliers (in standard deviations). If `None`, then the default is 2.
+    `how`: How prices are averaged: `"mean"`, or `"vwap"` to weight each scan by its quantity.  Default is `"mean"`.
+    `forecastHours`: The number of hours of forecast to draw after the prices, with its band.  Default is `0`, i.e. no forecast.
     """
-    data = get_server_history(item, server, faction, numDays)
-    times = data["times"]
-    prices = data["prices"]
+    data = get_server_history(item, server, faction, numDays, how=how)
+    scans = get_server_history(item, server, faction, FORECAST_DAYS, avg=False) if forecastHours else None
+    return price_figure(item, data, numDays, replaceOutliers, threshold, forecastHours, scans)
+
+
+def price_figure(item: str, data: PriceSeries, numDays: int = None, replaceOutliers: bool = False, threshold: int = 2, forecastHours: int = 0, scans: PriceSeries = None) -> plt.Figure:
+    """
+    Builds the figure of `price` from already loaded server data.
+    The forecast, if any, is fitted to the raw hourly `scans` (e.g. `get_server_history(..., avg=False)`), not to the averaged `data`.
+    """
+    times = data.times
+    prices = data.prices
     mean = np.mean(prices)
-    numDays = ((times[-1])-(times[0])).days + 1 if numDays is None else numDays
+    numDays = history_days(times) if numDays is None else numDays
     if replaceOutliers:
-        prices = replace_outliers(prices, threshold)
-    fig = generate_figure(times, prices)
+        prices, _ = replace_outliers(prices, threshold)
+    if forecastHours and scans is None:
+        raise ValueError(f"\n>> A forecast needs the raw hourly `scans` to be fitted to.\n")
+    forecast = forecast_prices({item: scans}, forecastHours)[item] if forecastHours else None
+    fig = generate_figure(times, prices, forecast=forecast)
     fig.gca().set_title(f"[{item}] - last {numDays} days", fontsize=16, fontweight='bold', pad=25, color='#ebebd6')
 
     unit = " s" if ylabel == "Price (silver)" else " g"
@@ -156,7 +211,7 @@ def price(item: str, numDays: int = None, server: str = "Skyfury", faction: str
 
 
 
-def price_and_quantity(item: str, numDays: int = None, server: str = "Skyfury", faction: str = "Alliance", replaceOutliers: bool = False, threshold: int = 2) -> None:
+def price_and_quantity(item: str, numDays: int = None, server: str = "Skyfury", faction: str = "Alliance", replaceOutliers: bool = False, threshold: int = 2, how: str = "mean") -> plt.Figure:
     """
     Plots the price and quantity of an item over time.
 
@@ -168,14 +223,22 @@ def price_and_quantity(item: str, numDays: int = None, server: str = "Skyfury",
     `faction`: The faction of the server to plot. If `None`, then the default is "Alliance".
     `replaceOutliers`: If `True`, then outliers will be replaced with the median price. If `False`, then outliers will be left as is. If `None`, then the default is `False`.
     `threshold`: The threshold for the prices to be considered outliers (in standard deviations). If `None`, then the default is 2.
+    `how`: How prices are averaged: `"mean"`, or `"vwap"` to weight each scan by its quantity.  Default is `"mean"`.
+    """
+    data = get_server_history(item, server, faction, numDays, how=how)
+    return price_and_quantity_figure(item, data, numDays, replaceOutliers, threshold)
+
+
+def price_and_quantity_figure(item: str, data: PriceSeries, numDays: int = None, replaceOutliers: bool = False, threshold: int = 2) -> plt.Figure:
     """
-    data = get_server_history(item, server, faction, numDays)
-    numDays = numDays = ((data["times"][-1])-(data["times"][0])).days + 1 if numDays is None else numDays
-    times = data["times"]
-    prices = data["prices"]
-    quantities = data["quantities"]
+    Builds the figure of `price_and_quantity` from already loaded server data.
+    """
+    numDays = history_days(data.times) if numDays is None else numDays
+    times = data.times
+    prices = data.prices
+    quantities = data.quantities
     if replaceOutliers:
-        prices = replace_outliers(prices, threshold)
+        prices, _ = replace_outliers(prices, threshold)
     fig = generate_figure(times, prices, quantities)
     fig.gca().set_title(f"[{item}] - last {numDays} days", fontsize=16, fontweight='bold', pad=25)
     
@@ -187,7 +250,7 @@ def price_and_quantity(item: str, numDays: int = None, server: str = "Skyfury",
 
 
 
-def price_and_region(item: str, numDays: int = None, server: str = "Skyfury", faction: str = "Alliance", region: str = "US", replaceOutliers: bool = False, threshold: int = 3) -> None:
+def price_and_region(item: str, numDays: int = None, server: str = "Skyfury", faction: str = "Alliance", region: str = "US", replaceOutliers: bool = False, threshold: int = 3, how: str = "mean") -> plt.Figure:
     """
     Plots the price of an item over time, along with the region price.
 
@@ -200,18 +263,115 @@ def price_and_region(item: str, numDays: int = None, server: str = "Skyfury", fa
     `region`: The region to plot. If `None`, then the default is "US".
     `replaceOutliers`: If `True`, then outliers will be replaced with the median price. If `False`, then outliers will be left as is. If `None`, then the default is `False`.
     `threshold`: The threshold for the prices to be considered outliers (in multiples of the price difference between server and region price). Default is 3.
+    `how`: How prices are averaged: `"mean"`, or `"vwap"` to weight each scan by its quantity.  Default is `"mean"`.
+    """
+    serverData = get_server_history(item, server, faction, numDays, how=how)
+    regionData = get_region_history(item, region, numDays, how=how)
+    return price_and_region_figure(item, serverData, regionData, numDays, replaceOutliers, threshold)
+
+
+def price_and_region_figure(item: str, serverData: PriceSeries, regionData: PriceSeries, numDays: int = None, replaceOutliers: bool = False, threshold: int = 3) -> plt.Figure:
+    """
+    Builds the figure of `price_and_region` from already loaded server and region data.
     """
-    serverData = get_server_history(item, server, faction, numDays)
-    regionData = get_region_history(item, region, numDays)
     serverData, regionData = align(serverData, regionData)
     if replaceOutliers:
         from ah.misc import fix_bad_data
-        regionData["prices"] = fix_bad_data(serverData["prices"], regionData["prices"], threshold)
+        regionData["prices"] = fix_bad_data(serverData.prices, regionData.prices, threshold)
 
-    serverPrices = serverData["prices"]
-    regionPrices = regionData["prices"]
-    numDays = numDays = ((serverData["times"][-1])-(serverData["times"][0])).days + 1 if numDays is None else numDays
-    fig = generate_figure(serverData["times"], [serverPrices, regionPrices])
+    serverPrices = serverData.prices
+    regionPrices = regionData.prices
+    numDays = history_days(serverData.times) if numDays is None else numDays
+    fig = generate_figure(serverData.times, [serverPrices, regionPrices])
     fig.gca().set_title(f"[{item}] - last {numDays} days", fontsize=16, fontweight='bold', pad=25)
     
     return fig
+
+
+
+
+
+
+
+FIGURES = {
+    "price": price_figure,
+    "price_and_quantity": price_and_quantity_figure,
+    "price_and_region": price_and_region_figure,
+}
+
+RENDER_CACHE = TTLCache(ttl=float("inf"), maxBytes=64*2**20, staleTtl=0, sizeof=len)
+metrics.register("render_cache", RENDER_CACHE.stats)
+
+
+def render(chart: str, item: str, numDays: int = None, server: str = "Skyfury", faction: str = "Alliance", region: str = "US", replaceOutliers: bool = False, threshold: int = None, format: str = "png", how: str = "mean", forecastHours: int = 0) -> bytes:
+    """
+    Renders one of the charts to image bytes, reusing a previous rendering if the data and options are unchanged.
+
+    Rendered images are cached under a hash of the input series and the chart options, so repeat views between scans never touch `matplotlib`.
+    Figures are closed as soon as they are rasterized.
+
+    Parameters
+    ----------
+    `chart`: The chart to render: `"price"`, `"price_and_quantity"` or `"price_and_region"`.
+    `item`, `numDays`, `server`, `faction`, `region`, `replaceOutliers`: As for the chart's plotting function.
+    `threshold`: The outlier threshold.  If `None`, then the chart's own default is used.
+    `format`: The image format passed to `savefig`, e.g. `"png"` or `"svg"`.  Default is `"png"`.
+    `how`: How prices are averaged: `"mean"` or `"vwap"` (quantity-weighted).  Default is `"mean"`.
+    `forecastHours`: Hours of forecast to draw on the `"price"` chart.  Default is `0`, i.e. no forecast.
+
+    Returns
+    -------
+    The encoded image.
+    """
+    if chart not in FIGURES:
+        raise ValueError(f"\n>> `chart` must be one of {', '.join(FIGURES)}, not {chart}.\n")
+    datasets = [get_server_history(item, server, faction, numDays, how=how)]
+    if not len(datasets[0]):
+        raise ValueError(f"\n>> No price history for {item} on {server}-{faction}.\n")
+    if chart == "price_and_region":
+        datasets.append(get_region_history(item, region, numDays, how=how))
+    options = {"numDays": numDays, "replaceOutliers": replaceOutliers}
+    if threshold is not None:
+        options["threshold"] = threshold
+    scans = None
+    if forecastHours and chart == "price":
+        options["forecastHours"] = forecastHours
+        scans = get_server_history(item, server, faction, FORECAST_DAYS, avg=False)
+    key = fingerprint(*datasets, scans, chart, item, format, how, sorted(options.items()))
+    if scans is not None:
+        options["scans"] = scans
+    return RENDER_CACHE.get(key, lambda: rasterize(FIGURES[chart](item, *datasets, **options), format))
+
+
+
+
+
+def fingerprint(*parts) -> str:
+    """
+    Returns a hash of the given series and options.  `PriceSeries` are hashed by the contents of their columns.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, PriceSeries):
+            for field in PriceSeries.FIELDS:
+                digest.update(np.ascontiguousarray(getattr(part, field)).tobytes())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+
+
+
+@metrics.timed("rasterize")
+def rasterize(fig: plt.Figure, format: str = "png") -> bytes:
+    """
+    Saves the figure to image bytes and closes it, freeing its memory.
+    """
+    buffer = io.BytesIO()
+    try:
+        fig.savefig(buffer, format=format, bbox_inches="tight")
+    finally:
+        plt.close(fig)
+    return buffer.getvalue()
@@ -0,0 +1,169 @@
+"""
+report.py
+=========
+
+Renders the price, price & quantity, and price & region charts of every item on a watchlist, in parallel, into a folder with an index page.
+Histories are fetched through the local history store by the main process alone; the render processes only draw.
+
+Usage:
+>>> python report.py watchlist.json --out report --days 7 --workers 8
+"""
+import os
+import html
+import argparse
+import matplotlib
+matplotlib.use("Agg")       # headless, must be selected before pyplot is imported
+
+import ah.api as api
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from ah.data import get_server_history, get_region_history
+from ah.watchlist import Watchlist
+from plots import price_figure, price_and_quantity_figure, price_and_region_figure, rasterize
+
+CHARTS = [("price", "Price"), ("price_and_quantity", "Price & Quantity"), ("price_and_region", "Price & Region")]
+
+
+
+
+
+def load_item(item: str, servers: list, region: str, numDays: int) -> dict:
+    """
+    Fetches an item's region history and each server's history once, through the local history store.
+    Called in the main process only, so a single process writes to the store.
+
+    Parameters
+    ----------
+    `servers`: List of `(server, faction)` tuples.
+
+    Returns
+    -------
+    Dictionary mapping `region` and each `(server, faction)` tuple to a `PriceSeries`, or to the error message if it couldn't be loaded.
+    """
+    data = {}
+    for key in [region, *servers]:
+        try:
+            data[key] = get_region_history(item, region, numDays) if key == region else get_server_history(item, *key, numDays)
+        except Exception as e:
+            data[key] = str(e)
+    return data
+
+
+def render_item(item: str, servers: list, region: str, data: dict, numDays: int, out: str, format: str = "png") -> list:
+    """
+    Renders all three charts per server of an item into `out`, from the histories loaded by `load_item`.
+
+    Parameters
+    ----------
+    `servers`: List of `(server, faction)` tuples.
+    `data`: The histories returned by `load_item`.
+
+    Returns
+    -------
+    List with one dictionary per server, of the form:
+    >>> {"item": "Saronite Ore", "server": "Skyfury", "faction": "Alliance", "files": {"price": "saronite-ore-skyfury-alliance-price.png", ...}, "error": None}
+    """
+    results = []
+    regionData = data[region]
+    if isinstance(regionData, str):
+        return [{"item": item, "server": server, "faction": faction, "files": {}, "error": regionData} for server,faction in servers]
+    for server, faction in servers:
+        result = {"item": item, "server": server, "faction": faction, "files": {}, "error": None}
+        try:
+            serverData = data[(server, faction)]
+            if isinstance(serverData, str):
+                raise ValueError(serverData)
+            if not len(serverData):
+                raise ValueError(f"no price history for {item} on {server}-{faction}")
+            figures = {
+                "price": lambda: price_figure(item, serverData, numDays),
+                "price_and_quantity": lambda: price_and_quantity_figure(item, serverData, numDays),
+                "price_and_region": lambda: price_and_region_figure(item, serverData, regionData, numDays, replaceOutliers=True, threshold=3),
+            }
+            stem = f"{item.lower().replace(' ', '-')}-{server.lower()}-{faction.lower()}"
+            for chart, _ in CHARTS:
+                if chart == "price_and_region" and not len(regionData):
+                    continue
+                name = f"{stem}-{chart}.{format}"
+                with open(os.path.join(out, name), "wb") as f:
+                    f.write(rasterize(figures[chart](), format))
+                result["files"][chart] = name
+        except Exception as e:
+            result["error"] = str(e)
+        results.append(result)
+    return results
+
+
+
+
+
+def write_index(results: list, out: str, numDays: int) -> str:
+    """
+    Writes an `index.html` page showing every rendered chart, grouped by item and server.  Returns its path.
+    """
+    rows = []
+    for r in sorted(results, key=lambda r: (r["item"].lower(), r["server"], r["faction"])):
+        title = html.escape(f"{r['item']} - {r['server']} {r['faction']}")
+        if r["error"]:
+            rows.append(f"<h2>{title}</h2>\n<p class=\"error\">{html.escape(r['error'])}</p>")
+            continue
+        images = "\n".join(f"<figure><img src=\"{html.escape(r['files'][chart])}\" alt=\"{label}\"><figcaption>{label}</figcaption></figure>"
+                           for chart,label in CHARTS if chart in r["files"])
+        rows.append(f"<h2>{title}</h2>\n<div class=\"charts\">\n{images}\n</div>")
+    page = f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Market report - last {numDays} days</title>
+<style>
+body {{ background: #0e1117; color: #ebebd6; font-family: sans-serif; margin: 2em; }}
+.charts {{ display: flex; flex-wrap: wrap; gap: 1em; }}
+figure {{ margin: 0; }}
+img {{ width: 480px; }}
+.error {{ color: #FF9B44; }}
+</style>
+</head>
+<body>
+<h1>Market report - last {numDays} days</h1>
+{chr(10).join(rows)}
+</body>
+</html>
+"""
+    path = os.path.join(out, "index.html")
+    with open(path, "w") as f:
+        f.write(page)
+    return path
+
+
+
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Render the charts of every item on a watchlist.")
+    parser.add_argument("watchlist", help="Path of the watchlist JSON file.")
+    parser.add_argument("--out", default="report", help="Folder to write the images and index.html to.")
+    parser.add_argument("--days", type=int, default=7, help="Number of days to plot.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of render processes.")
+    parser.add_argument("--format", default="png", choices=["png", "svg"], help="Image format.")
+    args = parser.parse_args()
+
+    watchlist = Watchlist.load(args.watchlist)
+    os.makedirs(args.out, exist_ok=True)
+    region = watchlist.regions[0] if watchlist.regions else "US"
+    servers = watchlist.servers()
+    results = []
+    # fetch (and write the store) in this process only, render in the workers
+    api.reserve_connections(args.workers)
+    with ThreadPoolExecutor(max_workers=args.workers) as loader, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        loaded = loader.map(lambda item: load_item(item, servers, region, args.days), watchlist.items)
+        futures = [pool.submit(render_item, item, servers, region, data, args.days, args.out, args.format) for item, data in zip(watchlist.items, loaded)]
+        for i,future in enumerate(as_completed(futures), 1):
+            for result in future.result():
+                results.append(result)
+                status = result["error"] or f"{len(result['files'])} charts"
+                print(f"[{i}/{len(futures)}] {result['item']} ({result['server']} {result['faction']}): {status}")
+    print(f"Wrote {write_index(results, args.out, args.days)}")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import json
+import pytest
+import numpy as np
+import ah.api as api
+from ah.decode import decode_prices
+from ah.transport import Transport
+
+ROWS = [
+    {"marketValue": 1200, "minBuyout": 1100, "quantity": 30, "scannedAt": "2026-10-01T12:00:00.000Z"},
+    {"marketValue": 1250.5, "minBuyout": None, "quantity": 28, "scannedAt": "2026-10-01T13:00:00.000Z"},
+]
+
+
+def chunked(body: bytes, size: int = 7) -> list:
+    return [body[i:i+size] for i in range(0, len(body), size)]
+
+
+def test_decodes_rows_split_across_chunks():
+    body = json.dumps({"slug": "saronite-ore", "data": ROWS}).encode()
+    times, marketValues, minBuyouts, quantities = decode_prices(chunked(body))
+    assert times.tolist() == np.array(["2026-10-01T12:00", "2026-10-01T13:00"], dtype="datetime64[m]").tolist()
+    assert marketValues.tolist() == [1200, 1250.5]
+    assert np.isnan(minBuyouts[1])
+    assert quantities.tolist() == [30, 28]
+
+
+@pytest.mark.parametrize("row", [
+    "not a row",
+    [1, 2, 3],
+    {"marketValue": 1200, "quantity": 30},
+    {"minBuyout": 1100, "quantity": 30, "scannedAt": "2026-10-01T14:00:00.000Z"},
+    {"marketValue": "1200", "scannedAt": "2026-10-01T14:00:00.000Z"},
+])
+def test_malformed_row_raises_value_error_with_index(row):
+    body = json.dumps({"data": ROWS + [row]}).encode()
+    with pytest.raises(ValueError, match="row 2"):
+        decode_prices(chunked(body))
+
+
+def test_truncated_body_raises_value_error():
+    body = json.dumps({"data": ROWS}).encode()
+    for end in (len(body) // 2, len(body) - 1):
+        with pytest.raises(ValueError):
+            decode_prices(chunked(body[:end]))
+
+
+class StaticTransport(Transport):
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def get(self, url: str, timeout: float) -> tuple:
+        return 200, self.body
+
+
+def test_fetch_series_returns_none_for_malformed_payload(capsys):
+    previous, baseUrl = api.TRANSPORT, api.BASE_URL
+    api.set_transport(StaticTransport(json.dumps({"data": [ROWS[0], {"quantity": 3}]}).encode()))
+    try:
+        assert api.fetch_series("http://example.invalid/prices", maxAge=0) is None
+    finally:
+        api.set_transport(previous, baseUrl)
+    assert "row 1" in capsys.readouterr().out